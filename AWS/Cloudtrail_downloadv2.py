@@ -3,97 +3,278 @@
 # Supports resumable downloads, AWS credentials from credentials file, progress tracking, and cross-platform compatibility.
 
 from __future__ import print_function
-import boto3, argparse, os, sys, json, time, gzip, multiprocessing, curses, platform
-from botocore.exceptions import ClientError
-from datetime import datetime
+import boto3, argparse, os, sys, json, time, multiprocessing, platform, threading
+from botocore.config import Config
+from botocore.exceptions import HTTPClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from queue import Empty
+
+# Make the shared for509 package importable when this script is run from the AWS directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from for509.ratelimit import TokenBucket, call_with_backoff
+from for509 import fastjson
+from for509.checkpoint import CheckpointStore, default_checkpoint_db
+from for509.cloudtrail import RegionOutput, CHECKPOINT_COLLECTOR, DEFAULT_OUTPUT_CONFIG, LOOKUP_WINDOW, encode_page, event_ids
+from for509 import metrics
+from for509.sinks import open_sink, report_stream
+from for509.cli import add_output_arguments, check_output_arguments
+from for509 import integrity
+from for509.aws import base_session, role_session, RoleCredentialCache, list_organization_accounts, read_account_list, role_arn_for
+from for509.aws import DiscoveryCache, cached_account_id, cached_regions, probe_regions
+from for509.scheduler import FairScheduler
+from for509.progress import ProgressCounter, RateMeter, open_display, format_bytes, format_eta
+
+# Seconds between two samples of the download counters (and redraws of the progress display)
+SAMPLE_INTERVAL = 1.0
+
+def build_time_slices(start_time, end_time, slice_hours):
+    """
+    Splits the [start_time, end_time] window into consecutive StartTime/EndTime slices of slice_hours, newest first.
+    CloudTrail treats both bounds as inclusive and event times have one second resolution, so each older slice ends
+    one second before the start of the next newer one to keep the slices from overlapping.
+    """
+    slices = []
+    step = timedelta(hours=slice_hours)
+    slice_end = end_time.replace(microsecond=0)
+    while slice_end >= start_time:
+        slice_start = max(start_time, slice_end - step + timedelta(seconds=1))
+        slices.append({'StartTime': slice_start.isoformat(), 'EndTime': slice_end.isoformat()})
+        slice_end = slice_start - timedelta(seconds=1)
+    return slices
+
+def walk_time_slice(lookup_events, time_slice, split_events, on_page):
+    """
+    Walks every page of a single StartTime/EndTime slice, handing each page to on_page(time_slice, events, next_token).
+    If the slice turns out dense (more than split_events events and still more pages to go), the unread remainder is
+    split in two and returned so the caller can spread it over idle workers. Returns an empty list once the slice is done.
+    """
+    start_time = datetime.fromisoformat(time_slice['StartTime'])
+    end_time = datetime.fromisoformat(time_slice['EndTime'])
+    next_token = time_slice.get('NextToken')
+
+    # Events sharing the oldest second seen so far, used to avoid re-downloading them if the slice gets split there
+    boundary_time = end_time
+    boundary_ids = set(time_slice.get('SkipEventIds', []))
+    walked = 0
+
+    while True:
+        lookup_args = {'StartTime': start_time, 'EndTime': end_time, 'MaxResults': 50}
+        if next_token:
+            lookup_args['NextToken'] = next_token
+        page = lookup_events(**lookup_args)
+        events = [event for event in page['Events'] if event['EventId'] not in boundary_ids or event['EventTime'] != end_time]
+        next_token = page.get('NextToken')
+        on_page(time_slice, events, next_token)
+        walked += len(events)
+
+        for event in page['Events']:
+            if event['EventTime'] < boundary_time:
+                boundary_time = event['EventTime']
+                boundary_ids = set()
+            if event['EventTime'] == boundary_time:
+                boundary_ids.add(event['EventId'])
+
+        if not next_token:
+            return []
+
+        # Rebalance: hand the unread part of a dense slice back as two smaller slices
+        if walked >= split_events and (boundary_time - start_time).total_seconds() >= 2:
+            midpoint = start_time + timedelta(seconds=int((boundary_time - start_time).total_seconds() // 2))
+            return [
+                {'StartTime': midpoint.isoformat(), 'EndTime': boundary_time.isoformat(), 'SkipEventIds': sorted(boundary_ids)},
+                {'StartTime': start_time.isoformat(), 'EndTime': (midpoint - timedelta(seconds=1)).isoformat()},
+            ]
+
+def encode_event(event):
+    """
+    Returns the JSON encoded CloudTrail record for an event returned by LookupEvents.
+    The API already returns the record as a JSON string, so it is passed through untouched.
+    """
+    return event['CloudTrailEvent']
 
-def regionDownload(session_params, region_name, log_directory, queue):
+def reserialize_event(event):
+    """
+    Parses and re-encodes the CloudTrail record, for when the record has to be normalized rather than passed through.
+    """
+    return fastjson.dumps(fastjson.loads(event['CloudTrailEvent']))
+
+def sliceDownload(lookup_events, slices, total_logs, slice_config, output, encode, progress):
+    """
+    Downloads a region's time slices concurrently on a bounded thread pool, re-queueing the halves of any slice that
+    turns out dense. All slices share the region's RegionOutput. Each page is written along with the pending slices and
+    their tokens, so the checkpoint committed when a file is finished lets an interrupted download resume where each
+    slice left off without losing or repeating any event. The seconds of the pending slices not walked yet are
+    reported to the progress counter as the remaining work.
+    """
+    lock = threading.Lock()
+    pending = {}
+    counter = {'total_logs': total_logs, 'next_id': 0}
+    positions = {}  # [StartTime, oldest event time walked so far] of each pending slice, by slice id
+
+    def add_position(slice_id, time_slice):
+        positions[slice_id] = [datetime.fromisoformat(time_slice['StartTime']), datetime.fromisoformat(time_slice['EndTime'])]
+
+    def add_slice(time_slice):
+        slice_id = counter['next_id']
+        counter['next_id'] += 1
+        pending[slice_id] = time_slice
+        add_position(slice_id, time_slice)
+        return slice_id
+
+    def pending_slices():
+        # A slice whose last page has been written has a NextToken of None but may not have been removed from pending yet
+        return [time_slice for time_slice in pending.values() if time_slice.get('NextToken', '') is not None]
+
+    def on_page(slice_id, time_slice, events, next_token):
+        with lock:
+            time_slice['NextToken'] = next_token
+            counter['total_logs'] += len(events)
+            output.write(encode_page(events, encode), {'Slices': pending_slices()}, counter['total_logs'], event_ids(events))
+            if events:
+                positions[slice_id][1] = min(positions[slice_id][1], events[-1]['EventTime'])
+            progress.set_remaining(sum((position - start).total_seconds() for start, position in positions.values()))
+
+    with ThreadPoolExecutor(max_workers=slice_config['workers']) as executor:
+        running = {}
+        with lock:
+            for time_slice in slices:
+                slice_id = add_slice(time_slice)
+                running[executor.submit(walk_time_slice, lookup_events, time_slice, slice_config['split_events'], partial(on_page, slice_id))] = slice_id
+
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                slice_id = running.pop(future)
+                new_slices = future.result()
+                with lock:
+                    del pending[slice_id]
+                    del positions[slice_id]
+                    for time_slice in new_slices:
+                        new_id = add_slice(time_slice)
+                        running[executor.submit(walk_time_slice, lookup_events, time_slice, slice_config['split_events'], partial(on_page, new_id))] = new_id
+
+    output.finish({'Slices': []})
+    return counter['total_logs']
+
+def regionDownload(session_params, region_name, log_directory, queue, limiter, checkpoint_db, slice_config=None, output_config=None, progress=None):
     """
     Downloads CloudTrail logs for a specific region and stores the pagination token and the number of events already downloaded for resuming if interrupted.
     Saves logs to the specified directory.
+    Every LookupEvents call goes through the limiter shared by all workers of this account and region; throttled calls are retried from the same NextToken.
+    If slice_config is set, the 90 day window is split into time slices that are downloaded concurrently.
+    Records are written to rolling gzip files sized by output_config. Each time a file is finished, the resume cursor and the file are committed
+    together to the checkpoint store in checkpoint_db.
+    If session_params contains a role_arn, that role is assumed (and re-assumed before the credentials expire) to download a member account.
+    Downloaded events and bytes are counted in progress, a ProgressCounter sampled by the main process; only completion is sent through queue.
     """
-    session = boto3.Session(
-        aws_access_key_id=session_params['aws_access_key_id'],
-        aws_secret_access_key=session_params['aws_secret_access_key'],
-        aws_session_token=session_params['aws_session_token'],
-        region_name=region_name
-    )
-
-    client = session.client('cloudtrail', region_name=region_name)
-    paginator = client.get_paginator('lookup_events')
-    token_filename = os.path.join(log_directory, f'{region_name}_resume.json')
-    StartingToken = None
-    total_logs = 0
-    is_resumed = False  # Flag to check if this is a resumed download
-
-    # Load the token and event count from the file if it exists (to resume)
-    if os.path.exists(token_filename):
-        try:
-            if os.path.getsize(token_filename) > 0:  # Check if the file is not empty
-                with open(token_filename, 'r') as f:
-                    token_data = json.load(f)
-                    StartingToken = token_data.get('NextToken')
-                    total_logs = token_data.get('DownloadedEvents', 0)
-                    is_resumed = True  # Mark as resumed
-            else:
-                # If the file is empty, mark as completed
-                queue.put([region_name, 'done', is_resumed])
+    progress = progress or ProgressCounter()
+    if session_params.get('role_arn'):
+        session = role_session(session_params, session_params['role_arn'], session_params.get('external_id'),
+                               session_params.get('role_credentials'), region_name)
+    else:
+        session = base_session(session_params, region_name)
+
+    # Retries are handled by call_with_backoff so that throttling slows down the shared limiter
+    client = session.client('cloudtrail', region_name=region_name, config=Config(retries={'total_max_attempts': 1}))
+
+    def lookup_events(**lookup_args):
+        return call_with_backoff(limiter, client.lookup_events, retry_on=(HTTPClientError,), metric='cloudtrail:LookupEvents', **lookup_args)
+
+    account_id = session_params.get('account_id') or session.client('sts', region_name=region_name).get_caller_identity()["Account"]
+
+    # Load the cursor and event count from the checkpoint store if it exists (to resume)
+    output = RegionOutput(checkpoint_db, account_id, region_name, log_directory, output_config, progress)
+    if output.done:
+        output.close()
+        queue.put([account_id, region_name, 'done', True])
+        return
+    is_resumed = output.is_resumed  # Flag to check if this is a resumed download
+    StartingToken = output.cursor.get('NextToken')
+    slices = output.cursor.get('Slices')
+    total_logs = output.events
+    encode = reserialize_event if (output_config or DEFAULT_OUTPUT_CONFIG)['reserialize'] else encode_event
+
+    if slices is not None or (slice_config and not is_resumed):
+        if slices is None:
+            end_time = datetime.now(timezone.utc)
+            slices = build_time_slices(end_time - LOOKUP_WINDOW, end_time, slice_config['slice_hours'])
+
+        sliceDownload(lookup_events, slices, total_logs, slice_config or DEFAULT_SLICE_CONFIG, output, encode, progress)
+        queue.put([account_id, region_name, 'done', is_resumed])
+        queue.close()
+        return
+
+    # Fetch logs one page at a time so that a throttled call is retried from the same NextToken
+    def page_iterator(next_token):
+        while True:
+            lookup_args = {'LookupAttributes': [], 'MaxResults': 50}
+            if next_token:
+                lookup_args['NextToken'] = next_token
+            page = lookup_events(**lookup_args)
+            yield page
+            next_token = page.get('NextToken')
+            if not next_token:
                 return
-        except (json.JSONDecodeError, KeyError):
-            # If the JSON is invalid, mark the region as done and log an error
-            queue.put([region_name, 'done', is_resumed])
-            return
-
-    timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
-    account_id = session.client('sts', region_name=region_name).get_caller_identity()["Account"]
-
-    # Fetch logs using pagination
-    page_iterator = paginator.paginate(
-        LookupAttributes=[],
-        PaginationConfig={'PageSize': 50, 'StartingToken': StartingToken}
-    )
-
-    for page in page_iterator:
-        filename = os.path.join(log_directory, f'{account_id}_CloudTrail_{region_name}_{timestamp}_{total_logs}.json.gz')
-        with gzip.open(filename, 'w') as cloudTrail_logs:
-            data = {'Records': []}
-            
-            if len(page['Events']) == 0:
-                continue
 
-            # Collect logs from the events
-            for event in page['Events']:
-                data['Records'].append(json.loads(event['CloudTrailEvent']))
-
-            cloudTrail_logs.write(json.dumps(data).encode('utf-8'))
-            total_logs += len(page['Events'])
-            queue.put([region_name, total_logs, is_resumed])  # Send the log count and resume status to the main process
-
-        # Save token and downloaded event count for resuming
-        try:
-            with open(token_filename, 'w') as token_file:
-                token_data = {
-                    'NextToken': page['NextToken'],
-                    'DownloadedEvents': total_logs
-                }
-                json.dump(token_data, token_file)
-            StartingToken = page['NextToken']
-        except KeyError:
-            pass  # No more pages
+    # Events come newest first, so the time between the oldest event so far and the start of the window is what is left
+    window_start = datetime.now(timezone.utc) - LOOKUP_WINDOW
+    for page in page_iterator(StartingToken):
+        if len(page['Events']) == 0:
+            continue
+
+        # Collect logs from the events. The token is only committed once the events before it are in a finished file
+        total_logs += len(page['Events'])
+        output.write(encode_page(page['Events'], encode), {'NextToken': page.get('NextToken')}, total_logs, event_ids(page['Events']))
+        progress.set_remaining(max(0, (page['Events'][-1]['EventTime'] - window_start).total_seconds()))
+
+    # Finish the last file and record the region as complete
+    output.finish({'NextToken': None})
 
     # Signal that the region download is complete
-    queue.put([region_name, 'done', is_resumed])
+    queue.put([account_id, region_name, 'done', is_resumed])
     queue.close()
 
-def remove_all_token_files(regions, log_directory):
+def regionWorker(*args):
+    """
+    Process entry point of a region download: runs regionDownload, saving the metrics of the process for the main
+    process to export as it goes.
+    """
+    snapshots = metrics.SnapshotThread().start()
+    try:
+        regionDownload(*args)
+    finally:
+        snapshots.stop()
+
+# Used when resuming a sliced download without slicing options on the command line
+DEFAULT_SLICE_CONFIG = {'slice_hours': 24, 'workers': 4, 'split_events': 10000}
+
+def migrate_resume_file(store, scope, token_filename):
+    """
+    Imports a {region}_resume.json file left by an older version of this script into the checkpoint store.
+    An empty or unreadable file is not trusted to mean the region is complete; the region is simply downloaded again.
     """
-    Removes all resume token files for the regions after the entire process is complete.
-    Only removes files if all regions are done.
+    if not os.path.exists(token_filename):
+        return
+    try:
+        with open(token_filename, 'r') as f:
+            token_data = json.load(f)
+        if store.load(CHECKPOINT_COLLECTOR, scope) is None:
+            done = 'NextToken' not in token_data and not token_data.get('Slices')
+            cursor = {'Slices': token_data['Slices']} if 'Slices' in token_data else {'NextToken': token_data.get('NextToken')}
+            store.commit(CHECKPOINT_COLLECTOR, scope, cursor, token_data.get('DownloadedEvents', 0), done=done)
+    except (ValueError, KeyError, TypeError):
+        pass
+    os.remove(token_filename)
+
+def clear_region_checkpoints(store, account_id, regions):
+    """
+    Removes the checkpoints for the regions after the entire process is complete.
+    Only called if all regions are done.
     """
     for region in regions:
-        token_filename = os.path.join(log_directory, f'{region}_resume.json')
-        if os.path.exists(token_filename):
-            os.remove(token_filename)
+        store.clear(CHECKPOINT_COLLECTOR, f'{account_id}:{region}')
 
 def all_regions_done(completed_regions, total_regions):
     """
@@ -101,10 +282,23 @@ def all_regions_done(completed_regions, total_regions):
     """
     return len(completed_regions) == total_regions
 
+def collection_targets(args, session_params, discovery_cache):
+    """
+    Returns the (account_id, role_arn) pairs to collect from. Without --accounts or --organization this is just the
+    account the credentials belong to, with no role to assume.
+    """
+    if args.organization:
+        accounts = list_organization_accounts(session_params)
+    elif args.accounts:
+        accounts = read_account_list(args.accounts)
+    else:
+        return [(cached_account_id(discovery_cache, session_params), None)]
+    return [(role_arn_for(account, args.role_name).split(':')[4], role_arn_for(account, args.role_name)) for account in accounts]
+
 def main(args):
     """
     Main function to initiate the downloading of CloudTrail logs from all regions and save them to the specified directory.
-    Automatically resumes from token files if present and deletes token files once all regions are done.
+    Automatically resumes from the checkpoint store if present and clears the checkpoints once all regions are done.
     """
 
     # Create a session dictionary that can be passed to processes (since boto3 session objects are not pickleable)
@@ -124,106 +318,227 @@ def main(args):
 
     # Create the output directory if it doesn't exist
     log_directory = args.output_directory
+    slice_config = None
+    if args.slice_hours:
+        slice_config = {'slice_hours': args.slice_hours, 'workers': args.slice_workers, 'split_events': args.split_events}
+    output_config = {
+        'max_events': args.max_file_events,
+        'max_bytes': args.max_file_mb * 1024 * 1024,
+        'ndjson': args.output_format == 'ndjson',
+        'reserialize': args.reserialize,
+        'dedup': not args.no_dedup,
+        'sink': args.sink,
+        'local_copy': not args.no_local_copy
+    }
+    if args.sink:
+        # Fails early on a bad URL or a missing client library
+        open_sink(args.sink, 'cloudtrail').close()
+    # With a stdout sink, the progress display and the summary go to standard error
+    out = report_stream(args.sink)
+
     if not os.path.exists(log_directory):
         os.makedirs(log_directory)
 
-    stdscr = curses.initscr()  # Initialize curses screen
+    checkpoint_db = args.checkpoint_db or default_checkpoint_db(log_directory)
+    store = CheckpointStore(checkpoint_db)
+
+    # Work out which accounts to collect from. Role credentials are assumed once per account and shared by its regions
+    discovery_cache = DiscoveryCache(args.cache_file, args.cache_ttl * 3600)
+    targets = collection_targets(args, session_params, discovery_cache)
+    credential_cache = RoleCredentialCache(session_params, args.external_id)
+    multi_account = len(targets) > 1 or targets[0][1] is not None
+
+    # Started before the workers so that they inherit where to save their metrics
+    exporter = metrics.MetricsExporter(args.metrics_file, args.metrics_summary, args.metrics_port).start()
+    # Likewise for the manifest the digests of every file written are recorded in
+    manifest = None
+    if output_config['local_copy']:
+        manifest = integrity.RunManifest(log_directory, 'cloudtrail', args.blake3, args.manifest_key_file)
+
+    # Progress is shown full screen on a terminal and as periodic log lines otherwise
+    display = open_display('Downloading AWS CloudTrail logs from All Regions', out)
     try:
-        stdscr.border(0)
-        stdscr.addstr(0, 0, 'Downloading AWS CloudTrail logs from All Regions', curses.A_BOLD)
-        stdscr.addstr(1, 1, 'Press q to quit', curses.A_BOLD)
-        stdscr.nodelay(1)
-        curses.cbreak()
-
-        # Retrieve AWS regions
-        ec2_client = boto3.client('ec2', aws_access_key_id=session_params['aws_access_key_id'],
-                                  aws_secret_access_key=session_params['aws_secret_access_key'],
-                                  aws_session_token=session_params['aws_session_token'],
-                                  region_name='us-east-1')
-
-        regions = ec2_client.describe_regions()
-        regionindex = {}
-        region_count = 2
-        regions_done = 0
+        # Account x region work items are run on a bounded number of processes, taking turns between accounts. The
+        # async engine bounds the regions it walks at once itself, so there the scheduler only sets the order
+        scheduler = FairScheduler(args.max_concurrency if args.engine == 'async' else args.max_workers)
+        account_regions = {}  # Regions enabled in each account
         log_queue = multiprocessing.Queue()
 
         start_time = time.time()  # Start time for calculating the total run time
 
-        processes = []
-        completed_regions = []  # List of completed regions
-
-        # Start processes to download logs for each region
-        for region in regions['Regions']:
-            region_name = region['RegionName']
-            stdscr.addstr(region_count, 1, f'{region_name}: 0 events', curses.A_NORMAL)
-            regionindex[region_name] = region_count
-
-            # Check if this region has a completed token file
-            token_filename = os.path.join(log_directory, f'{region_name}_resume.json')
-            if os.path.exists(token_filename):
-                with open(token_filename, 'r') as f:
-                    try:
-                        token_data = json.load(f)
-                        if 'NextToken' not in token_data:  # If there is no next token, this region is complete
-                            stdscr.addstr(region_count, 1, ' ' * 50)  # Clear previous content
-                            stdscr.addstr(region_count, 1, f'{region_name}: DONE', curses.A_BOLD)
-                            completed_regions.append(region_name)
-                            regions_done += 1
-                            region_count += 1
-                            continue
-                    except (json.JSONDecodeError, KeyError):
-                        stdscr.addstr(region_count, 1, ' ' * 50)  # Clear previous content
-                        stdscr.addstr(region_count, 1, f'{region_name}: DONE', curses.A_BOLD)
-                        completed_regions.append(region_name)
-                        regions_done += 1
-                        region_count += 1
-                        continue
-
-            # Start a new process for regions that are not marked as done
-            process = multiprocessing.Process(target=regionDownload, args=(session_params, region_name, log_directory, log_queue))
-            processes.append(process)
-            process.start()
-            region_count += 1
-
-        # Monitor the progress of the downloads
-        total_downloaded = 0
-        while regions_done < region_count - 2:
-            region_name, log_count, is_resumed = log_queue.get()
-            if log_count == "done":
-                regions_done += 1
-                stdscr.addstr(int(regionindex[region_name]), 1, ' ' * 50)  # Clear previous content
-                stdscr.addstr(int(regionindex[region_name]), 1, f'{region_name}: DONE', curses.A_BOLD)
-                completed_regions.append(region_name)
+        # The async engine runs every region as a coroutine in this process instead of one process per region
+        engine = None
+        if args.engine == 'async':
+            from for509.cloudtrail_async import AsyncEngine
+            encode = reserialize_event if args.reserialize else encode_event
+            engine = AsyncEngine(log_directory, log_queue, checkpoint_db, encode, output_config, args.max_concurrency).start()
+
+        processes = {}  # Running process (or async engine task) of each (account, region)
+        limiters = {}  # LookupEvents is rate limited per account and region, so each gets its own limiter
+        progress = {}  # Shared download counters of each (account, region), written by its worker
+        meter = RateMeter()
+        rates = {}  # Latest (events/s, bytes/s, ETA) of each running (account, region)
+        completed_regions = set()  # (account, region) pairs that are complete
+        empty_regions = set()  # (account, region) pairs the pre-flight probe found without any events
+        failed_regions = set()  # (account, region) pairs whose process died
+        is_resumed = False
+
+        def draw(key):
+            account_id, region_name = key
+            if multi_account:
+                regions = account_regions[account_id]
+                done = sum(1 for region in regions if (account_id, region) in completed_regions)
+                events = sum(counter.events for (account, _), counter in progress.items() if account == account_id)
+                events_rate = sum(rate[0] for (account, _), rate in rates.items() if account == account_id)
+                bytes_rate = sum(rate[1] for (account, _), rate in rates.items() if account == account_id)
+                throttles = sum(limiter.throttles for (account, _), limiter in limiters.items() if account == account_id)
+                display.set_row(account_id, f'{account_id}: {events} events, {events_rate:.0f} events/s, {format_bytes(bytes_rate)}/s, '
+                                            f'{done}/{len(regions)} regions done, {throttles} throttled', done == len(regions))
+                return
+
+            events = progress[key].events if key in progress else 0
+            if key in empty_regions:
+                display.set_row(region_name, f'{region_name}: DONE (no events)', True)
+            elif key in completed_regions:
+                display.set_row(region_name, f'{region_name}: DONE, {events} events', True)
+            elif key in failed_regions:
+                display.set_row(region_name, f'{region_name}: FAILED after {events} events', True)
+            else:
+                events_rate, bytes_rate, eta = rates.get(key, (0.0, 0.0, None))
+                throttles = limiters[key].throttles if key in limiters else 0
+                display.set_row(region_name, f'{region_name}: {events} events, {events_rate:.1f} events/s, {format_bytes(bytes_rate)}/s, '
+                                             f'ETA {format_eta(eta)}, {throttles} throttled')
+
+        candidates = []  # (account_id, role_arn, region_name, session) of regions that still need downloading
+        for account_id, role_arn in targets:
+            # Retrieve the AWS regions enabled in this account
+            if role_arn:
+                account_session = role_session(session_params, role_arn, args.external_id, credential_cache.get(role_arn), 'us-east-1')
             else:
-                stdscr.addstr(int(regionindex[region_name]), 1, f'{region_name}: {log_count} events', curses.A_NORMAL)
-                total_downloaded += log_count
+                account_session = base_session(session_params, 'us-east-1')
+            account_regions[account_id] = cached_regions(discovery_cache, account_session, account_id)
+
+            for region_name in account_regions[account_id]:
+                # Check if this region has a completed checkpoint
+                scope = f'{account_id}:{region_name}'
+                if not multi_account:
+                    migrate_resume_file(store, scope, os.path.join(log_directory, f'{region_name}_resume.json'))
+                checkpoint = store.load(CHECKPOINT_COLLECTOR, scope)
+                is_resumed = is_resumed or checkpoint is not None
+                if checkpoint is not None and checkpoint.done:
+                    completed_regions.add((account_id, region_name))
+                elif checkpoint is not None or args.no_probe:
+                    scheduler.add(account_id, (role_arn, region_name))
+                else:
+                    candidates.append((account_id, role_arn, region_name, account_session))
+                draw((account_id, region_name))
+
+        # Regions without a single event are marked done without starting a worker for them. The probes spend the
+        # LookupEvents budget of their region, so their limiters are made now and kept for the download processes
+        for account_id, _, region_name, _ in candidates:
+            limiters[(account_id, region_name)] = TokenBucket(rate=args.lookup_rate)
+        empty_regions.update(probe_regions(discovery_cache, [(account_id, region_name, account_session) for account_id, _, region_name, account_session in candidates], limiters))
+        discovery_cache.save()
+        for account_id, role_arn, region_name, _ in candidates:
+            if (account_id, region_name) in empty_regions:
+                completed_regions.add((account_id, region_name))
+                draw((account_id, region_name))
+            else:
+                scheduler.add(account_id, (role_arn, region_name))
+
+        # Start work items as processes free up. Workers only report completion through the queue; their counters
+        # are sampled every SAMPLE_INTERVAL, so neither side ever waits on the other
+        next_sample = time.monotonic()
+        while True:
+            work = scheduler.next()
+            while work is not None:
+                account_id, (role_arn, region_name) = work
+                key = (account_id, region_name)
+                worker_params = dict(session_params, account_id=account_id)
+                if role_arn:
+                    worker_params.update(role_arn=role_arn, external_id=args.external_id, role_credentials=credential_cache.get(role_arn))
+                if engine is not None:
+                    processes[key] = engine.submit(worker_params, region_name, args.lookup_rate)
+                    limiters[key] = processes[key].limiter
+                    progress[key] = processes[key].progress
+                else:
+                    if key not in limiters:
+                        limiters[key] = TokenBucket(rate=args.lookup_rate)
+                    progress[key] = ProgressCounter()
+                    processes[key] = multiprocessing.Process(target=regionWorker, args=(worker_params, region_name, log_directory, log_queue, limiters[key], checkpoint_db, slice_config, output_config, progress[key]))
+                    processes[key].start()
+                work = scheduler.next()
+
+            if not processes:
+                break
+
+            try:
+                account_id, region_name, status, resumed = log_queue.get(timeout=max(0, next_sample - time.monotonic()))
+                key = (account_id, region_name)
+                is_resumed = is_resumed or resumed
+                if status == 'done':
+                    completed_regions.add(key)
+                    processes.pop(key).join()
+                    scheduler.finished(account_id)
+                    rates.pop(key, None)
+                    meter.forget(key)
+                    draw(key)
+                continue
+            except Empty:
+                pass
+
+            # A process that exited with an error will never report done, so give its slot to the next work item
+            for key, process in list(processes.items()):
+                if process.exitcode not in (None, 0):
+                    failed_regions.add(key)
+                    del processes[key]
+                    scheduler.finished(key[0])
+                    rates.pop(key, None)
+                    draw(key)
+
+            next_sample = time.monotonic() + SAMPLE_INTERVAL
+            for key in processes:
+                rates[key] = meter.sample(key, progress[key])
+                draw(key)
 
             # Calculate elapsed time
             elapsed_time = time.time() - start_time
             if is_resumed:
-                stdscr.addstr(0, 50, f'RESUMED DOWNLOAD - Elapsed: {int(elapsed_time)}s')
+                display.set_status(f'RESUMED DOWNLOAD - Elapsed: {int(elapsed_time)}s')
             else:
-                stdscr.addstr(0, 50, f'Elapsed: {int(elapsed_time)}s')
+                display.set_status(f'Elapsed: {int(elapsed_time)}s')
+            display.refresh()
 
-            if stdscr.getch() == ord('q'):
+            if display.quit_requested():
                 # Cleanup and exit
-                stdscr.addstr(0, 50, "Exiting...")
+                display.set_status('Exiting...')
+                display.refresh()
                 break
 
         # Terminate all running processes
-        for process in processes:
+        for process in processes.values():
             process.terminate()
             process.join()
+        if engine is not None:
+            engine.stop()
 
     finally:
-        curses.endwin()  # Ensure curses cleans up the terminal state even if an error occurs
+        display.close()  # Ensure curses cleans up the terminal state even if an error occurs
 
-    # Only remove token files if all regions are done
-    if all_regions_done(completed_regions, len(regions['Regions'])):
-        remove_all_token_files([region['RegionName'] for region in regions['Regions']], log_directory)
+    # Only remove the checkpoints if all regions of all accounts are done
+    if all_regions_done(completed_regions, sum(len(regions) for regions in account_regions.values())):
+        for account_id, regions in account_regions.items():
+            clear_region_checkpoints(store, account_id, regions)
+    store.close()
+    exporter.close()
+    if manifest is not None:
+        print(f'Manifest: {manifest.close()}', file=out)
 
     total_time = time.time() - start_time
-    print(f'Total logs downloaded: {total_downloaded}. Total time: {int(total_time)} seconds.')
+    print(f'Total logs downloaded: {sum(counter.events for counter in progress.values())}. Total time: {int(total_time)} seconds.', file=out)
+    if failed_regions:
+        print('Failed: ' + ', '.join(f'{account_id}:{region_name}' for account_id, region_name in sorted(failed_regions)), file=out)
+        sys.exit(1)
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -237,6 +552,30 @@ if __name__ == '__main__':
     parser.add_argument('--session-token', required=False, default=None, help='The AWS session token to use for authentication, if there is one.')
     parser.add_argument('--profile', required=False, default='default', help='The AWS profile name to use from the credentials file.')
     parser.add_argument('--output-directory', required=True, help='Directory to save CloudTrail logs.')
-
+    parser.add_argument('--accounts', required=False, default=None, help='File listing the account IDs (or role ARNs) to collect from, one per line.')
+    parser.add_argument('--organization', required=False, action='store_true', help='Collect from every active account of the AWS Organization.')
+    parser.add_argument('--role-name', required=False, default='OrganizationAccountAccessRole', help='Role to assume in each account listed by --accounts or --organization.')
+    parser.add_argument('--external-id', required=False, default=None, help='External ID to pass when assuming the role, if it requires one.')
+    parser.add_argument('--cache-file', required=False, default=os.path.join(os.path.expanduser('~'), '.cache', 'for509', 'aws_discovery.json'), help='File caching account IDs, region lists and empty regions between runs.')
+    parser.add_argument('--cache-ttl', required=False, default=24, type=float, help='Hours cached discovery results stay valid (0 disables the cache).')
+    parser.add_argument('--no-probe', required=False, action='store_true', help='Start a worker for every region instead of first probing for regions without events.')
+    parser.add_argument('--max-workers', required=False, default=16, type=int, help='Maximum number of account/region download processes running at the same time (process engine).')
+    parser.add_argument('--engine', required=False, default='process', choices=['process', 'async'], help='Download each region in its own process (default) or all regions as coroutines in one process (requires aiobotocore).')
+    parser.add_argument('--max-concurrency', required=False, default=64, type=int, help='Maximum number of regions the async engine walks at the same time.')
+    parser.add_argument('--checkpoint-db', required=False, default=None, help='SQLite checkpoint database used to resume interrupted downloads (default: checkpoints.sqlite in the output directory).')
+    parser.add_argument('--max-file-events', required=False, default=100000, type=int, help='Start a new output file after this many events.')
+    parser.add_argument('--max-file-mb', required=False, default=64, type=int, help='Start a new output file after this many MB of compressed output.')
+    parser.add_argument('--output-format', required=False, default='records', choices=['records', 'ndjson'], help='Write {"Records":[...]} files like a CloudTrail trail (default) or one event per line.')
+    parser.add_argument('--reserialize', required=False, action='store_true', help='Parse and re-encode every event instead of passing the JSON returned by the API straight through.')
+    parser.add_argument('--no-dedup', required=False, action='store_true', help='Keep events already written by an earlier run into the output directory (by default their event IDs are remembered and repeats dropped).')
+    parser.add_argument('--lookup-rate', required=False, default=2.0, type=float, help='Maximum LookupEvents requests per second per region (the CloudTrail limit is 2).')
+    parser.add_argument('--slice-hours', required=False, default=0, type=int, help='Split each region into time slices of this many hours and download them concurrently (0 disables slicing).')
+    parser.add_argument('--slice-workers', required=False, default=4, type=int, help='Number of time slices downloaded concurrently per region when slicing.')
+    parser.add_argument('--split-events', required=False, default=10000, type=int, help='Split a slice in two once this many of its events have been downloaded and more remain.')
+
+    add_output_arguments(parser)
     args = parser.parse_args()
+    check_output_arguments(parser, args)
+    if args.engine == 'async' and args.slice_hours:
+        parser.error('--slice-hours is only supported by the process engine')
     main(args)
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# AWS CloudTrail trail bucket download script for FOR509
+# LookupEvents (awsCloudTrailDownload.py, Cloudtrail_downloadv2.py) only reaches back 90 days at about 2 requests per
+# second. Trails, including organization trails, keep every event in an S3 bucket: this script downloads their log
+# files, listing the AWSLogs/<account>/CloudTrail/<region>/<yyyy>/<mm>/<dd>/ prefixes in parallel and fetching the
+# files over a pool of connections, so years of logs come down as fast as the bandwidth allows.
+#
+# Usage:
+#   python3 Cloudtrail_s3_download.py --bucket org-trail-logs --output-directory /cases/incident-42/trail
+#   python3 Cloudtrail_s3_download.py --bucket org-trail-logs --prefix audit --start 2023-01-01 --end 2024-06-30 --accounts 123456789012
+#   python3 Cloudtrail_s3_download.py --bucket org-trail-logs --role-arn arn:aws:iam::111122223333:role/LogArchiveRead
+#
+# The log files are saved as they are, gzipped {"Records":[...]} files like the ones regionDownload writes, under
+# <output directory>/<bucket>/<key>. To test against moto, run moto_server and set AWS_ENDPOINT_URL_S3=http://127.0.0.1:5000
+
+import argparse, gzip, io, os, re, sys, threading, time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from queue import Full, Queue
+
+import boto3
+from botocore.config import Config
+
+# Make the shared for509 package importable when this script is run from the AWS directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from for509.aws import base_session, role_session, trail_file, in_delivery_window, date_prefix_in_window, list_common_prefixes
+from for509.checkpoint import CheckpointStore, OutputFile, default_checkpoint_db
+from for509.ratelimit import AdaptiveConcurrency, THROTTLE_STATUS_CODES
+from for509 import fastjson, integrity, metrics
+from for509.cli import add_output_arguments, check_output_arguments
+from for509.sinks import open_sink, report_stream
+
+# Log files already downloaded (bucket/key, ETag and size) are recorded under this collector, so re-running skips them
+CHECKPOINT_COLLECTOR = 'cloudtrail-s3'
+# The newest delivery time downloaded from each bucket/account/region, where the next incremental listing starts
+REGION_COLLECTOR = 'cloudtrail-s3-region'
+
+# Listed files waiting for a download thread. Listing pauses when this is full, so memory stays flat however many files there are
+WORK_QUEUE_SIZE = 1000
+# Prefixes (accounts, regions, years, months and days) listed at the same time
+LISTING_THREADS = 16
+
+# Objects are streamed to disk in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+# Objects larger than this are downloaded with several ranged GETs in parallel. CloudTrail rarely writes files this
+# large, but busy organization trails can
+LARGE_OBJECT_SIZE = 16 * 1024 * 1024
+RANGE_SIZE = 8 * 1024 * 1024
+LARGE_OBJECT_CONCURRENCY = 4
+
+# The ETag of an object uploaded in one part without KMS encryption is the MD5 of its bytes
+_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+_KMS_ENCRYPTION = ('aws:kms', 'aws:kms:dsse')
+
+# One trail log file: where it is, the ETag and size it was listed with, and the account, region and delivery time of its key
+TrailObject = namedtuple('TrailObject', ['key', 'etag', 'size', 'account', 'region', 'delivered'])
+# One prefix of the key layout still to be listed, with the date fields of the prefix and the start of its region's window
+ListingTask = namedtuple('ListingTask', ['level', 'prefix', 'account', 'region', 'start', 'fields'])
+
+# Date prefixes under a region, each listed for the next
+_NEXT_DATE_LEVEL = {'region': 'year', 'year': 'month', 'month': 'day'}
+
+def parse_time(value):
+    # --start/--end accept a date or an ISO 8601 time, in UTC unless they say otherwise
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+class TrailBucketDownloader(object):
+    def __init__(self, session, bucket, output_directory, store, limiter, key_prefix='', start=None, end=None, accounts=None,
+                 regions=None, incremental=True, lookback_hours=3, sink=None, local_copy=True, max_concurrency=64):
+        # Every download thread, listing thread and range of a large object gets a pooled connection of its own
+        self.client = session.client('s3', config=Config(
+            max_pool_connections=max_concurrency * LARGE_OBJECT_CONCURRENCY + LISTING_THREADS,
+            retries={'mode': 'standard', 'max_attempts': 10}))
+        # SlowDown and 503 responses are retried by botocore, but each one also lowers the number of concurrent downloads
+        self.client.meta.events.register_first('needs-retry.s3', self.count_throttling)
+        self.bucket = bucket
+        self.key_prefix = key_prefix.strip('/') + '/' if key_prefix.strip('/') else ''
+        # Files are saved under <output directory>/<bucket>/<key>
+        self.local_path = os.path.join(output_directory, bucket)
+        self.store = store
+        self.limiter = limiter
+        self.start = start
+        self.end = end
+        self.accounts = set(accounts) if accounts else None
+        self.regions = set(regions) if regions else None
+        self.incremental = incremental
+        self.lookback = timedelta(hours=lookback_hours)
+        # Records of the downloaded files are also streamed to the sink, if there is one, and only there without a local copy
+        self.sink = sink
+        self.local_copy = local_copy
+        # What this prints goes to standard error when standard output carries the records
+        self.out = report_stream(sink)
+        # Outcome of every listed file (listed, skipped, downloaded, failed, bytes)
+        self.counts = Counter()
+        # For every (account, region) listed: the start of the time window it was collected from, the newest delivery
+        # time downloaded, and whether anything failed (in which case the next run does not skip ahead)
+        self.region_state = {}
+        self.lock = threading.Lock()
+        # Print the key of every file downloaded
+        self.verbose = True
+
+    def count(self, outcome, amount=1):
+        with self.lock:
+            self.counts[outcome] += amount
+
+    def count_throttling(self, response=None, **kwargs):
+        if response is not None and response[0].status_code in THROTTLE_STATUS_CODES:
+            self.limiter.on_throttle()
+            metrics.inc('for509_api_throttles_total', api='s3:' + kwargs['operation'].name)
+            metrics.inc('for509_api_retries_total', api='s3:' + kwargs['operation'].name)
+
+    def region_scope(self, account, region):
+        return '%s/%s%s/%s' % (self.bucket, self.key_prefix, account, region)
+
+    def region_start(self, account, region):
+        # Start of the window listed for a region. An incremental run starts a few hours before the newest file the
+        # last run downloaded, provided that run covered everything from the requested start onwards
+        state = {'start': self.start, 'newest': None, 'failed': False}
+        start = self.start
+        checkpoint = self.store.load(REGION_COLLECTOR, self.region_scope(account, region))
+        if self.incremental and checkpoint is not None:
+            recorded = parse_time(checkpoint.cursor['start']) if checkpoint.cursor['start'] else None
+            if recorded is None or (start is not None and recorded <= start):
+                state = {'start': recorded, 'newest': parse_time(checkpoint.cursor['newest_delivery']), 'failed': False}
+                start = max(start, state['newest'] - self.lookback) if start else state['newest'] - self.lookback
+        with self.lock:
+            self.region_state[(account, region)] = state
+        return start
+
+    def list_prefixes(self, prefix):
+        with metrics.timer('for509_api_call_seconds', api='s3:ListObjectsV2'):
+            return list_common_prefixes(self.client, self.bucket, prefix)
+
+    def list_task(self, task):
+        # Yields the listing tasks one level down the key layout from a prefix, or for a day, its files in the time window
+        if task.level == 'day':
+            with metrics.timer('for509_api_call_seconds', api='s3:ListObjectsV2'):
+                objects = []
+                for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=task.prefix):
+                    objects.extend(page.get('Contents', []))
+            for item in objects:
+                parsed = trail_file(item['Key'])
+                if parsed is not None and in_delivery_window(parsed[2], task.start, self.end):
+                    yield TrailObject(item['Key'], item['ETag'], item['Size'], *parsed)
+            return
+        if task.level == 'account':
+            for child in self.list_prefixes(task.prefix + 'CloudTrail/'):
+                region = child.rstrip('/').rsplit('/', 1)[-1]
+                if self.regions is None or region in self.regions:
+                    yield ListingTask('region', child, task.account, region, self.region_start(task.account, region), ())
+            return
+        for child in self.list_prefixes(task.prefix):
+            name = child[len(task.prefix):].rstrip('/')
+            if task.level in ('logs', 'organization'):
+                # Organization trails add a level for the organization ID
+                if task.level == 'logs' and name.startswith('o-'):
+                    yield ListingTask('organization', child, None, None, None, ())
+                elif re.match(r'^\d{12}$', name) and (self.accounts is None or name in self.accounts):
+                    yield ListingTask('account', child, name, None, None, ())
+            elif name.isdigit():
+                fields = task.fields + (int(name),)
+                if date_prefix_in_window(fields, task.start, self.end):
+                    yield ListingTask(_NEXT_DATE_LEVEL[task.level], child, task.account, task.region, task.start, fields)
+
+    def list_new_objects(self):
+        # Lazily yields the trail files in the time window. LISTING_THREADS threads walk the key layout, listing the
+        # accounts, regions, years, months and days of the bucket in parallel and skipping the dates outside the window.
+        # The files of each day are handed over through a bounded queue, so listing never runs far ahead of downloads
+        listing = Queue()
+        found = Queue(WORK_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put_found(item):
+            while not stopped.is_set():
+                try:
+                    found.put(item, timeout=0.5)
+                    return
+                except Full:
+                    pass
+
+        def walk():
+            while True:
+                task = listing.get()
+                if task is None:
+                    return
+                try:
+                    for item in self.list_task(task):
+                        if isinstance(item, TrailObject):
+                            put_found(item)
+                        elif not stopped.is_set():
+                            listing.put(item)
+                except Exception as e:
+                    print('Failed to list s3://%s/%s: %s' % (self.bucket, task.prefix, e), file=self.out)
+                    self.count('listing failed')
+                    if task.region is not None:
+                        self.region_failed(task.account, task.region)
+                finally:
+                    listing.task_done()
+
+        def finish_listing():
+            listing.join()
+            for _ in walkers:
+                listing.put(None)
+            put_found(None)
+
+        listing.put(ListingTask('logs', self.key_prefix + 'AWSLogs/', None, None, None, ()))
+        walkers = [threading.Thread(target=walk, daemon=True) for _ in range(LISTING_THREADS)]
+        for thread in walkers + [threading.Thread(target=finish_listing, daemon=True)]:
+            thread.start()
+        try:
+            while True:
+                item = found.get()
+                if item is None:
+                    return
+                self.count('listed')
+                yield item
+        finally:
+            stopped.set()
+
+    def region_failed(self, account, region):
+        with self.lock:
+            if (account, region) in self.region_state:
+                self.region_state[(account, region)]['failed'] = True
+
+    def region_reached(self, obj):
+        with self.lock:
+            state = self.region_state.get((obj.account, obj.region))
+            if state is not None and (state['newest'] is None or obj.delivered > state['newest']):
+                state['newest'] = obj.delivered
+
+    def finish(self):
+        # Remember the newest file downloaded from each region for the next incremental run
+        for (account, region), state in self.region_state.items():
+            if state['newest'] is None or state['failed']:
+                continue
+            cursor = {'start': state['start'].isoformat() if state['start'] else None, 'newest_delivery': state['newest'].isoformat()}
+            self.store.commit(REGION_COLLECTOR, self.region_scope(account, region), cursor, 0, done=True)
+
+    def save_object(self, obj):
+        # Returns the number of bytes downloaded: 0 if the file was skipped, None if it failed
+        download_file_path = os.path.join(self.local_path, obj.key)
+
+        # Skip files already downloaded, unless they changed since
+        scope = self.bucket + '/' + obj.key
+        checkpoint = self.store.load(CHECKPOINT_COLLECTOR, scope)
+        if checkpoint and checkpoint.done and checkpoint.cursor.get('etag') == obj.etag and (os.path.exists(download_file_path) or not self.local_copy):
+            self.count('skipped')
+            self.region_reached(obj)
+            return 0
+        if self.local_copy:
+            os.makedirs(os.path.dirname(download_file_path), exist_ok=True)
+
+        wait_start = time.perf_counter()
+        self.limiter.acquire()
+        metrics.observe('for509_rate_limit_wait_seconds', time.perf_counter() - wait_start, api='s3:GetObject')
+        size = 0
+        try:
+            if self.verbose:
+                print('s3://%s/%s' % (self.bucket, obj.key), file=self.out)
+            if not self.local_copy:
+                # Log files are small enough to be held in memory between their download and the sink
+                data = io.BytesIO()
+                self.download(obj, data)
+                size = obj.size
+                self.send_records(data.getvalue())
+                self.sink.flush()
+                self.commit(obj, scope, size, None)
+                return size
+            # Download to a temporary file that only gets the file's name once it is complete. The bytes are hashed on
+            # their way to the file, for the run manifest and to check them against the ETag when it is their MD5
+            etag_md5 = _MD5_ETAG.match(obj.etag)
+            hasher = integrity.hasher(('md5',) if etag_md5 else ())
+            part_file_path = download_file_path + '.part'
+            with open(part_file_path, 'wb') as file:
+                target = integrity.HashingFile(file, hasher) if hasher is not None else file
+                encryption = self.download(obj, target)
+                size = obj.size
+                with metrics.timer('for509_write_seconds', collector='cloudtrail-s3'):
+                    file.flush()
+                    os.fsync(file.fileno())
+            if hasher is not None and (not target.finish() or hasher.size != size):
+                raise IOError('the download left gaps in the file')
+            md5_verified = etag_md5 is not None and encryption not in _KMS_ENCRYPTION
+            if md5_verified and hasher.hexdigests()['md5'] != etag_md5.group(1):
+                metrics.inc('for509_integrity_failures_total', collector='cloudtrail-s3')
+                raise IOError('the bytes downloaded do not match the ETag of the object')
+            os.replace(part_file_path, download_file_path)
+            if hasher is not None:
+                details = {'etag_md5': 'verified'} if md5_verified else {}
+                integrity.record(download_file_path, size, hasher.hexdigests(), collector='cloudtrail-s3', bucket=self.bucket,
+                                 key=obj.key, etag=obj.etag, account=obj.account, region=obj.region, **details)
+            # Only recorded as downloaded once the sink has every record of the file
+            if self.sink is not None:
+                with open(download_file_path, 'rb') as f:
+                    self.send_records(f.read())
+                self.sink.flush()
+        except Exception as e:
+            # A failed file is not recorded, so the next run picks it up again
+            print('Failed to download s3://%s/%s: %s' % (self.bucket, obj.key, e), file=self.out)
+            # Nor is what it left half written: the next run downloads the whole file again
+            if os.path.exists(download_file_path + '.part'):
+                os.remove(download_file_path + '.part')
+            self.count('failed')
+            self.region_failed(obj.account, obj.region)
+            return None
+        finally:
+            self.limiter.release(size)
+        self.commit(obj, scope, size, download_file_path)
+        return size
+
+    def commit(self, obj, scope, size, download_file_path):
+        # Records a file as downloaded, with its local copy if there is one
+        outputs = [OutputFile(download_file_path, size, 1)] if download_file_path is not None else []
+        self.store.commit(CHECKPOINT_COLLECTOR, scope, {'etag': obj.etag, 'size': obj.size}, 1, outputs, done=True)
+        metrics.inc('for509_bytes_in_total', size, collector='cloudtrail-s3')
+        if download_file_path is not None:
+            metrics.inc('for509_bytes_out_total', size, collector='cloudtrail-s3')
+        metrics.inc('for509_files_total', collector='cloudtrail-s3')
+        with self.lock:
+            self.counts['downloaded'] += 1
+            self.counts['bytes'] += size
+        self.region_reached(obj)
+
+    def download(self, obj, file):
+        # Writes the object to file and returns its server side encryption. Objects larger than LARGE_OBJECT_SIZE are
+        # fetched as concurrent ranged GETs. Every request is made with If-Match on the listed ETag, so an object
+        # replaced during the download fails instead of mixing two versions
+        if obj.size <= LARGE_OBJECT_SIZE:
+            return self.get_range(obj, file)
+        lock = threading.Lock()
+        ranges = [(offset, min(offset + RANGE_SIZE, obj.size) - 1) for offset in range(0, obj.size, RANGE_SIZE)]
+        with ThreadPoolExecutor(max_workers=LARGE_OBJECT_CONCURRENCY) as pool:
+            encryptions = list(pool.map(lambda byte_range: self.get_range(obj, file, byte_range, lock), ranges))
+        return encryptions[0]
+
+    def get_range(self, obj, file, byte_range=None, lock=None):
+        get_args = {'Bucket': self.bucket, 'Key': obj.key, 'IfMatch': obj.etag}
+        if byte_range is not None:
+            get_args['Range'] = 'bytes=%d-%d' % byte_range
+        offset = byte_range[0] if byte_range is not None else 0
+        expected = byte_range[1] - byte_range[0] + 1 if byte_range is not None else obj.size
+        with metrics.timer('for509_api_call_seconds', api='s3:GetObject'):
+            response = self.client.get_object(**get_args)
+            body = response['Body']
+            received = 0
+            try:
+                for chunk in body.iter_chunks(CHUNK_SIZE):
+                    if lock is None:
+                        file.write(chunk)
+                    else:
+                        with lock:
+                            file.seek(offset + received)
+                            file.write(chunk)
+                    received += len(chunk)
+            finally:
+                body.close()
+        if received != expected:
+            raise IOError('received %d bytes instead of %d' % (received, expected))
+        return response.get('ServerSideEncryption')
+
+    def send_records(self, data):
+        # Sends the records of a downloaded (gzipped) log file to the sink, with their event IDs
+        records = fastjson.loads(gzip.decompress(data))['Records']
+        self.sink.send([fastjson.dumps(record) for record in records], [record.get('eventID') for record in records])
+
+def main(args):
+    session_params = {
+        'aws_access_key_id': args.access_key_id,
+        'aws_secret_access_key': args.secret_key,
+        'aws_session_token': args.session_token
+    }
+    if not args.access_key_id and not args.secret_key:
+        # Load credentials from the AWS credentials file
+        credentials = boto3.Session(profile_name=args.profile).get_credentials().get_frozen_credentials()
+        session_params['aws_access_key_id'] = credentials.access_key
+        session_params['aws_secret_access_key'] = credentials.secret_key
+        session_params['aws_session_token'] = credentials.token
+    # Organization trails usually live in a log archive account, read through a role there
+    if args.role_arn:
+        session = role_session(session_params, args.role_arn, args.external_id, region_name=args.region)
+    else:
+        session = base_session(session_params, args.region)
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    exporter = metrics.MetricsExporter(args.metrics_file, args.metrics_summary, args.metrics_port).start()
+    # Digests of every file saved are recorded in a signed run manifest
+    run_manifest = None
+    if not args.no_local_copy:
+        run_manifest = integrity.RunManifest(args.output_directory, 'cloudtrail-s3', args.blake3, args.manifest_key_file)
+    store = CheckpointStore(args.checkpoint_db or default_checkpoint_db(args.output_directory))
+    limiter = AdaptiveConcurrency(initial=args.concurrency, maximum=args.max_concurrency)
+    sink = open_sink(args.sink, 'cloudtrail') if args.sink else None
+    out = report_stream(sink)
+    downloader = TrailBucketDownloader(session, args.bucket, args.output_directory, store, limiter, args.prefix,
+                                       parse_time(args.start) if args.start else None, parse_time(args.end) if args.end else None,
+                                       args.accounts, args.regions, not args.full, args.lookback_hours, sink, not args.no_local_copy,
+                                       args.max_concurrency)
+
+    # Listed files go through a bounded queue to the download threads, which share the adaptive limit
+    work = Queue(WORK_QUEUE_SIZE)
+
+    def download_objects():
+        while True:
+            obj = work.get()
+            if obj is None:
+                return
+            downloader.save_object(obj)
+
+    download_threads = [threading.Thread(target=download_objects, daemon=True) for _ in range(args.max_concurrency)]
+    for thread in download_threads:
+        thread.start()
+    for obj in downloader.list_new_objects():
+        work.put(obj)
+    for _ in download_threads:
+        work.put(None)
+    for thread in download_threads:
+        thread.join()
+
+    downloader.finish()
+    counts = downloader.counts
+    print('s3://%s/%s: %d listed, %d downloaded (%.1f MB), %d already downloaded, %d failed, %d prefixes failed to list' % (
+        args.bucket, downloader.key_prefix, counts['listed'], counts['downloaded'], counts['bytes'] / 1024 / 1024,
+        counts['skipped'], counts['failed'], counts['listing failed']), file=out)
+    print('Throttled %d times, finished at %d concurrent downloads' % (limiter.throttles, limiter.limit), file=out)
+    if sink is not None:
+        sink.close()
+    store.close()
+    exporter.close()
+    if run_manifest is not None:
+        print('Run manifest: %s' % run_manifest.close(), file=out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the log files a CloudTrail trail (or organization trail) delivered to an S3 bucket.')
+    parser.add_argument('--bucket', required=True, help='S3 bucket the trail delivers its log files to.')
+    parser.add_argument('--prefix', default='', help='S3 key prefix of the trail, if it has one (the part before AWSLogs/).')
+    parser.add_argument('--output-directory', required=True, help='Directory to save the log files in. They are saved under <bucket>/<key>.')
+    parser.add_argument('--start', default=None, help='Only download files with events from this UTC date or time on (e.g. 2023-01-01 or 2023-01-01T12:00).')
+    parser.add_argument('--end', default=None, help='Only download files with events up to this UTC date or time.')
+    parser.add_argument('--accounts', nargs='+', default=None, help='Only download the logs of these account IDs (default: every account in the bucket).')
+    parser.add_argument('--regions', nargs='+', default=None, help='Only download the logs of these regions (default: every region in the bucket).')
+    parser.add_argument('--full', action='store_true', help='List every day from --start on instead of only the days since the last run (already downloaded files are still skipped).')
+    parser.add_argument('--lookback-hours', default=3, type=int, help='Hours before the newest file downloaded from a region to list again on the next run.')
+    parser.add_argument('--concurrency', default=16, type=int, help='Number of files downloaded at once to start with.')
+    parser.add_argument('--max-concurrency', default=64, type=int, help='Upper bound for the number of files downloaded at once.')
+    parser.add_argument('--access-key-id', default=None, help='The AWS access key ID to use for authentication.')
+    parser.add_argument('--secret-key', default=None, help='The AWS secret access key to use for authentication.')
+    parser.add_argument('--session-token', default=None, help='The AWS session token to use for authentication, if there is one.')
+    parser.add_argument('--profile', default='default', help='The AWS profile name to use from the credentials file.')
+    parser.add_argument('--role-arn', default=None, help='Role to assume to read the bucket, e.g. in the log archive account of an organization.')
+    parser.add_argument('--external-id', default=None, help='External ID to pass when assuming the role, if it requires one.')
+    parser.add_argument('--region', default=None, help='Region of the bucket (requests are redirected to it otherwise, at the cost of an extra round trip).')
+    parser.add_argument('--checkpoint-db', default=None, help='SQLite record of downloaded files (default: checkpoints.sqlite in the output directory).')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+    check_output_arguments(parser, args)
+    main(args)
@@ -1,73 +1,98 @@
 #!/usr/bin/env python3
 # AWS Default Cloudtrail Download script for FOR509
 # This script will dump the last 90 days of CloudTrail logs from the AWS maintained trail
-# For org created trails in buckets you will need to download that bucket
+# For org created trails in buckets you will need to download that bucket, e.g. with Cloudtrail_s3_download.py
 # V2 of this script now iterates through all regions
 # V3 of this script now uses multiprocess to download from all regions at the same time
 # V4 of this script uses curses to provide updates as to the download progress
 # Copyright: David Cowen 2022
 
 from __future__ import print_function
-import boto3, argparse, os, sys, json, time, random, string, gzip, multiprocessing, curses
-from botocore.exceptions import ClientError
+import boto3, argparse, os, sys, json, time, random, string, glob, multiprocessing, curses
+from botocore.config import Config
+from botocore.exceptions import HTTPClientError
 from datetime import datetime, timezone
 from multiprocessing import Process, TimeoutError, parent_process, Pipe
 
-def regionDownload(access_key_id, secret_access_key, session_token, region_name, conn):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from for509.ratelimit import TokenBucket, call_with_backoff
+from for509.writer import RollingRecordsWriter
+from for509 import integrity
+from for509.checkpoint import CheckpointStore, OutputFile, default_checkpoint_db
+from for509.aws import base_session, DiscoveryCache, cached_account_id, cached_regions, probe_regions
 
-    accountid_client = boto3.client(
-        'sts',
-        aws_access_key_id = access_key_id,
-        aws_secret_access_key = secret_access_key,
-        aws_session_token = session_token,
-        region_name = region_name)
+# Resume checkpoints, shared with Cloudtrail_downloadv2.py, in the directory the logs are written to (the current one)
+CHECKPOINT_DB = default_checkpoint_db(os.curdir)
+CHECKPOINT_COLLECTOR = 'cloudtrail-lookup'
+
+# Account ID and region list are cached here for a day (empty regions only for a few minutes)
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'for509', 'aws_discovery.json')
+
+def regionDownload(access_key_id, secret_access_key, session_token, region_name, conn, limiter, account_id):
 
     client = boto3.client(
         'cloudtrail',
         aws_access_key_id = access_key_id,
         aws_secret_access_key = secret_access_key,
         aws_session_token = session_token,
-        region_name = region_name)
+        region_name = region_name,
+        config = Config(retries = {'total_max_attempts': 1}))
 
-    paginator = client.get_paginator('lookup_events')
-
-    StartingToken = None
-    total_logs = 0
     timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
-    account_id = accountid_client.get_caller_identity()["Account"]
-
-    page_iterator = paginator.paginate(
-        LookupAttributes=[],
-        PaginationConfig={ 'PageSize':50, 'StartingToken':StartingToken })
-
-    for page in page_iterator:
-        filename = '%s_CloudTrail_%s_%s_%s.json.gz' % (account_id, region_name, timestamp,total_logs)
-        cloudTraillogs = gzip.open(filename, 'w')
-        data={}
-        data['Records'] = []
 
+    # Resume from the last committed token, if any
+    store = CheckpointStore(CHECKPOINT_DB)
+    scope = '%s:%s' % (account_id, region_name)
+    checkpoint = store.load(CHECKPOINT_COLLECTOR, scope)
+    if checkpoint is not None and checkpoint.done:
+        conn.put([region_name, 'done'])
+        return
+    StartingToken = checkpoint.cursor.get('NextToken') if checkpoint else None
+    total_logs = checkpoint.events if checkpoint else 0
+    recorded_outputs = set(output.path for output in checkpoint.outputs) if checkpoint else set()
+    for part_filename in glob.glob('%s_CloudTrail_%s_*.json.gz.part' % (account_id, region_name)):
+        if part_filename[:-len('.part')] in recorded_outputs:
+            os.replace(part_filename, part_filename[:-len('.part')])
+        else:
+            os.remove(part_filename)
+    state = {'NextToken': StartingToken, 'events': total_logs}
+
+    def page_iterator(next_token):
+        # Throttled calls are retried by call_with_backoff from the same NextToken
+        while True:
+            lookup_args = { 'LookupAttributes':[], 'MaxResults':50 }
+            if next_token:
+                lookup_args['NextToken'] = next_token
+            page = call_with_backoff(limiter, client.lookup_events, retry_on=(HTTPClientError,), **lookup_args)
+            yield page
+            next_token = page.get('NextToken')
+            if not next_token:
+                return
+
+    # One gzip stream per region, rolled every 100k events or 64MB. The token is committed along with each finished file
+    def commit_file(filename, file_events, size):
+        store.commit(CHECKPOINT_COLLECTOR, scope, {'NextToken': state['NextToken']}, state['events'], [OutputFile(filename, size, file_events)])
+        integrity.record(filename, size, writer.digests, collector='cloudtrail', account=account_id, region=region_name, events=file_events)
+
+    writer = RollingRecordsWriter(lambda first_index: '%s_CloudTrail_%s_%s_%s.json.gz' % (account_id, region_name, timestamp, first_index),
+                                  first_index=total_logs, on_close=commit_file, hash_algorithms=integrity.algorithms())
+
+    for page in page_iterator(StartingToken):
         if len(page['Events']) == 0:
             continue
 
+        total_logs = total_logs + len(page['Events'])
+        state['NextToken'] = page.get('NextToken')
+        state['events'] = total_logs
 
+        # CloudTrailEvent is already a JSON string, so it is spliced into the file as is
+        writer.write([event['CloudTrailEvent'] for event in page['Events']])
         
-
-        for event in page['Events']:
-            data['Records'].append(json.loads(event['CloudTrailEvent']))
-
-        cloudTraillogs.write(json.dumps(data).encode('utf-8'))
-        
-        total_logs = total_logs + len(page['Events'])
         #print('\rTotal Logs downloaded: %s' % (total_logs), end='',flush=True)
         conn.put([region_name, total_logs])
-        cloudTraillogs.close()
-        try:
-            token_filename = region_name + 'token'
-            token_file = open(token_filename,'w')
-            token_file.write(page['NextToken'])
-            StartingToken = page['NextToken']
-        except KeyError:
-            continue
+    writer.close()
+    store.commit(CHECKPOINT_COLLECTOR, scope, {'NextToken': None}, total_logs, done=True)
+    store.close()
     conn.put([region_name, 'done'])
     conn.close()
 
@@ -95,25 +120,37 @@ def main(args):
     curses.cbreak()
     
 
-    client = boto3.client(
-        'ec2',
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key,
-        aws_session_token=session_token,
-        region_name = 'us-east-1'
-        )
+    session_params = {
+        'aws_access_key_id': access_key_id,
+        'aws_secret_access_key': secret_access_key,
+        'aws_session_token': session_token
+        }
+    session = base_session(session_params, 'us-east-1')
+    cache = DiscoveryCache(DISCOVERY_CACHE, 24 * 3600)
     total_logs = 0
-    regions = client.describe_regions()
+    account_id = cached_account_id(cache, session_params, session)
+    regions = cached_regions(cache, session, account_id)
+    # Regions without any events are not worth a process. Each probe spends the LookupEvents budget of its region
+    limiters = dict(((account_id, region_name), TokenBucket(rate=2.0)) for region_name in regions)
+    empty_regions = probe_regions(cache, [(account_id, region_name, session) for region_name in regions], limiters)
+    cache.save()
     regionindex = {}
     region_count = 2
     regions_done = 0
 
     n = multiprocessing.Queue()
+    # The SHA-256 of every file the region processes write is recorded in a signed manifest
+    manifest = integrity.RunManifest('.', 'cloudtrail')
 
-    for region in regions['Regions']:
-        region_name = region['RegionName']
+    for region_name in regions:
         regionindex[region_name]=region_count
-        Process(target=regionDownload, args=(access_key_id,secret_access_key, session_token, region_name, n)).start()
+        if (account_id, region_name) in empty_regions:
+            stdscr.addstr(int(regionindex[region_name]), 1, region_name+': done (no events)', curses.A_NORMAL)
+            regions_done = regions_done + 1
+            region_count = region_count + 1
+            continue
+        limiter = limiters[(account_id, region_name)]
+        Process(target=regionDownload, args=(access_key_id,secret_access_key, session_token, region_name, n, limiter, account_id)).start()
         stdscr.addstr(int(regionindex[region_name]), 1, region_name+': 0', curses.A_NORMAL)
         region_count = region_count + 1
 
@@ -125,8 +162,16 @@ def main(args):
         stdscr.addstr(int(regionindex[region_name]), 1, region_name+': '+ str(log_count), curses.A_NORMAL)
         if stdscr.getch() == ord('q'):
             curses.endwin()
+            manifest.close()
             sys.exit()
     curses.endwin()
+    manifest.close()
+    # Every region finished, so the next run starts a fresh download. Only this account's regions are cleared: the
+    # database is shared with Cloudtrail_downloadv2.py, which may hold the checkpoints of other accounts
+    store = CheckpointStore(CHECKPOINT_DB)
+    for region_name in regions:
+        store.clear(CHECKPOINT_COLLECTOR, '%s:%s' % (account_id, region_name))
+    store.close()
     sys.exit()
 
 if __name__ == '__main__':
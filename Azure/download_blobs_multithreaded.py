@@ -7,79 +7,423 @@
 # Requires the Azure python SDK
 # pip3 install azure-storage-blob --user
 
+# Usage:
+#   python3 download_blobs_multithreaded.py --connection-string "DefaultEndpointsProtocol=https;..." --output-directory /home/elk_user/blob
+#   python3 download_blobs_multithreaded.py --accounts-file storage_accounts.txt --containers insights-logs-signinlogs insights-logs-auditlogs
+#
+# Sample connection string
+# DefaultEndpointsProtocol=https;AccountName=pymtechlabslogstorage;AccountKey=og5lhNt9+ZE08/R9OvyliaA2ruX00q1Znavwy5VN<redacted>;EndpointSuffix=core.windows.net
+# To test against the Azurite storage emulator use the connection string "UseDevelopmentStorage=true"
+
+import argparse
 import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
 from multiprocessing.pool import ThreadPool
+from queue import Queue
 from azure.storage.blob import BlobServiceClient, BlobClient
 from azure.storage.blob import ContentSettings, ContainerClient
-from datetime import date
 from os import path
- 
-# IMPORTANT: Replace connection string with your storage account connection string
-# Usually starts with DefaultEndpointsProtocol=https;...
-#
-# Sample connection string
-# MY_CONNECTION_STRING = "DefaultEndpointsProtocol=https;AccountName=pymtechlabslogstorage;AccountKey=og5lhNt9+ZE08/R9OvyliaA2ruX00q1Znavwy5VN<redacted>;EndpointSuffix=core.windows.net"
-MY_CONNECTION_STRING = 
-
-# IMPORTANT: You must specify a blob container
-# Blob containers from the SANS FOR509 class:
-#MY_BLOB_CONTAINER = "insights-logs-networksecuritygroupflowevent"
-#MY_BLOB_CONTAINER = "insights-logs-auditlogs"
-#MY_BLOB_CONTAINER = "insights-logs-managedidentitysigninlogs"
-#MY_BLOB_CONTAINER = "insights-logs-noninteractiveusersigninlogs"
-#MY_BLOB_CONTAINER = "insights-logs-serviceprincipalsigninlogs"
-#MY_BLOB_CONTAINER = "insights-logs-signinlogs"
-#MY_BLOB_CONTAINER = "insights-activity-logs"
-#MY_BLOB_CONTAINER = "insights-logs-storageread"
-MY_BLOB_CONTAINER =
-
-
-today = date.today()
-d1 = today.strftime('%Y%m%d')
-   
-# Replace with the local folder where you want files to be downloaded
-# By default the script will create a directory with the date and the name of the blob container
-LOCAL_BLOB_PATH = path.join('/home/elk_user/blob',d1,MY_BLOB_CONTAINER)
-    
+
+# Make the shared for509 package importable when this script is run from the Azure directory
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), os.pardir))
+from for509.checkpoint import CheckpointStore, OutputFile, default_checkpoint_db
+from for509.azure import list_blobs_since, partition_time
+from for509.ratelimit import AdaptiveConcurrency, THROTTLE_STATUS_CODES
+from for509 import integrity, metrics
+from for509.cli import add_output_arguments, check_output_arguments
+from for509.sinks import RecordStream, open_sink, report_stream
+
+# Blob containers from the SANS FOR509 class, downloaded by default (containers an account does not have are skipped)
+DEFAULT_CONTAINERS = [
+  "insights-logs-networksecuritygroupflowevent",
+  "insights-logs-auditlogs",
+  "insights-logs-managedidentitysigninlogs",
+  "insights-logs-noninteractiveusersigninlogs",
+  "insights-logs-serviceprincipalsigninlogs",
+  "insights-logs-signinlogs",
+  "insights-activity-logs",
+  "insights-logs-storageread",
+]
+
+# Blobs already downloaded (name, etag, last modified time and size) are recorded under this collector, so re-running skips them
+CHECKPOINT_COLLECTOR = 'azure-blob'
+# The newest y=/m=/d=/h= partition downloaded from each container, where the next incremental listing starts
+CONTAINER_COLLECTOR = 'azure-container'
+
+# Listed blobs waiting for a download thread. Listing pauses when this is full, so memory stays flat however many blobs there are
+WORK_QUEUE_SIZE = 1000
+# Containers listed at the same time
+LISTING_THREADS = 4
+
+# Blobs are streamed to disk in chunks of this size, so memory use does not depend on the size of the blobs
+CHUNK_SIZE = 4 * 1024 * 1024
+# Blobs larger than this are downloaded with several ranged requests in parallel
+LARGE_BLOB_SIZE = 64 * 1024 * 1024
+LARGE_BLOB_CONCURRENCY = 4
+# Diagnostic log blobs are appended to during their hour. When one changed since it was downloaded, only the bytes after
+# the recorded size are fetched, along with this many bytes before it to check the part already downloaded is unchanged
+RESUME_OVERLAP = 4096
+
+# Checkpoint database name used by earlier versions, moved to the default one shared with the other scripts
+LEGACY_CHECKPOINT_DB = '.checkpoints.sqlite'
+
 class AzureBlobFileDownloader:
-  def __init__(self):
-    print("Intializing AzureBlobFileDownloader")
-           
+  def __init__(self, connection_string, container, output_directory, store, limiter, incremental=True, lookback_hours=3, sink=None, local_copy=True):
     # Initialize the connection to Azure storage account
-    self.blob_service_client =  BlobServiceClient.from_connection_string(MY_CONNECTION_STRING)
-    self.my_container = self.blob_service_client.get_container_client(MY_BLOB_CONTAINER)
-                        
-                         
-  def download_all_blobs_in_container(self):
-    # get a list of blobs
-    my_blobs = self.my_container.list_blobs()
-    result = self.run(my_blobs)
-    print(result)
-                 
-  def run(self,blobs):
-    # Download 10 files at a time!
-    with ThreadPool(processes=int(10)) as pool:
-      return pool.map(self.save_blob_locally, blobs)
-                                 
+    self.blob_service_client =  BlobServiceClient.from_connection_string(connection_string,
+                                                                         max_single_get_size=CHUNK_SIZE, max_chunk_get_size=CHUNK_SIZE)
+    self.account_name = self.blob_service_client.account_name
+    self.container = container
+    self.my_container = self.blob_service_client.get_container_client(container)
+    # Files are saved under <output directory>/<storage account>/<container>/<blob name>
+    self.local_blob_path = path.join(output_directory, self.account_name, container)
+    self.store = store
+    self.limiter = limiter
+    self.incremental = incremental
+    self.lookback_hours = lookback_hours
+    self.scope_prefix = self.account_name + '/' + container + '/'
+    # Outcome of every listed blob (listed, skipped, downloaded, appended, failed, bytes), instead of a list of every file name
+    self.counts = Counter()
+    self.newest_partition = None
+    # The oldest partition with a blob that failed, and whether the listing failed, which keep finish() from moving
+    # the next incremental listing past blobs that were never downloaded
+    self.oldest_failed_partition = None
+    self.listing_failed = False
+    self.lock = threading.Lock()
+    # Print the name of every blob downloaded
+    self.verbose = True
+    # Records of the downloaded blobs are also streamed to the sink, if there is one, and only there without a local copy
+    self.sink = sink
+    self.local_copy = local_copy
+    # What this prints goes to standard error when standard output carries the records
+    self.out = report_stream(sink)
+
+  def list_new_blobs(self):
+    # Lazily yields the blobs of the container, page by page. Incremental listing starts a few hours before the newest partition of the last run
+    checkpoint = self.store.load(CONTAINER_COLLECTOR, self.account_name + '/' + self.container)
+    since = None
+    if self.incremental and checkpoint is not None:
+      self.newest_partition = datetime.fromisoformat(checkpoint.cursor['newest_partition'])
+      since = self.newest_partition - timedelta(hours=self.lookback_hours)
+    try:
+      for blob in list_blobs_since(self.my_container, since):
+        self.count('listed')
+        yield blob
+    except BaseException:
+      self.listing_failed = True
+      raise
+
+  def count(self, outcome, amount=1):
+    with self.lock:
+      self.counts[outcome] += amount
+
+  def failed(self, blob):
+    # Blobs outside the date partitions are listed by every run, so only a failed partitioned blob holds the checkpoint back
+    blob_partition = partition_time(blob.name)
+    with self.lock:
+      self.counts['failed'] += 1
+      if blob_partition is not None and (self.oldest_failed_partition is None or blob_partition < self.oldest_failed_partition):
+        self.oldest_failed_partition = blob_partition
+
+  def finish(self):
+    # Remember the newest partition downloaded for the next incremental run, but no later than the oldest partition
+    # with a failed blob, so the next listing includes it again. After a failed listing, the blobs never listed could
+    # be anywhere, so the checkpoint of the last run is kept as it is
+    if self.listing_failed or self.newest_partition is None:
+      return
+    newest_partition = self.newest_partition
+    if self.oldest_failed_partition is not None:
+      newest_partition = min(newest_partition, self.oldest_failed_partition)
+    self.store.commit(CONTAINER_COLLECTOR, self.account_name + '/' + self.container,
+                      {'newest_partition': newest_partition.isoformat()}, self.counts['downloaded'], done=True)
+
   def save_blob_locally(self,blob):
+    # Returns the number of bytes downloaded: 0 if the blob was skipped, None if it failed
     file_name = blob.name
-    print(file_name)
-    bytes = self.my_container.get_blob_client(blob).download_blob().readall()
-                                                
     # Get full path to the file
-    download_file_path = os.path.join(LOCAL_BLOB_PATH, file_name)
+    download_file_path = os.path.join(self.local_blob_path, file_name)
+
+    # Skip blobs already downloaded, unless they changed since
+    scope = self.scope_prefix + file_name
+    checkpoint = self.store.load(CHECKPOINT_COLLECTOR, scope)
+    if checkpoint and checkpoint.done and checkpoint.cursor.get('etag') == blob.etag and (path.exists(download_file_path) or not self.local_copy):
+      self.count('skipped')
+      return 0
+    # A blob that grew since it was downloaded is appended to the local copy, if that is still the size recorded
+    resume_offset = 0
+    if checkpoint and checkpoint.done and checkpoint.outputs and path.exists(download_file_path):
+      recorded_size = checkpoint.outputs[-1].offset
+      if 0 < recorded_size < (blob.size or 0) and path.getsize(download_file_path) == recorded_size:
+        resume_offset = recorded_size
+    elif checkpoint and checkpoint.done and not self.local_copy:
+      # Without a local copy to compare with, only the growth of an NDJSON blob is sent (checked once it is opened)
+      if 0 < (checkpoint.cursor.get('size') or 0) < (blob.size or 0):
+        resume_offset = checkpoint.cursor['size']
+
     # for nested blobs, create local path as well!
-    os.makedirs(os.path.dirname(download_file_path), exist_ok=True)
-                                    
-    with open(download_file_path, "wb") as file:
-      file.write(bytes)
-    # To delete the blob once downloaded:
-    #  - useful if you want to download logs with a cron job (so you don't re-download every blob in the storage account each time)
-    #  - make sure it's the same indent as the "with" line
+    if self.local_copy:
+      os.makedirs(os.path.dirname(download_file_path), exist_ok=True)
+
+    # 503 ServerBusy responses are retried by the SDK, but each one also lowers the number of concurrent downloads
+    def count_throttling(response):
+      if response.http_response.status_code in THROTTLE_STATUS_CODES:
+        self.limiter.on_throttle()
+        metrics.inc('for509_api_throttles_total', api='azure:GetBlob')
+        metrics.inc('for509_api_retries_total', api='azure:GetBlob')
+
+    wait_start = time.perf_counter()
+    self.limiter.acquire()
+    metrics.observe('for509_rate_limit_wait_seconds', time.perf_counter() - wait_start, api='azure:GetBlob')
+    size = 0
+    try:
+      if self.verbose:
+        print(self.account_name + '/' + self.container + '/' + file_name, file=self.out)
+      blob_client = self.my_container.get_blob_client(blob)
+      # Large blobs are fetched as parallel ranged downloads; either way chunks are written straight to the file
+      max_concurrency = LARGE_BLOB_CONCURRENCY if (blob.size or 0) > LARGE_BLOB_SIZE else 1
+      appended = None
+      if resume_offset and self.local_copy:
+        hasher = integrity.hasher()
+        appended = self.append_growth(blob_client, download_file_path, resume_offset, count_throttling, scope, hasher)
+        if appended is not None and hasher is not None:
+          integrity.record(download_file_path, appended, hasher.hexdigests(), offset=resume_offset, collector='azure-blob', blob=scope, etag=blob.etag)
+      if appended is not None:
+        size = appended
+        self.count('appended')
+      elif not self.local_copy:
+        if resume_offset and not self.line_ends_at(blob_client, resume_offset, count_throttling):
+          # Not NDJSON appended to, e.g. a {"records":[...]} object rewritten as it grows: the whole blob is sent
+          # again, and its records keep their IDs, so the sink replaces the copies it already has
+          resume_offset = 0
+        with metrics.timer('for509_api_call_seconds', api='azure:GetBlob'):
+          downloader = blob_client.download_blob(offset=resume_offset or None, max_concurrency=max_concurrency, raw_response_hook=count_throttling)
+          size = self.stream_chunks(downloader, scope, resume_offset)
+        if resume_offset:
+          self.count('appended')
+      else:
+        # Download to a temporary file that only gets the blob's name once it is complete. The bytes are hashed on
+        # their way to the file, for the run manifest and to check them against the MD5 the blob was stored with
+        content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+        hasher = integrity.hasher(('md5',) if content_md5 else ())
+        part_file_path = download_file_path + '.part'
+        with open(part_file_path, "wb") as file:
+          target = integrity.HashingFile(file, hasher) if hasher is not None else file
+          with metrics.timer('for509_api_call_seconds', api='azure:GetBlob'):
+            downloader = blob_client.download_blob(max_concurrency=max_concurrency, raw_response_hook=count_throttling)
+            if self.sink is None:
+              size = downloader.readinto(target)
+            else:
+              size = self.stream_chunks(downloader, scope, 0, target)
+          with metrics.timer('for509_write_seconds', collector='azure-blob'):
+            file.flush()
+            os.fsync(file.fileno())
+        if hasher is not None and (not target.finish() or hasher.size != size):
+          raise IOError('the download left gaps in the file')
+        if content_md5 and hasher.digest('md5') != bytes(content_md5):
+          metrics.inc('for509_integrity_failures_total', collector='azure-blob')
+          raise IOError('the bytes downloaded do not match the Content-MD5 of the blob')
+        os.replace(part_file_path, download_file_path)
+        if hasher is not None:
+          details = {'content_md5': 'verified'} if content_md5 else {}
+          integrity.record(download_file_path, size, hasher.hexdigests(), collector='azure-blob', blob=scope, etag=blob.etag, **details)
+      # Only recorded as downloaded once the sink has every record of the blob
+      if self.sink is not None:
+        self.sink.flush()
+    except Exception as e:
+      # A failed blob is not recorded in the manifest, and holds back the container checkpoint, so the next run picks it up again
+      print('Failed to download %s: %s' % (file_name, e), file=self.out)
+      # Nor is what it left half written: the next run downloads the whole blob again
+      if path.exists(download_file_path + '.part'):
+        os.remove(download_file_path + '.part')
+      self.failed(blob)
+      return None
+    finally:
+      self.limiter.release(size)
+
+    manifest_entry = {'etag': blob.etag, 'last_modified': blob.last_modified.isoformat() if blob.last_modified else None, 'size': blob.size}
+    outputs = [OutputFile(download_file_path, path.getsize(download_file_path), 1)] if self.local_copy else []
+    self.store.commit(CHECKPOINT_COLLECTOR, scope, manifest_entry, 1, outputs, done=True)
+    blob_partition = partition_time(file_name)
+    metrics.inc('for509_bytes_in_total', size, collector='azure-blob')
+    if self.local_copy:
+      metrics.inc('for509_bytes_out_total', size, collector='azure-blob')
+    metrics.inc('for509_files_total', collector='azure-blob')
+    with self.lock:
+      self.counts['downloaded'] += 1
+      self.counts['bytes'] += size
+      if blob_partition is not None and (self.newest_partition is None or blob_partition > self.newest_partition):
+        self.newest_partition = blob_partition
+    # Blobs are never deleted: the manifest is what keeps old blobs from being downloaded again.
+    # To delete the blob once downloaded (only for copies you can afford to lose):
+    #  - make sure it's the same indent as the "manifest_entry" line
     #  - uncomment the next line
     #self.my_container.get_blob_client(blob).delete_blob()
-    return file_name
+    return size
+
+  def line_ends_at(self, blob_client, offset, count_throttling):
+    # Whether the byte before offset is a newline, i.e. the blob can be read on from offset as whole NDJSON lines
+    with metrics.timer('for509_api_call_seconds', api='azure:GetBlob'):
+      return blob_client.download_blob(offset=offset - 1, length=1, raw_response_hook=count_throttling).readall() == b'\n'
+
+  def stream_chunks(self, downloader, scope, offset, file=None):
+    # Sends the records of a download starting at offset to the sink as its chunks arrive, also writing them to file
+    # if there is one, and returns the number of bytes downloaded
+    records = RecordStream(self.sink, scope, offset)
+    size = 0
+    for chunk in downloader.chunks():
+      if file is not None:
+        file.write(chunk)
+      records.feed(chunk)
+      size += len(chunk)
+    records.close()
+    return size
+
+  def append_growth(self, blob_client, download_file_path, offset, count_throttling, scope, hasher=None):
+    # Appends the bytes of the blob after offset to the local copy and returns how many there were, or returns None
+    # (leaving the copy as it was) if the last bytes downloaded before no longer match, i.e. the blob was rewritten.
+    # The appended bytes are added to hasher, if there is one
+    overlap = min(offset, RESUME_OVERLAP)
+    records = RecordStream(self.sink, scope, offset) if self.sink is not None else None
+    with open(download_file_path, 'r+b') as file:
+      file.seek(offset - overlap)
+      expected = file.read(overlap)
+      received = b''
+      appended = 0
+      try:
+        with metrics.timer('for509_api_call_seconds', api='azure:GetBlob'):
+          downloader = blob_client.download_blob(offset=offset - overlap, raw_response_hook=count_throttling)
+          for chunk in downloader.chunks():
+            if len(received) < overlap:
+              needed = overlap - len(received)
+              received += chunk[:needed]
+              chunk = chunk[needed:]
+              if received != expected[:len(received)]:
+                return None
+            if chunk:
+              file.write(chunk)
+              appended += len(chunk)
+              if hasher is not None:
+                hasher.update(chunk)
+              if records is not None:
+                records.feed(chunk)
+        if received != expected:
+          file.truncate(offset)
+          return None
+        with metrics.timer('for509_write_seconds', collector='azure-blob'):
+          file.flush()
+          os.fsync(file.fileno())
+      except BaseException:
+        file.truncate(offset)
+        raise
+    if records is not None:
+      records.close()
+    return appended
+
+def read_connection_strings(filename):
+  # One connection string per line. Blank lines and lines starting with # are ignored
+  with open(filename, 'r') as f:
+    return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def main(args):
+  connection_strings = list(args.connection_string or [])
+  if args.accounts_file:
+    connection_strings.extend(read_connection_strings(args.accounts_file))
+  if not connection_strings and os.environ.get('AZURE_STORAGE_CONNECTION_STRING'):
+    connection_strings.append(os.environ['AZURE_STORAGE_CONNECTION_STRING'])
+  if not connection_strings:
+    sys.exit('No storage account given: use --connection-string, --accounts-file or AZURE_STORAGE_CONNECTION_STRING')
+
+  os.makedirs(args.output_directory, exist_ok=True)
+  exporter = metrics.MetricsExporter(args.metrics_file, args.metrics_summary, args.metrics_port).start()
+  # Digests of every file saved are recorded in a signed run manifest
+  run_manifest = None
+  if not args.no_local_copy:
+    run_manifest = integrity.RunManifest(args.output_directory, 'azure-blob', args.blake3, args.manifest_key_file)
+  checkpoint_db = args.checkpoint_db
+  if not checkpoint_db:
+    checkpoint_db = default_checkpoint_db(args.output_directory)
+    legacy_checkpoint_db = path.join(args.output_directory, LEGACY_CHECKPOINT_DB)
+    if path.exists(legacy_checkpoint_db) and not path.exists(checkpoint_db):
+      for suffix in ('-wal', '-shm', ''):
+        if path.exists(legacy_checkpoint_db + suffix):
+          os.replace(legacy_checkpoint_db + suffix, checkpoint_db + suffix)
+  store = CheckpointStore(checkpoint_db)
+
+  # Every account and container shares one pool; the limiter decides how many of its threads download at once
+  limiter = AdaptiveConcurrency(initial=args.concurrency, maximum=args.max_concurrency)
+  # One sink, and so one set of connections, for every container
+  sink = open_sink(args.sink, 'azure') if args.sink else None
+  out = report_stream(sink)
+  downloaders = []
+  for connection_string in connection_strings:
+    for container in args.containers:
+      downloader = AzureBlobFileDownloader(connection_string, container, args.output_directory, store, limiter,
+                                           not args.full, args.lookback_hours, sink, not args.no_local_copy)
+      if not downloader.my_container.exists():
+        continue
+      print("Downloading %s/%s" % (downloader.account_name, container), file=out)
+      downloaders.append(downloader)
+
+  # Listing threads feed pages of blobs into a bounded queue that the download threads drain, so downloads start
+  # with the first page of the first container and listing never runs far ahead of them
+  work = Queue(WORK_QUEUE_SIZE)
+
+  def list_container(downloader):
+    try:
+      for blob in downloader.list_new_blobs():
+        work.put((downloader, blob))
+    except Exception as e:
+      print('Failed to list %s/%s: %s' % (downloader.account_name, downloader.container, e), file=out)
+      downloader.count('listing failed')
+
+  def download_blobs():
+    while True:
+      item = work.get()
+      if item is None:
+        return
+      downloader, blob = item
+      downloader.save_blob_locally(blob)
+
+  download_threads = [threading.Thread(target=download_blobs, daemon=True) for _ in range(args.max_concurrency)]
+  for thread in download_threads:
+    thread.start()
+  with ThreadPool(processes=LISTING_THREADS) as pool:
+    pool.map(list_container, downloaders)
+  for _ in download_threads:
+    work.put(None)
+  for thread in download_threads:
+    thread.join()
+
+  for downloader in downloaders:
+    downloader.finish()
+    counts = downloader.counts
+    print('%s/%s: %d listed, %d downloaded (%.1f MB, %d of them only appended to), %d already downloaded, %d failed' % (
+      downloader.account_name, downloader.container, counts['listed'], counts['downloaded'], counts['bytes'] / 1024 / 1024,
+      counts['appended'], counts['skipped'], counts['failed']), file=out)
+  print('Throttled %d times, finished at %d concurrent downloads' % (limiter.throttles, limiter.limit), file=out)
+  if sink is not None:
+    sink.close()
+  store.close()
+  exporter.close()
+  if run_manifest is not None:
+    print('Run manifest: %s' % run_manifest.close(), file=out)
 
-# Initialize class and upload files
-azure_blob_file_downloader = AzureBlobFileDownloader()
-azure_blob_file_downloader.download_all_blobs_in_container()
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Download the diagnostic log blobs of one or more Azure storage accounts.')
+  parser.add_argument('--connection-string', action='append', help='Storage account connection string. Can be given several times.')
+  parser.add_argument('--accounts-file', default=None, help='File with one storage account connection string per line.')
+  parser.add_argument('--containers', nargs='+', default=DEFAULT_CONTAINERS, help='Blob containers to download (default: the insights-logs-* containers used in FOR509).')
+  parser.add_argument('--output-directory', default='/home/elk_user/blob', help='Local folder to download to. Blobs are saved under <account>/<container>/.')
+  parser.add_argument('--checkpoint-db', default=None, help='SQLite manifest of downloaded blobs (default: checkpoints.sqlite in the output directory).')
+  parser.add_argument('--full', action='store_true', help='List every blob instead of only the date partitions since the last run (already downloaded blobs are still skipped).')
+  parser.add_argument('--lookback-hours', default=3, type=int, help='Hours before the newest downloaded partition to list again, for blobs still being appended to.')
+  parser.add_argument('--concurrency', default=10, type=int, help='Number of blobs downloaded at once to start with.')
+  parser.add_argument('--max-concurrency', default=64, type=int, help='Upper bound for the number of blobs downloaded at once.')
+  add_output_arguments(parser)
+  args = parser.parse_args()
+  check_output_arguments(parser, args)
+  main(args)
@@ -5,10 +5,31 @@ import requests
 import os
 import argparse
 import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 from dateutil import parser as dateparser, tz
 
+# Make the shared for509 package importable when this script is run from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from for509.checkpoint import CheckpointStore, OutputFile, default_checkpoint_db, truncate_to_checkpoint
+from for509.dedup import SeenSet
+from for509.writer import NdjsonWriter, ReversingSpool, open_lines, COMPRESSION_EXTENSIONS
+from for509.ratelimit import TokenBucket, call_with_backoff, is_server_error
+from for509.sinks import open_sink
+from for509 import integrity, metrics
+from for509.cli import add_output_arguments, check_output_arguments
+
+
+class ListingError(Exception):
+    """
+    Raised from the API error when listing part of an application's activities failed for good
+    """
+
 
 class Google(object):
     """
@@ -18,6 +39,28 @@ class Google(object):
     # These applications will be collected by default
     DEFAULT_APPLICATIONS = ['login', 'drive', 'admin', 'user_accounts', 'chat', 'calendar', 'token']
 
+    # Checkpoints of this script are stored under this collector name, one scope per application
+    CHECKPOINT_COLLECTOR = 'gws'
+
+    # High volume applications are split into this many startTime/endTime shards that are listed in parallel
+    SHARDED_APPLICATIONS = ['drive', 'token']
+    DEFAULT_SHARDS = 8
+    # Times a shard (or an unsharded application) is listed from its start before the application is given up on
+    SHARD_ATTEMPTS = 3
+
+    # Most Reports API activity data is kept for 6 months, so sharding starts there when no start date is given
+    LOG_RETENTION = timedelta(days=180)
+
+    # Largest page size activities.list accepts
+    PAGE_SIZE = 1000
+
+    # Requests per second and requests in flight for the whole run, whatever the number of applications and shards
+    DEFAULT_REQUEST_RATE = 25.0
+    DEFAULT_MAX_REQUESTS = 10
+
+    # Keys of the records already in each application's log file are kept under <output path>/SEEN_DIRECTORY/<app>
+    SEEN_DIRECTORY = '.seen'
+
     def __init__(self, **kwargs):
         self.SERVICE_ACCOUNT_FILE = kwargs['creds_path']
         self.delegated_creds = kwargs['delegated_creds']
@@ -25,13 +68,47 @@ class Google(object):
         self.app_list = kwargs['apps']
         self.update = kwargs['update']
         self.overwrite = kwargs['overwrite']
+        self.max_workers = kwargs.get('max_workers') or 8
+        self.shards = kwargs.get('shards') or self.DEFAULT_SHARDS
+        # Every activities.list call shares one request budget, so that applications and shards listed in parallel do
+        # not multiply the load on the API; throttled and failed (5xx) calls are retried with backoff against it
+        max_requests = kwargs.get('max_requests') or self.DEFAULT_MAX_REQUESTS
+        self.limiter = TokenBucket(rate=kwargs.get('request_rate') or self.DEFAULT_REQUEST_RATE, burst=max_requests)
+        self._requests = threading.BoundedSemaphore(max_requests)
+        self.compression = kwargs.get('compression')
+        self.dedup = kwargs.get('dedup', True)
+        # Records are also streamed to the sink, if there is one, and only there without a local copy
+        self.local_copy = kwargs.get('local_copy', True)
+        if not self.local_copy and not kwargs.get('sink'):
+            raise ValueError('No sink given: set sink or keep local_copy')
+        self.sink = open_sink(kwargs['sink'], 'gws') if kwargs.get('sink') else None
 
         # Create output path if required
         if not os.path.exists(self.output_path):
             os.makedirs(self.output_path)
 
-        # Connect to Google API
-        self.service = self.google_session()
+        # Records how far each application's log file has been safely written
+        self.checkpoints = CheckpointStore(kwargs.get('checkpoint_db') or default_checkpoint_db(self.output_path))
+
+        # googleapiclient service objects are not thread-safe, so each worker thread connects with its own
+        self._local = threading.local()
+
+        # Applications that could not be collected completely, for the exit code
+        self.failed_apps = []
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+        self.checkpoints.close()
+
+    @property
+    def service(self):
+        """
+        Google API service object of the calling thread, connected on first use.
+        """
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.google_session()
+        return self._local.service
 
     @staticmethod
     def get_application_list():
@@ -43,21 +120,54 @@ class Google(object):
         return r.json()['resources']['activities']['methods']['list']['parameters']['applicationName']['enum']
 
     @staticmethod
-    def _check_recent_date(log_file_path):
-        """
-        Opens an existing log file to find the datetime of the most recent record
-        """
-        return_date = None        
-        if os.path.exists(log_file_path):
-            with open(log_file_path, 'r') as f:
-                for line in f.readlines():
-                    json_obj = json.loads(line)
-                    line_datetime = dateparser.parse(json_obj['id']['time'])
-                    if not return_date:
-                        return_date = line_datetime
-                    elif return_date < line_datetime:
-                        return_date = line_datetime
-        return return_date
+    def _read_last_line(log_file_path, block_size=65536):
+        """
+        Returns the last complete line of a file, reading backwards from the end in blocks
+        """
+        with open(log_file_path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            data = b''
+            position = end
+            while position > 0:
+                position = max(0, position - block_size)
+                f.seek(position)
+                data = f.read(end - position)
+                lines = data.rstrip(b'\n').split(b'\n')
+                if len(lines) > 1 or position == 0:
+                    return lines[-1].decode('utf-8')
+        return ''
+
+    @staticmethod
+    def _parse_time(value):
+        """
+        Parses the RFC 3339 timestamps of the Reports API (fromisoformat only accepts the Z suffix from Python 3.11)
+        """
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+    def _check_recent_date(self, app, log_file_path):
+        """
+        Returns the datetime of the most recent record already saved for the application: the time recorded with its
+        checkpoint, or else the time of the last line of the log file (records are written in time order)
+        """
+        # Without a local copy the checkpoint is all there is
+        if self.local_copy and not os.path.exists(log_file_path):
+            return None
+        checkpoint = self.checkpoints.load(self.CHECKPOINT_COLLECTOR, app)
+        if checkpoint and checkpoint.cursor and checkpoint.cursor.get('time'):
+            return self._parse_time(checkpoint.cursor['time'])
+        if not os.path.exists(log_file_path):
+            return None
+        if self.compression:
+            # A compressed file cannot be read from the end, so it is decompressed once to find its last line
+            last_line = ''
+            with open_lines(log_file_path, self.compression) as f:
+                for last_line in f:
+                    pass
+        else:
+            last_line = self._read_last_line(log_file_path)
+        if not last_line.strip():
+            return None
+        return self._parse_time(json.loads(last_line)['id']['time'])
 
     def google_session(self):
         """
@@ -73,69 +183,305 @@ class Google(object):
     
     def get_logs(self, from_date=None):
         """ 
-        Collect all logs from specified applications
+        Collect all logs from specified applications, up to max_workers applications at a time
         """
 
         total_saved, total_found = 0, 0
 
-        for app in self.app_list:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for app, saved, found in executor.map(lambda app: self.get_app_logs(app, from_date), self.app_list):
+                total_saved += saved
+                total_found += found
+
+        logging.info(f"TOTAL: Saved {total_saved} of {total_found} records.")
+        if self.failed_apps:
+            logging.error(f"Could not collect all logs of: {', '.join(sorted(self.failed_apps))}")
+
+    def output_file(self, app):
+        """
+        Path of the log file of an application
+        """
+        return f"{self.output_path}/{app}_logs.json{COMPRESSION_EXTENSIONS[self.compression]}"
+
+    def get_app_logs(self, app, from_date=None):
+        """
+        Collect the logs of a single application. Returns (app, saved, found)
+        """
 
-            # Define output file name
-            output_file = f"{self.output_path}/{app}_logs.json"
+        # Define output file name
+        output_file = self.output_file(app)
 
-            # Get most recent log entry date (if required)
-            if self.update:
-                from_date = self._check_recent_date(output_file) or from_date
+        # Get most recent log entry date (if required)
+        if self.update:
+            from_date = self._check_recent_date(app, output_file) or from_date
 
-            # Collect logs for specified app
-            logging.info(f"Collecting logs for {app}...")
-            if from_date:
-                logging.debug(f"Only extracting records after {from_date}")
+        # Collect logs for specified app
+        logging.info(f"Collecting logs for {app}...")
+        if from_date:
+            logging.debug(f"Only extracting records after {from_date}")
 
+        try:
             saved, found = self._get_activity_logs(
                 app, 
                 output_file=output_file, 
                 overwrite=self.overwrite, 
                 only_after_datetime=from_date
             )
-            logging.info(f"Saved {saved} of {found} entries for {app}")
-            total_saved += saved
-            total_found += found
+        except Exception as e:
+            # The other applications carry on; this one is picked up from its checkpoint by the next --update run
+            logging.error(f"Error collecting logs for {app}: {e}")
+            self.failed_apps.append(app)
+            return app, 0, 0
+        logging.info(f"Saved {saved} of {found} entries for {app}")
+        return app, saved, found
 
-        logging.info(f"TOTAL: Saved {total_saved} of {total_found} records.")
+    @staticmethod
+    def _rfc3339(value):
+        return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}Z'
 
-    def _get_activity_logs(self, application_name, output_file, overwrite=False, only_after_datetime=None):
-        """ Collect activitiy logs from the specified application """
+    def _list_activities(self, application_name, start_time=None, end_time=None):
+        """
+        Yields the pages of activities of the application between start_time and end_time (newest first), following
+        nextPageToken to the last page.
+        """
+        list_args = {'userKey': 'all', 'applicationName': application_name, 'maxResults': self.PAGE_SIZE}
+        if start_time:
+            list_args['startTime'] = self._rfc3339(start_time)
+        if end_time:
+            list_args['endTime'] = self._rfc3339(end_time)
+
+        while True:
+            request = self.service.activities().list(**list_args)
+            results = call_with_backoff(self.limiter, self._execute, request, retry_if=is_server_error, metric='gws:activities.list')
+            yield results.get('items', [])
+            if not results.get('nextPageToken'):
+                return
+            list_args['pageToken'] = results['nextPageToken']
+
+    def _execute(self, request):
+        """
+        Sends a request, holding one of the max_requests slots only while it is in flight (not while backing off)
+        """
+        with self._requests:
+            return request.execute()
 
-        # Call the Admin SDK Reports API
+    def _spool_shard(self, application_name, start_time, end_time, only_after, is_first, is_last):
+        """
+        Lists one time shard into a ReversingSpool, encoding each record as it arrives, prefixed with its seen key and
+        a tab. Records in the first second of the shard are kept apart (they may also have been returned by the
+        previous shard), and the keys of the records in its last second are noted, so that merge_shards can drop the
+        duplicates between neighbouring shards.
+        """
+        shard = {'spool': ReversingSpool(self.output_path), 'head': [], 'tail_keys': set(), 'found': 0, 'pages': 0, 'newest': None, 'duplicates': 0}
+        first_second = None if is_first else self._rfc3339(start_time)[:19]
+        last_second = None if is_last else self._rfc3339(end_time)[:19]
         try:
-            results = self.service.activities().list(
-                userKey='all', applicationName=application_name).execute()
-        except TypeError as e:
-            logging.error(f"Error collecting logs for {application_name}: {e}")
-            return False, False
+            for page in self._list_activities(application_name, start_time, end_time):
+                shard['pages'] += 1
+                shard['found'] += len(page)
+                lines = []
+                serialize_start = time.perf_counter()
+                for entry in page:
+                    entry_time = entry['id']['time']
+                    if shard['newest'] is None:
+                        shard['newest'] = entry_time
+                    if only_after and entry_time <= only_after:
+                        continue  # Skip this record
+                    line = json.dumps(entry) + '\n'
+                    key = (entry_time, entry['id'].get('uniqueQualifier'))
+                    if last_second and entry_time.startswith(last_second):
+                        shard['tail_keys'].add(key)
+                    if first_second and entry_time.startswith(first_second):
+                        shard['head'].append((key, line))
+                    else:
+                        lines.append(self._seen_key(key) + '\t' + line)
+                metrics.observe('for509_serialize_seconds', time.perf_counter() - serialize_start, collector='gws')
+                shard['spool'].add(lines)
+        except BaseException:
+            shard['spool'].close()
+            raise
+        logging.debug(f"{application_name} {start_time or ''} - {end_time or ''}: {shard['found']} entries in {shard['pages']} pages")
+        return shard
+
+    def _spool_shard_with_retries(self, application_name, start_time, end_time, *args):
+        """
+        _spool_shard, listing the shard again from its start into a new spool if it fails. Throttled and 5xx pages are
+        already retried by _list_activities; this covers the rest, e.g. dropped connections. Client errors (4xx)
+        are not retried.
+        """
+        for attempt in range(1, self.SHARD_ATTEMPTS + 1):
+            try:
+                return self._spool_shard(application_name, start_time, end_time, *args)
+            except Exception as e:
+                status = getattr(e, 'status_code', None)
+                if attempt == self.SHARD_ATTEMPTS or (isinstance(status, int) and status < 500):
+                    raise
+                logging.warning(f"Listing {application_name} {start_time or ''} - {end_time or ''} failed ({e}), listing it again")
+                metrics.inc('for509_api_retries_total', api='gws:shard')
+
+    def _fetch_activities(self, application_name, only_after_datetime=None):
+        """
+        Lists all activities of the application since only_after_datetime (filtered by the API) into spooled shards,
+        and yields them oldest first, each as soon as it and the shards before it are listed, so older shards are
+        written while newer ones are still being listed. Applications in SHARDED_APPLICATIONS are listed as parallel
+        time shards; the others as a single one. A shard only comes out in time order once all of it is listed (the
+        API pages newest first), so the newest records are only ever written last.
+
+        If a shard fails, ListingError is raised after the shards before it, and the newer shards are dropped, so
+        everything written is complete up to where the checkpoint moves to.
+        """
+        only_after = self._rfc3339(only_after_datetime) if only_after_datetime else None
+        if application_name not in self.SHARDED_APPLICATIONS or self.shards < 2:
+            try:
+                shard = self._spool_shard_with_retries(application_name, only_after_datetime, None, only_after, True, True)
+            except Exception as e:
+                raise ListingError(application_name) from e
+            yield shard
+            return
+
+        end_time = datetime.now(timezone.utc)
+        start_time = only_after_datetime or end_time - self.LOG_RETENTION
+        step = (end_time - start_time) / self.shards
+        bounds = [start_time + step * i for i in range(self.shards)] + [end_time]
+
+        executor = ThreadPoolExecutor(max_workers=self.shards)
+        futures = [executor.submit(self._spool_shard_with_retries, application_name, bounds[i], bounds[i + 1], only_after,
+                                   i == 0, i == self.shards - 1) for i in range(self.shards)]
+        handed_over = 0
+        try:
+            for future in futures:
+                try:
+                    shard = future.result()
+                except Exception as e:
+                    raise ListingError(application_name) from e
+                handed_over += 1
+                yield shard
+        finally:
+            # After a failure (or when the caller stops early) wait for the shards still being listed and drop them
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for future in futures[handed_over:]:
+                if not future.cancelled() and future.exception() is None:
+                    future.result()['spool'].close()
 
-        activities = results.get('items', [])
-        output_count = 0
-        if activities:
-            with open(output_file, 'w' if overwrite else 'a') as output:
+    @staticmethod
+    def _seen_key(key):
+        # uniqueQualifier is only unique together with the time
+        return f'{key[0]}:{key[1]}'
 
-                # Loop through activities in reverse order (so latest events are at the end)
-                for entry in activities[::-1]:
-                    # TODO: See if we can speed this up to prevent looping through all activities
+    def _shard_lines(self, shard, previous_keys, seen=None):
+        """
+        Yields batches of lines of a shard in time order. Shard bounds are inclusive, so the records in its first
+        second that the previous shard (whose tail_keys are previous_keys) already returned are dropped. Records whose
+        key is in seen (already in the log file) are dropped too; keys are only added to seen here, for the records
+        actually written, so a shard that was listed again or not written at all leaves no keys behind.
+        """
+        head = [(self._seen_key(key), line) for key, line in reversed(shard['head']) if key not in previous_keys]
+        yield self._unseen(head, shard, seen)
+        for batch in shard['spool'].replay():
+            yield self._unseen((item.split('\t', 1) for item in batch), shard, seen)
 
-                    # If we're only exporting new records, check the datetime of the record
-                    if only_after_datetime:
-                        entry_datetime = dateparser.parse(entry['id']['time'])
-                        if (entry_datetime <= only_after_datetime):
-                            continue  # Skip this record
+    @staticmethod
+    def _unseen(items, shard, seen=None):
+        """
+        Lines of the (seen key, line) items whose key is not in seen yet, adding their keys to it
+        """
+        lines = []
+        for key, line in items:
+            if seen is None or seen.add(key):
+                lines.append(line)
+            else:
+                shard['duplicates'] += 1
+        return lines
 
-                    # Output this record
-                    json_formatted_str = json.dumps(entry)
-                    output.write(f"{json_formatted_str}\n")
-                    output_count += 1
+    def _get_activity_logs(self, application_name, output_file, overwrite=False, only_after_datetime=None):
+        """ Collect activitiy logs from the specified application """
 
-        return output_count, len(activities)
+        # Keys of the records already in the log file, so that records listed again are not appended a second time
+        seen = None
+        if self.dedup:
+            seen = SeenSet(os.path.join(self.output_path, self.SEEN_DIRECTORY, application_name))
+            if overwrite or (self.local_copy and not os.path.exists(output_file)):
+                seen.reset()
+
+        # Call the Admin SDK Reports API. Shards are written as they come; after a failed shard, the shards before it
+        # are still checkpointed, and the error is raised once they are
+        shards = []
+        listing = self._fetch_activities(application_name, only_after_datetime)
+        output_count = 0
+        error = None
+        try:
+            output = None
+            writing = False
+            size = 0
+            try:
+                previous_keys = set()
+                for shard in listing:
+                    shards.append(shard)
+                    if shard['found'] and not writing:
+                        writing = True
+                        # Drop anything a crashed run appended after the last checkpoint before adding to the file
+                        checkpoint = self.checkpoints.load(self.CHECKPOINT_COLLECTOR, application_name)
+                        if not overwrite and self.local_copy:
+                            truncate_to_checkpoint(checkpoint, output_file)
+
+                        # Records are written oldest first (so latest events are at the end), a batch at a time
+                        initial_size = os.path.getsize(output_file) if not overwrite and os.path.exists(output_file) else 0
+                        # Hashed as it is written, for the run manifest
+                        hasher = integrity.hasher()
+                        output = NdjsonWriter(output_file, append=not overwrite, compression=self.compression, hasher=hasher) if self.local_copy else None
+                    for batch in self._shard_lines(shard, previous_keys, seen):
+                        if output is not None:
+                            with metrics.timer('for509_write_seconds', collector='gws'):
+                                output.write_lines(batch)
+                        if self.sink is not None and batch:
+                            self.sink.send([line.rstrip('\n') for line in batch])
+                        output_count += len(batch)
+                        metrics.inc('for509_bytes_in_total', sum(len(line) for line in batch), collector='gws')
+                    previous_keys = shard['tail_keys']
+                    # Its runs are not needed once written
+                    shard['spool'].close()
+            except ListingError as e:
+                error = e.__cause__
+            finally:
+                listing.close()
+                if output is not None:
+                    size = output.close()
+            found = sum(shard['found'] for shard in shards)
+            if writing:
+                metrics.inc('for509_events_total', output_count, collector='gws')
+                if output is not None:
+                    metrics.inc('for509_bytes_out_total', size - initial_size, collector='gws')
+
+                newest = max(shard['newest'] for shard in shards if shard['newest'])
+                total_events = output_count if overwrite or not checkpoint else checkpoint.events + output_count
+                if self.sink is not None:
+                    # The checkpoint must not get ahead of what the sink has
+                    self.sink.flush()
+                outputs = [OutputFile(output_file, size, total_events)] if output is not None else []
+                self.checkpoints.commit(self.CHECKPOINT_COLLECTOR, application_name, {'time': newest}, total_events, outputs)
+                if output is not None and hasher is not None:
+                    integrity.record(output_file, size - initial_size, hasher.hexdigests(), offset=initial_size, collector='gws',
+                                     application=application_name, events=output_count)
+                if seen is not None:
+                    # Only once the records are in the checkpointed file: a crash before this keeps them collectable
+                    seen.commit()
+                duplicates = sum(shard['duplicates'] for shard in shards)
+                if duplicates:
+                    metrics.inc('for509_duplicates_total', duplicates, collector='gws')
+                    logging.info(f"Dropped {duplicates} {application_name} records already in {output_file}")
+        finally:
+            for shard in shards:
+                shard['spool'].close()
+            if seen is not None:
+                seen.close()
+
+        if error is not None:
+            if output_count:
+                logging.info(f"Saved {output_count} {application_name} records older than the failed listing")
+            raise error
+        return output_count, found
 
 
 if __name__ == '__main__':
@@ -150,6 +496,18 @@ if __name__ == '__main__':
     parser.add_argument('--creds-path', required=False, help=".json credential file for the service account.")
     parser.add_argument('--delegated-creds', required=False, help="Principal name of the service account")
     parser.add_argument('--output-path', '-o', required=False, help="Folder to save downloaded logs")
+    parser.add_argument('--checkpoint-db', required=False, default=None,
+                        help="SQLite checkpoint database (default: checkpoints.sqlite in the output path)")
+    parser.add_argument('--max-workers', required=False, default=8, type=int,
+                        help="Number of applications collected at the same time")
+    parser.add_argument('--shards', required=False, default=Google.DEFAULT_SHARDS, type=int,
+                        help="Number of time shards listed in parallel for high volume applications (drive, token)")
+    parser.add_argument('--max-requests', required=False, default=Google.DEFAULT_MAX_REQUESTS, type=int,
+                        help="Number of API requests in flight at once, across all applications and shards")
+    parser.add_argument('--request-rate', required=False, default=Google.DEFAULT_REQUEST_RATE, type=float,
+                        help="Most API requests per second (throttled requests lower the rate for a while)")
+    parser.add_argument('--compression', required=False, default=None, choices=['gzip', 'zstd'],
+                        help="Compress the log files (zstd requires the zstandard package)")
     parser.add_argument('--apps', '-a', required=False, default=','.join(Google.DEFAULT_APPLICATIONS), 
                         help="Comma separated list of applications whose logs will be downloaded. "
                          "Or 'all' to attempt to download all available logs")
@@ -163,6 +521,9 @@ if __name__ == '__main__':
                         help="Update existing log files (if present). This will only save new log records.")
     parser.add_argument('--overwrite', required=False, action="store_true",
                         help="Overwrite existing log files (if present), with all available (or requested) log records.")
+    parser.add_argument('--no-dedup', dest='dedup', required=False, action="store_false",
+                        help="Append records even if they are already in the log file (by default their keys are remembered and repeats dropped).")
+    add_output_arguments(parser)
     
     # Logging/output levels
     parser.add_argument('--quiet', '-q', dest="log_level", action='store_const',
@@ -187,6 +548,10 @@ if __name__ == '__main__':
             if key not in args or not vars(args)[key]:
                 vars(args)[key] = config[key]
 
+    # The sink may come from the config file
+    check_output_arguments(parser, args)
+    args.local_copy = not args.no_local_copy
+
     # Convert apps argument to list
     if args.apps.strip().lower() == 'all':
         args.apps = Google.get_application_list()
@@ -198,4 +563,17 @@ if __name__ == '__main__':
 
     # Connect to Google API
     google = Google(**vars(args))
-    google.get_logs(args.from_date)
+    exporter = metrics.MetricsExporter(args.metrics_file, args.metrics_summary, args.metrics_port).start()
+    # Digests of everything appended to the log files are recorded in a signed run manifest
+    manifest = None
+    if google.local_copy:
+        manifest = integrity.RunManifest(google.output_path, 'gws', args.blake3, args.manifest_key_file)
+    try:
+        google.get_logs(args.from_date)
+    finally:
+        google.close()
+        exporter.close()
+        if manifest is not None:
+            logging.info(f"Run manifest: {manifest.close()}")
+    if google.failed_apps:
+        sys.exit(1)
@@ -0,0 +1,3 @@
+"""
+Benchmark harness running the collectors against local fakes of the cloud APIs. See bench/run.py.
+"""
@@ -0,0 +1,475 @@
+"""
+Local stand-ins for the APIs the collectors download from, served over HTTP so the collectors run unmodified through
+their real SDKs: CloudTrail LookupEvents (AWS JSON protocol), Azure Blob storage (the REST calls the blob downloader
+makes), an S3 bucket a CloudTrail trail delivers to and the Admin SDK Reports API activities.list. Stand-ins for the sinks they stream to (Elasticsearch _bulk and
+the Kafka REST proxy) count what they receive.
+
+Each fake serves a fixed, generated data set of events newest first. Every request waits page_latency seconds, and a
+throttle_rate fraction of them (chosen with a seeded random generator, so runs are repeatable) gets the service's
+throttling response instead.
+"""
+
+import base64, gzip, hashlib, json, math, random, sys, threading, time
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+from xml.sax.saxutils import escape
+
+# Azurite's well known development account, so the same connection string shape works against Azurite
+AZURITE_ACCOUNT = 'devstoreaccount1'
+AZURITE_KEY = 'Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=='
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        fake.requests += 1
+        if fake.page_latency:
+            time.sleep(fake.page_latency)
+        if fake.should_throttle():
+            fake.throttles += 1
+            status, headers, payload = fake.throttle_response()
+        else:
+            status, headers, payload = fake.handle(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_HEAD = _handle
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping their keep-alive connections when they exit are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeServer(object):
+    """
+    Serves a fake on 127.0.0.1 (on a free port unless one is given) from a background thread. Use as a context manager.
+    """
+
+    def __init__(self, page_latency=0.0, throttle_rate=0.0, seed=1, port=0):
+        self.page_latency = page_latency
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.throttles = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def should_throttle(self):
+        with self._random_lock:
+            return self._random.random() < self.throttle_rate
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+    def throttle_response(self):
+        raise NotImplementedError
+
+class _Timeline(object):
+    """
+    count events spread evenly over span, newest (index 0) first, ending now.
+    """
+
+    def __init__(self, count, span):
+        self.count = count
+        self.newest = datetime.now(timezone.utc).replace(microsecond=0)
+        self.step = span / max(count, 1)
+
+    def time(self, index):
+        return self.newest - self.step * index
+
+    def indexes(self, start=None, end=None):
+        """
+        Range of the indexes of the events between start and end, both inclusive.
+        """
+        first = 0 if end is None else max(0, math.ceil((self.newest - end) / self.step))
+        last = self.count if start is None else min(self.count, math.floor((self.newest - start) / self.step) + 1)
+        return first, max(first, last)
+
+def _padding(index, size):
+    # Deterministic filler so records have a realistic size without all compressing to nothing
+    return ''.join(f'{(index * 2654435761 + i) % 4294967296:08x}' for i in range(size // 8))
+
+def _cloudtrail_record(index, event_time, record_size, account='123456789012', region='us-east-1'):
+    return {
+        'eventVersion': '1.08', 'eventTime': event_time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'eventSource': 'iam.amazonaws.com',
+        'eventName': 'ListUsers', 'awsRegion': region, 'sourceIPAddress': '203.0.113.10', 'eventID': f'{index:08d}-0000-4000-8000-000000000000',
+        'userIdentity': {'type': 'IAMUser', 'accountId': account, 'userName': f'user{index % 50}'},
+        'requestParameters': {'marker': _padding(index, record_size)},
+    }
+
+class CloudTrailFake(FakeServer):
+    """
+    LookupEvents over the last 90 days. Honors MaxResults, NextToken and the inclusive StartTime/EndTime filters used
+    by sliced downloads. Point boto3 at it with AWS_ENDPOINT_URL_CLOUDTRAIL=<url>.
+    """
+
+    def __init__(self, events=20000, record_size=1200, **kwargs):
+        super().__init__(**kwargs)
+        self.timeline = _Timeline(events, timedelta(days=89))
+        self.record_size = record_size
+
+    def event(self, index):
+        event_time = self.timeline.time(index)
+        record = _cloudtrail_record(index, event_time, self.record_size)
+        return {'EventId': record['eventID'], 'EventName': 'ListUsers', 'EventTime': event_time.timestamp(),
+                'EventSource': 'iam.amazonaws.com', 'CloudTrailEvent': json.dumps(record)}
+
+    def handle(self, method, path, headers, body):
+        if not headers.get('X-Amz-Target', '').endswith('.LookupEvents'):
+            return 400, {'Content-Type': 'application/x-amz-json-1.1'}, b'{"__type":"UnknownOperationException"}'
+        request = json.loads(body or b'{}')
+        start = datetime.fromtimestamp(request['StartTime'], timezone.utc) if 'StartTime' in request else None
+        end = datetime.fromtimestamp(request['EndTime'], timezone.utc) if 'EndTime' in request else None
+        first, last = self.timeline.indexes(start, end)
+        # The token is the index of the next event, so it stays valid whatever the filters are
+        if request.get('NextToken'):
+            first = int(request['NextToken'])
+        stop = min(last, first + request.get('MaxResults', 50))
+        page = {'Events': [self.event(index) for index in range(first, stop)]}
+        if stop < last:
+            page['NextToken'] = str(stop)
+        return 200, {'Content-Type': 'application/x-amz-json-1.1'}, json.dumps(page).encode()
+
+    def throttle_response(self):
+        return 400, {'Content-Type': 'application/x-amz-json-1.1'}, b'{"__type":"ThrottlingException","message":"Rate exceeded"}'
+
+class BlobFake(FakeServer):
+    """
+    One container of hourly y=/m=/d=/h= partitioned PT1H.json blobs (the layout of Azure Monitor diagnostic logs),
+    events_per_blob lines each. Serves container properties, List Blobs (prefix, delimiter, marker, maxresults) and
+    Get Blob with ranges. Blobs are listed with their Content-MD5, like blobs uploaded in one request.
+    """
+
+    def __init__(self, events=20000, events_per_blob=100, container='insights-logs-signinlogs', resources=4, record_size=600, **kwargs):
+        super().__init__(**kwargs)
+        self.container = container
+        self.events = events
+        self.blobs = {}  # Content of each blob name
+        newest_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        for index in range(0, events, events_per_blob):
+            # Each hour has one blob per resource
+            blob_index = index // events_per_blob
+            hour = newest_hour - timedelta(hours=blob_index // resources)
+            name = (f'resourceId=/SUBSCRIPTIONS/0000/RESOURCEGROUPS/RG/PROVIDERS/MICROSOFT.AAD/R{blob_index % resources}/'
+                    f'y={hour.year}/m={hour.month:02d}/d={hour.day:02d}/h={hour.hour:02d}/m=00/PT1H.json')
+            lines = [json.dumps({'time': hour.isoformat(), 'operationName': 'Sign-in activity', 'correlationId': f'{index + i:012d}',
+                                 'properties': _padding(index + i, record_size)}) + '\n' for i in range(min(events_per_blob, events - index))]
+            self.blobs[name] = ''.join(lines).encode()
+        self.names = sorted(self.blobs)
+        self.last_modified = formatdate(newest_hour.timestamp(), usegmt=True)
+
+    def connection_string(self):
+        return (f'DefaultEndpointsProtocol=http;AccountName={AZURITE_ACCOUNT};AccountKey={AZURITE_KEY};'
+                f'BlobEndpoint={self.url}/{AZURITE_ACCOUNT};')
+
+    def _etag(self, name):
+        return f'"0x8D{len(self.blobs[name]):012X}"'
+
+    def _content_md5(self, name):
+        return base64.b64encode(hashlib.md5(self.blobs[name]).digest()).decode()
+
+    def _list(self, query):
+        prefix = query.get('prefix', [''])[0]
+        delimiter = query.get('delimiter', [''])[0]
+        marker = query.get('marker', [''])[0]
+        max_results = int(query.get('maxresults', ['5000'])[0])
+        entries = []
+        prefixes = set()
+        next_marker = ''
+        for name in self.names:
+            if not name.startswith(prefix) or (marker and name < marker):
+                continue
+            if delimiter and delimiter in name[len(prefix):]:
+                sub_prefix = name[:name.index(delimiter, len(prefix)) + 1]
+                if sub_prefix in prefixes:
+                    continue
+                prefixes.add(sub_prefix)
+                entry = f'<BlobPrefix><Name>{escape(sub_prefix)}</Name></BlobPrefix>'
+            else:
+                entry = (f'<Blob><Name>{escape(name)}</Name><Properties><Last-Modified>{self.last_modified}</Last-Modified>'
+                         f'<Etag>{self._etag(name)}</Etag><Content-Length>{len(self.blobs[name])}</Content-Length>'
+                         f'<Content-Type>application/json</Content-Type><Content-MD5>{self._content_md5(name)}</Content-MD5><BlobType>BlockBlob</BlobType></Properties></Blob>')
+            if len(entries) == max_results:
+                next_marker = name
+                break
+            entries.append(entry)
+        return (f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ServiceEndpoint="{self.url}/{AZURITE_ACCOUNT}/" '
+                f'ContainerName="{self.container}"><Prefix>{escape(prefix)}</Prefix><MaxResults>{max_results}</MaxResults>'
+                f'<Delimiter>{escape(delimiter)}</Delimiter><Blobs>{"".join(entries)}</Blobs>'
+                f'<NextMarker>{escape(next_marker)}</NextMarker></EnumerationResults>').encode()
+
+    def handle(self, method, path, headers, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = unquote(url.path).lstrip('/').split('/', 2)
+        common = {'x-ms-version': headers.get('x-ms-version', '2021-08-06'), 'x-ms-request-id': '00000000-0000-0000-0000-000000000000',
+                  'Date': formatdate(usegmt=True)}
+        if len(parts) < 2 or parts[1] != self.container:
+            return 404, dict(common, **{'x-ms-error-code': 'ContainerNotFound', 'Content-Type': 'application/xml'}), \
+                b'<?xml version="1.0" encoding="utf-8"?><Error><Code>ContainerNotFound</Code></Error>'
+        if len(parts) == 2:
+            if query.get('comp') == ['list']:
+                return 200, dict(common, **{'Content-Type': 'application/xml'}), self._list(query)
+            return 200, dict(common, **{'ETag': '"0x8D000000000000"', 'Last-Modified': self.last_modified}), b''
+
+        name = parts[2]
+        if name not in self.blobs:
+            return 404, dict(common, **{'x-ms-error-code': 'BlobNotFound', 'Content-Type': 'application/xml'}), \
+                b'<?xml version="1.0" encoding="utf-8"?><Error><Code>BlobNotFound</Code></Error>'
+        content = self.blobs[name]
+        blob_headers = dict(common, **{'ETag': self._etag(name), 'Last-Modified': self.last_modified, 'x-ms-blob-type': 'BlockBlob',
+                                       'Content-Type': 'application/json', 'Accept-Ranges': 'bytes',
+                                       'x-ms-blob-content-md5': self._content_md5(name)})
+        byte_range = headers.get('x-ms-range') or headers.get('Range')
+        if not byte_range:
+            return 200, blob_headers, content
+        start, _, end = byte_range.split('=', 1)[1].partition('-')
+        start, end = int(start), min(int(end) if end else len(content) - 1, len(content) - 1)
+        blob_headers['Content-Range'] = f'bytes {start}-{end}/{len(content)}'
+        return 206, blob_headers, content[start:end + 1]
+
+    def throttle_response(self):
+        return 503, {'x-ms-error-code': 'ServerBusy', 'Content-Type': 'application/xml'}, \
+            b'<?xml version="1.0" encoding="utf-8"?><Error><Code>ServerBusy</Code><Message>The server is busy.</Message></Error>'
+
+class TrailBucketFake(FakeServer):
+    """
+    An S3 bucket an organization trail delivered events_per_file events per log file to, over the last three years,
+    taking turns between accounts and regions. Serves ListObjectsV2 (prefix, delimiter, continuation-token, max-keys)
+    and GetObject with ranges and If-Match, path style. Point boto3 at it with AWS_ENDPOINT_URL_S3=<url>.
+    """
+
+    def __init__(self, events=20000, events_per_file=100, bucket='bench-trail', accounts=2, regions=('us-east-1', 'eu-west-1'), record_size=1200, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.timeline = _Timeline(events, timedelta(days=3 * 365))
+        self.objects = {}  # Content of each key
+        for file_index, index in enumerate(range(0, events, events_per_file)):
+            account = f'{100000000000 + file_index % accounts:012d}'
+            region = regions[file_index // accounts % len(regions)]
+            delivered = self.timeline.time(index)
+            key = (f'AWSLogs/o-bench00001/{account}/CloudTrail/{region}/{delivered:%Y/%m/%d}/'
+                   f'{account}_CloudTrail_{region}_{delivered:%Y%m%dT%H%M}Z_{file_index:08d}.json.gz')
+            records = [_cloudtrail_record(index + i, self.timeline.time(index + i), record_size, account, region)
+                       for i in range(min(events_per_file, events - index))]
+            self.objects[key] = gzip.compress(json.dumps({'Records': records}).encode(), mtime=0)
+        self.keys = sorted(self.objects)
+        self.etags = {key: f'"{hashlib.md5(content).hexdigest()}"' for key, content in self.objects.items()}
+        self.last_modified = formatdate(self.timeline.newest.timestamp(), usegmt=True)
+
+    @staticmethod
+    def _error(status, code):
+        return status, {'Content-Type': 'application/xml'}, \
+            f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode()
+
+    def _list(self, query):
+        prefix = query.get('prefix', [''])[0]
+        delimiter = query.get('delimiter', [''])[0]
+        token = query.get('continuation-token', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        encode = (lambda value: quote(value, safe='/')) if query.get('encoding-type') == ['url'] else escape
+        entries = []
+        prefixes = set()
+        last = None
+        truncated = False
+        for key in self.keys:
+            # The token is the last key or common prefix returned
+            if not key.startswith(prefix) or (token and (key <= token or (delimiter and token.endswith(delimiter) and key.startswith(token)))):
+                continue
+            if delimiter and delimiter in key[len(prefix):]:
+                sub_prefix = key[:key.index(delimiter, len(prefix)) + 1]
+                if sub_prefix in prefixes:
+                    continue
+                entry, name = f'<CommonPrefixes><Prefix>{encode(sub_prefix)}</Prefix></CommonPrefixes>', sub_prefix
+                prefixes.add(sub_prefix)
+            else:
+                entry, name = (f'<Contents><Key>{encode(key)}</Key><LastModified>{self.timeline.newest:%Y-%m-%dT%H:%M:%S.000Z}</LastModified>'
+                               f'<ETag>{escape(self.etags[key])}</ETag><Size>{len(self.objects[key])}</Size><StorageClass>STANDARD</StorageClass></Contents>'), key
+            if len(entries) == max_keys:
+                truncated = True
+                break
+            entries.append(entry)
+            last = name
+        continuation = f'<NextContinuationToken>{escape(last)}</NextContinuationToken>' if truncated else ''
+        encoding = '<EncodingType>url</EncodingType>' if query.get('encoding-type') == ['url'] else ''
+        return (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f'<Name>{self.bucket}</Name><Prefix>{encode(prefix)}</Prefix><KeyCount>{len(entries)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+                f'<Delimiter>{encode(delimiter)}</Delimiter>{encoding}<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+                f'{"".join(entries)}{continuation}</ListBucketResult>').encode()
+
+    def handle(self, method, path, headers, body):
+        url = urlparse(path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        if bucket != self.bucket:
+            return self._error(404, 'NoSuchBucket')
+        if not key:
+            return 200, {'Content-Type': 'application/xml'}, self._list(parse_qs(url.query))
+        if key not in self.objects:
+            return self._error(404, 'NoSuchKey')
+        if headers.get('If-Match') and headers['If-Match'] != self.etags[key]:
+            return self._error(412, 'PreconditionFailed')
+        content = self.objects[key]
+        object_headers = {'ETag': self.etags[key], 'Last-Modified': self.last_modified, 'Content-Type': 'application/x-gzip',
+                          'Accept-Ranges': 'bytes', 'x-amz-server-side-encryption': 'AES256'}
+        if not headers.get('Range'):
+            return 200, object_headers, content
+        start, _, end = headers['Range'].split('=', 1)[1].partition('-')
+        start, end = int(start), min(int(end) if end else len(content) - 1, len(content) - 1)
+        object_headers['Content-Range'] = f'bytes {start}-{end}/{len(content)}'
+        return 206, object_headers, content[start:end + 1]
+
+    def throttle_response(self):
+        return self._error(503, 'SlowDown')
+
+class ReportsFake(FakeServer):
+    """
+    Admin SDK Reports API activities.list for any application, over the last 170 days. Honors maxResults, pageToken
+    and the inclusive startTime/endTime filters. Build the service with client_options={'api_endpoint': fake.endpoint}.
+    """
+
+    def __init__(self, events=20000, record_size=400, **kwargs):
+        super().__init__(**kwargs)
+        self.timeline = _Timeline(events, timedelta(days=170))
+        self.record_size = record_size
+
+    @property
+    def endpoint(self):
+        # The client appends the service path (admin/reports/v1/) to this
+        return f'{self.url}/'
+
+    @staticmethod
+    def _rfc3339(value):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}Z'
+
+    @staticmethod
+    def _parse(value):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+    def activity(self, application, index):
+        return {
+            'kind': 'admin#reports#activity',
+            'id': {'time': self._rfc3339(self.timeline.time(index)), 'uniqueQualifier': str(index), 'applicationName': application,
+                   'customerId': 'C0000000'},
+            'actor': {'email': f'user{index % 50}@example.com', 'profileId': str(100000 + index % 50)},
+            'ipAddress': '203.0.113.10',
+            'events': [{'type': 'access', 'name': 'view', 'parameters': [{'name': 'doc_id', 'value': _padding(index, self.record_size)}]}],
+        }
+
+    def handle(self, method, path, headers, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = url.path.rstrip('/').split('/')
+        if 'applications' not in parts:
+            return 404, {'Content-Type': 'application/json'}, b'{"error":{"code":404,"message":"Not Found"}}'
+        application = parts[parts.index('applications') + 1]
+        start = self._parse(query['startTime'][0]) if 'startTime' in query else None
+        end = self._parse(query['endTime'][0]) if 'endTime' in query else None
+        first, last = self.timeline.indexes(start, end)
+        if 'pageToken' in query:
+            first = int(query['pageToken'][0])
+        stop = min(last, first + int(query.get('maxResults', ['1000'])[0]))
+        page = {'kind': 'admin#reports#activities', 'items': [self.activity(application, index) for index in range(first, stop)]}
+        if stop < last:
+            page['nextPageToken'] = str(stop)
+        return 200, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(page).encode()
+
+    def throttle_response(self):
+        return 429, {'Content-Type': 'application/json; charset=UTF-8'}, \
+            b'{"error":{"code":429,"message":"Quota exceeded","errors":[{"reason":"rateLimitExceeded"}]}}'
+
+class SinkFake(FakeServer):
+    """
+    Base of the sink stand-ins: records the IDs of the records received, so duplicates (records sent again after a
+    retry or a resume) can be told apart from distinct records.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = 0
+        self.ids = set()
+        self._lock = threading.Lock()
+
+    def receive(self, ids):
+        with self._lock:
+            self.received += len(ids)
+            self.ids.update(ids)
+
+class ElasticsearchFake(SinkFake):
+    """
+    Elasticsearch _bulk: accepts index actions, answering with a per item status. Throttled requests get 429.
+    """
+
+    def handle(self, method, path, headers, body):
+        if urlparse(path).path.rstrip('/') != '/_bulk':
+            return 404, {'Content-Type': 'application/json'}, b'{"error":"no handler"}'
+        lines = body.split(b'\n')
+        actions = [json.loads(line)['index'] for line in lines[0::2] if line.strip()]
+        self.receive([action['_id'] for action in actions])
+        items = [{'index': {'_index': action['_index'], '_id': action['_id'], 'status': 201, 'result': 'created'}} for action in actions]
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'took': 1, 'errors': False, 'items': items}).encode()
+
+    def throttle_response(self):
+        return 429, {'Content-Type': 'application/json'}, b'{"error":{"type":"es_rejected_execution_exception"},"status":429}'
+
+class KafkaRestFake(SinkFake):
+    """
+    Kafka REST proxy v2 produce (POST /topics/<topic>). Throttled requests get 429.
+    """
+
+    def handle(self, method, path, headers, body):
+        if not urlparse(path).path.startswith('/topics/'):
+            return 404, {'Content-Type': 'application/vnd.kafka.v2+json'}, b'{"error_code":40401,"message":"Not found"}'
+        records = json.loads(body)['records']
+        self.receive([record['key'] for record in records])
+        offsets = [{'partition': 0, 'offset': self.received - len(records) + index, 'error_code': None, 'error': None} for index in range(len(records))]
+        return 200, {'Content-Type': 'application/vnd.kafka.v2+json'}, json.dumps({'offsets': offsets}).encode()
+
+    def throttle_response(self):
+        return 429, {'Content-Type': 'application/vnd.kafka.v2+json'}, b'{"error_code":42901,"message":"Request rate limit exceeded"}'
+
+def seed_azurite(connection_string, fake):
+    """
+    Uploads the blobs of a BlobFake to the storage account of connection_string (typically Azurite), so the blob
+    benchmark can run against it instead.
+    """
+    from azure.storage.blob import BlobServiceClient
+    container = BlobServiceClient.from_connection_string(connection_string).get_container_client(fake.container)
+    if not container.exists():
+        container.create_container()
+    for name, content in fake.blobs.items():
+        container.upload_blob(name, content, overwrite=True)
@@ -0,0 +1,182 @@
+"""
+Benchmarks the collectors against the local fakes and compares the results to a stored baseline.
+
+    python -m bench.run                          # every target, compared to bench/baseline.json
+    python -m bench.run --targets cloudtrail --events 50000 --page-latency-ms 20 --throttle-rate 0.02
+    python -m bench.run --update-baseline        # record the current results as the baseline
+    python -m bench.run --sink elasticsearch --no-local-copy   # stream to a local Elasticsearch stand-in instead
+
+Each target runs --repeat times in a fresh output directory and the best run is kept (highest events/s, lowest time
+to first byte and peak RSS), which filters out noise from the rest of the machine. A result is a regression if it is
+worse than the baseline by more than --tolerance, or if it collected a different number of events or files than the
+baseline did. Baselines are only compared when they were recorded with the same scenario. The exit code is 1 if any
+target regressed or failed.
+
+With --sink the collectors also stream their records to a stand-in of that sink, and the records it received (and
+how many distinct IDs they had) are reported; with --no-local-copy as well, events are counted at the sink.
+"""
+
+import argparse, json, os, shutil, subprocess, sys, tempfile
+
+from bench.fakes import BlobFake, CloudTrailFake, ElasticsearchFake, KafkaRestFake, ReportsFake, TrailBucketFake, seed_azurite
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Result fields compared to the baseline, and whether a higher value is better
+METRICS = {'events_per_second': True, 'first_byte': False, 'peak_rss': False}
+
+REPORTS_APPLICATIONS = ['drive', 'login']
+
+# Sink stand-ins, and the URL scheme of their for509.sinks URLs
+SINKS = {'elasticsearch': (ElasticsearchFake, 'elasticsearch+'), 'kafka-rest': (KafkaRestFake, 'kafka-rest+')}
+
+def start_fake(target, scenario, azurite=None):
+    fake_args = {'page_latency': scenario['page_latency_ms'] / 1000, 'throttle_rate': scenario['throttle_rate'], 'seed': scenario['seed']}
+    if target == 'cloudtrail':
+        fake = CloudTrailFake(scenario['events'], **fake_args).start()
+        return fake, {'url': fake.url, 'slice_hours': scenario['slice_hours']}
+    if target == 'blob':
+        fake = BlobFake(scenario['events'], **fake_args).start()
+        if azurite:
+            # The fake only generates the blobs; they are served by Azurite
+            seed_azurite(azurite, fake)
+            return fake, {'connection_string': azurite, 'container': fake.container}
+        return fake, {'connection_string': fake.connection_string(), 'container': fake.container}
+    if target == 'trail':
+        fake = TrailBucketFake(scenario['events'], **fake_args).start()
+        return fake, {'url': fake.url, 'bucket': fake.bucket}
+    # The events are split between the applications
+    fake = ReportsFake(scenario['events'] // len(REPORTS_APPLICATIONS), **fake_args).start()
+    return fake, {'endpoint': fake.endpoint, 'apps': REPORTS_APPLICATIONS}
+
+def run_once(target, config):
+    output_directory = tempfile.mkdtemp(prefix=f'bench-{target}-')
+    try:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+        child = subprocess.run([sys.executable, '-m', 'bench.targets', target, json.dumps(dict(config, output_directory=output_directory))],
+                               capture_output=True, text=True, env=env, cwd=REPO_ROOT)
+        if child.returncode != 0:
+            raise RuntimeError(child.stderr.strip().splitlines()[-1] if child.stderr.strip() else f'exit code {child.returncode}')
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        result['events_per_second'] = result['events'] / result['elapsed'] if result['elapsed'] else 0.0
+        return result
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+def best_of(results):
+    best = dict(max(results, key=lambda result: result['events_per_second']))
+    for metric, higher_is_better in METRICS.items():
+        values = [result[metric] for result in results if result[metric] is not None]
+        if values:
+            best[metric] = max(values) if higher_is_better else min(values)
+    return best
+
+def run_target(target, scenario, azurite=None):
+    fake, config = start_fake(target, scenario, azurite)
+    sink = None
+    try:
+        if scenario.get('sink'):
+            # The sink is throttled like the API, so delivery retries are exercised too
+            sink_class, scheme = SINKS[scenario['sink']]
+            sink = sink_class(page_latency=scenario['page_latency_ms'] / 1000, throttle_rate=scenario['throttle_rate'], seed=scenario['seed']).start()
+            config = dict(config, sink=f'{scheme}{sink.url}/bench-{target}', local_copy=scenario['local_copy'])
+        result = best_of([run_once(target, config) for _ in range(scenario['repeat'])])
+        # Requests served per run
+        result['requests'] = fake.requests // scenario['repeat']
+        result['throttles'] = fake.throttles // scenario['repeat']
+        if sink is not None:
+            # IDs are stable, so every run sends the same distinct records
+            result['sink_received'] = sink.received // scenario['repeat']
+            result['sink_records'] = len(sink.ids)
+            if not scenario['local_copy']:
+                result['events'] = result['sink_records']
+                result['events_per_second'] = result['events'] / result['elapsed'] if result['elapsed'] else 0.0
+    finally:
+        fake.stop()
+        if sink is not None:
+            sink.stop()
+    return result
+
+def compare(result, baseline, tolerance):
+    """
+    Returns the regressions of result against baseline, as readable strings.
+    """
+    regressions = []
+    for key in ('events', 'files'):
+        if result[key] != baseline[key]:
+            regressions.append(f'{key} {result[key]} instead of {baseline[key]}')
+    for metric, higher_is_better in METRICS.items():
+        value, reference = result[metric], baseline.get(metric)
+        if value is None or not reference:
+            continue
+        change = (value - reference) / reference
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f'{metric} {value:.3g} vs {reference:.3g} ({change:+.0%})')
+    return regressions
+
+def format_result(target, result):
+    first_byte = f'{result["first_byte"]:.3f}s' if result['first_byte'] is not None else '-'
+    return (f'{target}: {result["events"]} events in {result["elapsed"]:.2f}s ({result["events_per_second"]:.0f} events/s), '
+            f'first byte {first_byte}, peak RSS {result["peak_rss"] / 1024 / 1024:.0f}MB, {result["files"]} files '
+            f'({result["bytes"] / 1024 / 1024:.1f}MB), {result["requests"]} requests, {result["throttles"]} throttled'
+            + (f', sink received {result["sink_received"]} ({result["sink_records"]} distinct)' if 'sink_records' in result else ''))
+
+def main(args):
+    scenario = {'events': args.events, 'page_latency_ms': args.page_latency_ms, 'throttle_rate': args.throttle_rate, 'seed': args.seed,
+                'slice_hours': args.slice_hours}
+    if args.sink:
+        scenario.update(sink=args.sink, local_copy=not args.no_local_copy)
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+
+    failed = False
+    results = {}
+    for target in args.targets:
+        try:
+            results[target] = run_target(target, dict(scenario, repeat=args.repeat), args.azurite)
+        except Exception as e:
+            print(f'{target}: FAILED: {e}')
+            failed = True
+            continue
+        print(format_result(target, results[target]))
+
+        baseline = stored.get(target)
+        if baseline is None or baseline['scenario'] != scenario or (target == 'blob' and args.azurite):
+            print('  no baseline for this scenario')
+            continue
+        regressions = compare(results[target], baseline['result'], args.tolerance)
+        for regression in regressions:
+            print(f'  REGRESSION: {regression}')
+        failed = failed or bool(regressions)
+
+    if args.update_baseline:
+        for target, result in results.items():
+            stored[target] = {'scenario': scenario, 'result': result}
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collectors against local fakes of the CloudTrail, Blob, S3 and Reports APIs.')
+    parser.add_argument('--targets', nargs='+', default=['cloudtrail', 'blob', 'trail', 'reports'], choices=['cloudtrail', 'blob', 'trail', 'reports'],
+                        help='Collectors to benchmark (blob requires azure-storage-blob, reports google-api-python-client).')
+    parser.add_argument('--events', default=20000, type=int, help='Events each fake serves.')
+    parser.add_argument('--page-latency-ms', default=5.0, type=float, help='Time each fake takes to answer a request.')
+    parser.add_argument('--throttle-rate', default=0.0, type=float, help='Fraction of requests answered with a throttling error.')
+    parser.add_argument('--seed', default=1, type=int, help='Seed choosing the throttled requests.')
+    parser.add_argument('--slice-hours', default=0, type=int, help='Download CloudTrail as concurrent time slices of this many hours.')
+    parser.add_argument('--azurite', default=None, help='Connection string of a running Azurite to benchmark blob downloads against instead of the '
+                                                         'built in fake (e.g. "UseDevelopmentStorage=true"). Latency and throttling do not apply to it.')
+    parser.add_argument('--sink', default=None, choices=sorted(SINKS), help='Also stream the records to a stand-in of this sink.')
+    parser.add_argument('--no-local-copy', action='store_true', help='With --sink, only send the records to the sink.')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per target; the best one is reported.')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Relative change from the baseline counted as a regression.')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline file to compare to and update.')
+    parser.add_argument('--update-baseline', action='store_true', help='Save the results as the baseline of their targets.')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,175 @@
+"""
+The collector code paths the benchmark measures, run in a child process of bench.run so that peak RSS and imports
+belong to the collector alone (the fakes run in the parent):
+
+    cloudtrail  Cloudtrail_downloadv2.regionDownload of one region
+    blob        download_blobs_multithreaded.main, i.e. the listing pipeline and save_blob_locally
+    trail       Cloudtrail_s3_download.main, i.e. the parallel prefix listing and save_object
+    reports     gws-get-logs.py Google.get_logs, i.e. _get_activity_logs of every application
+
+    python -m bench.targets <target> '<json config>'
+
+prints one JSON line: events, elapsed seconds, time to first output byte, peak RSS, output files and bytes. A 'sink'
+URL in the config is passed on to the collector, with 'local_copy'. Like the collectors' own command lines, every
+run hashes the files it writes into a signed manifest, which is not counted as output.
+"""
+
+import argparse, contextlib, io, json, logging, os, resource, sys, threading, time
+
+from for509 import integrity
+from for509.plugins import load_script
+
+def _is_output(name):
+    # Leaves out checkpoint databases and run manifests
+    return '.sqlite' not in name and not name.startswith('manifest-')
+
+def _output_files(directory):
+    # Finished output files, leaving out seen sets and files still being written
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if name != '.seen']
+        for name in files:
+            if _is_output(name) and not name.endswith('.part'):
+                yield os.path.join(root, name)
+
+class FirstByteWatcher(object):
+    """
+    Polls a directory until any file in it (finished or not) has data, and records how long that took.
+    """
+
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.first_byte = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def _has_data(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [name for name in dirs if name != '.seen']
+            for name in files:
+                if _is_output(name):
+                    try:
+                        if os.path.getsize(os.path.join(root, name)) > 0:
+                            return True
+                    except OSError:
+                        pass
+        return False
+
+    def _watch(self):
+        while not self._stop.is_set():
+            if self._has_data():
+                self.first_byte = time.perf_counter() - self.start
+                return
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class _Queue(object):
+    def put(self, message):
+        pass
+
+    def close(self):
+        pass
+
+def run_cloudtrail(config, output_directory):
+    from for509.cloudtrail import DEFAULT_OUTPUT_CONFIG
+    from for509.ratelimit import TokenBucket
+    os.environ['AWS_ENDPOINT_URL_CLOUDTRAIL'] = config['url']
+    v2 = load_script(os.path.join('AWS', 'Cloudtrail_downloadv2.py'), 'for509_cloudtrail_download')
+    session_params = {'aws_access_key_id': 'AKIDBENCHMARK', 'aws_secret_access_key': 'benchmark', 'aws_session_token': None,
+                      'account_id': '123456789012'}
+    slice_config = None
+    if config.get('slice_hours'):
+        slice_config = {'slice_hours': config['slice_hours'], 'workers': config.get('slice_workers', 4), 'split_events': 10000}
+    output_config = dict(DEFAULT_OUTPUT_CONFIG, sink=config.get('sink'), local_copy=config.get('local_copy', True))
+    v2.regionDownload(session_params, 'us-east-1', output_directory, _Queue(), TokenBucket(rate=config.get('lookup_rate', 1000.0)),
+                      os.path.join(output_directory, 'checkpoints.sqlite'), slice_config, output_config)
+
+def run_blob(config, output_directory):
+    script = load_script(os.path.join('Azure', 'download_blobs_multithreaded.py'), 'for509_azure_blob_download')
+    args = argparse.Namespace(connection_string=[config['connection_string']], accounts_file=None, containers=[config['container']],
+                              output_directory=output_directory, checkpoint_db=None, full=False, lookback_hours=3,
+                              concurrency=config.get('concurrency', 10), max_concurrency=config.get('max_concurrency', 64),
+                              sink=config.get('sink'), no_local_copy=not config.get('local_copy', True), blake3=False, manifest_key_file=None,
+                              metrics_file=None, metrics_summary=None, metrics_port=None)
+    # The script prints every blob it downloads
+    with contextlib.redirect_stdout(io.StringIO()):
+        script.main(args)
+
+def run_trail(config, output_directory):
+    os.environ['AWS_ENDPOINT_URL_S3'] = config['url']
+    script = load_script(os.path.join('AWS', 'Cloudtrail_s3_download.py'), 'for509_cloudtrail_s3_download')
+    args = argparse.Namespace(bucket=config['bucket'], prefix='', output_directory=output_directory, start=None, end=None, accounts=None,
+                              regions=None, full=False, lookback_hours=3, concurrency=config.get('concurrency', 16),
+                              max_concurrency=config.get('max_concurrency', 64), access_key_id='AKIDBENCHMARK', secret_key='benchmark',
+                              session_token=None, profile='default', role_arn=None, external_id=None, region='us-east-1', checkpoint_db=None,
+                              sink=config.get('sink'), no_local_copy=not config.get('local_copy', True), blake3=False, manifest_key_file=None,
+                              metrics_file=None, metrics_summary=None, metrics_port=None)
+    # The script prints every file it downloads
+    with contextlib.redirect_stdout(io.StringIO()):
+        script.main(args)
+
+def run_reports(config, output_directory):
+    import httplib2
+    from googleapiclient.discovery import build
+    script = load_script(os.path.join('GWS', 'gws-log-collection', 'gws-get-logs.py'), 'for509_gws_get_logs')
+
+    # No credentials: the fake does not check them
+    script.Google.google_session = lambda self: build('admin', 'reports_v1', http=httplib2.Http(), static_discovery=True,
+                                                      client_options={'api_endpoint': config['endpoint']})
+    google = script.Google(creds_path=None, delegated_creds=None, output_path=output_directory, apps=config['apps'],
+                           update=False, overwrite=False, shards=config.get('shards'), compression=config.get('compression'),
+                           sink=config.get('sink'), local_copy=config.get('local_copy', True))
+    try:
+        google.get_logs()
+    finally:
+        google.close()
+
+TARGETS = {'cloudtrail': run_cloudtrail, 'blob': run_blob, 'trail': run_trail, 'reports': run_reports}
+
+def count_events(path):
+    """
+    Events in an output file: lines of NDJSON and blob files, records of CloudTrail {"Records":[...]} files.
+    """
+    from for509.writer import open_lines
+    compression = 'gzip' if path.endswith('.gz') else 'zstd' if path.endswith('.zst') else None
+    if os.path.basename(path).split('_')[1:2] == ['CloudTrail'] and '.ndjson' not in path:
+        with open_lines(path, compression) as f:
+            return len(json.loads(f.read())['Records'])
+    with open_lines(path, compression) as f:
+        return sum(1 for line in f if line.strip())
+
+def main(target, config):
+    output_directory = config['output_directory']
+    os.makedirs(output_directory, exist_ok=True)
+    os.environ.setdefault(integrity.KEY_ENV, 'benchmark')
+    manifest = None
+    # The blob and trail targets run their script's main, which opens its own manifest
+    if config.get('local_copy', True) and target not in ('blob', 'trail'):
+        manifest = integrity.RunManifest(output_directory, target)
+    watcher = FirstByteWatcher(output_directory)
+    TARGETS[target](config, output_directory)
+    if manifest is not None:
+        manifest.close()
+    elapsed = time.perf_counter() - watcher.start
+    watcher.stop()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    files = list(_output_files(output_directory))
+    return {
+        'events': sum(count_events(path) for path in files),
+        'elapsed': elapsed,
+        'first_byte': watcher.first_byte,
+        'peak_rss': peak_rss,
+        'files': len(files),
+        'bytes': sum(os.path.getsize(path) for path in files),
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    print(json.dumps(main(sys.argv[1], json.loads(sys.argv[2]))))
@@ -0,0 +1,3 @@
+"""
+Shared helpers for the SANS FOR509 log collection scripts.
+"""
@@ -0,0 +1,253 @@
+"""
+AWS helpers shared by the CloudTrail collectors: assumed-role sessions, account discovery, region pre-flight and the
+key layout of trail buckets.
+"""
+
+import json, os, re, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+
+from for509.ratelimit import call_with_backoff
+
+# Assumed role credentials are refreshed when they have less than this much time left
+REFRESH_MARGIN = timedelta(minutes=15)
+
+# Trails deliver their log files to <key prefix>/AWSLogs/[<organization ID>/]<account>/CloudTrail/<region>/<yyyy>/<mm>/<dd>/
+# <account>_CloudTrail_<region>_<yyyymmdd>T<hhmm>Z_<unique string>.json.gz, dated when the file was delivered
+TRAIL_FILE = re.compile(r'(?:^|/)AWSLogs/(?:o-[a-z0-9]+/)?(\d{12})/CloudTrail/([a-z0-9-]+)/\d{4}/\d\d/\d\d/'
+                        r'\d{12}_CloudTrail_[a-z0-9-]+_(\d{8}T\d{4})Z_[^/]+\.json\.gz$')
+# Files are usually delivered within 15 minutes of their events; a file delivered up to this long after the end of a
+# time window is still read in case it holds events from inside it
+DELIVERY_DELAY = timedelta(hours=1)
+
+# A region found without events is only trusted to stay empty this long (in seconds), whatever the cache TTL: events
+# it gets later must not be skipped for a day. Long enough for a quick re-run to skip the probes
+EMPTY_REGION_TTL = 10 * 60
+
+def base_session(session_params, region_name=None):
+    """
+    Returns a boto3 session for the access keys in session_params.
+    """
+    return boto3.Session(
+        aws_access_key_id=session_params['aws_access_key_id'],
+        aws_secret_access_key=session_params['aws_secret_access_key'],
+        aws_session_token=session_params['aws_session_token'],
+        region_name=region_name
+    )
+
+def assume_role(session_params, role_arn, external_id=None, session_name='for509-collection'):
+    """
+    Assumes role_arn with the base credentials and returns the temporary credentials in botocore's metadata format.
+    """
+    assume_args = {'RoleArn': role_arn, 'RoleSessionName': session_name}
+    if external_id:
+        assume_args['ExternalId'] = external_id
+    credentials = base_session(session_params).client('sts').assume_role(**assume_args)['Credentials']
+    return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat()
+    }
+
+def role_session(session_params, role_arn, external_id=None, credentials=None, region_name=None):
+    """
+    Returns a boto3 session for role_arn whose credentials refresh themselves by assuming the role again before
+    they expire, so long running downloads outlive the one hour STS session. credentials can be a set of still valid
+    assumed role credentials (e.g. from RoleCredentialCache) to avoid an extra AssumeRole call.
+    """
+    def refresh():
+        return assume_role(session_params, role_arn, external_id)
+
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=credentials or refresh(), refresh_using=refresh, method='sts-assume-role')
+    return boto3.Session(botocore_session=botocore_session, region_name=region_name)
+
+class RoleCredentialCache(object):
+    """
+    Caches assumed role credentials per role so that the many account x region work items of one account share a
+    single AssumeRole call. Credentials close to expiry are replaced transparently.
+    """
+
+    def __init__(self, session_params, external_id=None):
+        self.session_params = session_params
+        self.external_id = external_id
+        self._lock = threading.Lock()
+        self._credentials = {}
+
+    def get(self, role_arn):
+        with self._lock:
+            credentials = self._credentials.get(role_arn)
+            if credentials is None or datetime.fromisoformat(credentials['expiry_time']) - datetime.now(timezone.utc) < REFRESH_MARGIN:
+                credentials = assume_role(self.session_params, role_arn, self.external_id)
+                self._credentials[role_arn] = credentials
+            return credentials
+
+def list_organization_accounts(session_params):
+    """
+    Returns the IDs of all active member accounts of the AWS Organization the credentials belong to.
+    """
+    client = base_session(session_params, 'us-east-1').client('organizations')
+    accounts = []
+    for page in client.get_paginator('list_accounts').paginate():
+        accounts.extend(account['Id'] for account in page['Accounts'] if account['Status'] == 'ACTIVE')
+    return accounts
+
+def read_account_list(filename):
+    """
+    Reads account IDs or role ARNs, one per line. Blank lines and lines starting with # are ignored.
+    """
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def role_arn_for(account, role_name):
+    """
+    Returns the role ARN to assume for an entry of the account list (either an account ID or a full role ARN).
+    """
+    if account.startswith('arn:'):
+        return account
+    return f'arn:aws:iam::{account}:role/{role_name}'
+
+class DiscoveryCache(object):
+    """
+    Small JSON file cache for account IDs, region lists and region probe results, so that repeated runs against the
+    same accounts can skip the discovery calls. Entries older than ttl seconds (or the shorter ttl given to get) are
+    ignored; a ttl of 0 disables the cache.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        if ttl and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                self._entries = {}
+
+    def get(self, key, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+        if not self.ttl or entry is None or time.time() - entry['time'] > min(self.ttl, ttl or self.ttl):
+            return None
+        return entry['value']
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = {'time': time.time(), 'value': value}
+
+    def save(self):
+        if not self.ttl:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(self.path + '.tmp', self.path)
+
+def cached_account_id(cache, session_params, session=None):
+    """
+    Returns the account ID the credentials belong to, calling STS only if it is not cached.
+    """
+    key = 'account:' + session_params['aws_access_key_id']
+    account_id = cache.get(key)
+    if account_id is None:
+        session = session or base_session(session_params, 'us-east-1')
+        account_id = session.client('sts').get_caller_identity()['Account']
+        cache.set(key, account_id)
+    return account_id
+
+def cached_regions(cache, session, account_id):
+    """
+    Returns the regions enabled in the account, calling EC2 DescribeRegions only if they are not cached.
+    """
+    key = 'regions:' + account_id
+    regions = cache.get(key)
+    if regions is None:
+        regions = [region['RegionName'] for region in session.client('ec2', region_name='us-east-1').describe_regions()['Regions']]
+        cache.set(key, regions)
+    return regions
+
+def region_has_events(client, limiter=None):
+    """
+    Probes a region with a single one-event LookupEvents call on its CloudTrail client, through limiter if there is
+    one (throttled probes are then retried). Any other error counts as having events, so the region is left to a full
+    download worker to deal with.
+    """
+    try:
+        if limiter is None:
+            return bool(client.lookup_events(MaxResults=1)['Events'])
+        return bool(call_with_backoff(limiter, client.lookup_events, metric='cloudtrail:LookupEvents', MaxResults=1)['Events'])
+    except Exception:
+        return True
+
+def probe_regions(cache, targets, limiters=None, max_workers=16):
+    """
+    Probes (account_id, region_name, session) targets in parallel and returns the set of (account_id, region_name)
+    pairs that have no CloudTrail events at all. Only regions found empty are cached, for EMPTY_REGION_TTL, so a
+    region with events is always probed (and downloaded) again. A probe goes through limiters[(account_id,
+    region_name)] if limiters has it: the TokenBucket the region is then downloaded with, as LookupEvents is rate
+    limited per account and region.
+    """
+    # boto3 sessions are not thread safe, so clients are created one at a time
+    client_lock = threading.Lock()
+
+    def probe(target):
+        account_id, region_name, session = target
+        key = f'empty:{account_id}:{region_name}'
+        if cache.get(key, EMPTY_REGION_TTL):
+            return account_id, region_name, False
+        with client_lock:
+            client = session.client('cloudtrail', region_name=region_name)
+        has_events = region_has_events(client, (limiters or {}).get((account_id, region_name)))
+        if not has_events:
+            cache.set(key, True)
+        return account_id, region_name, has_events
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return set((account_id, region_name) for account_id, region_name, has_events in executor.map(probe, targets) if not has_events)
+
+def trail_file(key):
+    """
+    Returns (account, region, delivery time) of a trail log file, or None if key is not one (e.g. a digest file).
+    """
+    match = TRAIL_FILE.search(key)
+    if not match:
+        return None
+    return match.group(1), match.group(2), datetime.strptime(match.group(3), '%Y%m%dT%H%M').replace(tzinfo=timezone.utc)
+
+def in_delivery_window(delivered, start=None, end=None):
+    """
+    True if a file delivered at that time can hold events from the [start, end] window (either bound may be None).
+    """
+    return (start is None or delivered >= start.replace(second=0, microsecond=0)) and (end is None or delivered <= end + DELIVERY_DELAY)
+
+def date_prefix_in_window(fields, start=None, end=None):
+    """
+    True if the files under a <yyyy>/, <yyyy>/<mm>/ or <yyyy>/<mm>/<dd>/ prefix, whose (year[, month[, day]]) fields
+    are given, can be in the delivery window of [start, end]. Only the fields the prefix has are compared, so whole years
+    and months outside the window are never listed.
+    """
+    if start is not None and fields < (start.year, start.month, start.day)[:len(fields)]:
+        return False
+    if end is not None:
+        last = end + DELIVERY_DELAY
+        if fields > (last.year, last.month, last.day)[:len(fields)]:
+            return False
+    return True
+
+def list_common_prefixes(client, bucket, prefix):
+    """
+    Returns the 'directories' directly under prefix of an S3 bucket (a '/' delimited listing).
+    """
+    prefixes = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    return prefixes
@@ -0,0 +1,58 @@
+"""
+Azure Storage helpers shared by the blob collectors: date partition parsing and incremental blob listing.
+"""
+
+import re
+from datetime import datetime, timezone
+
+from azure.storage.blob import BlobPrefix
+
+# Azure Monitor diagnostic settings write blobs under .../y=2024/m=01/d=15/h=10/m=00/PT1H.json
+_PARTITION_FIELDS = ('y', 'm', 'd', 'h')
+_SEGMENT = re.compile(r'^([a-z]+)=(\d+)$')
+
+def partition_fields(name):
+    """
+    Returns the (year, month, day, hour) fields found in a blob name or prefix, as a tuple of however many of them are
+    present (up to the hour), e.g. (2024, 1) for '.../y=2024/m=01/'. Returns () if the name is not date partitioned.
+    """
+    fields = []
+    for segment in name.split('/'):
+        match = _SEGMENT.match(segment)
+        if not match:
+            continue
+        if len(fields) < len(_PARTITION_FIELDS) and match.group(1) == _PARTITION_FIELDS[len(fields)]:
+            fields.append(int(match.group(2)))
+    return tuple(fields)
+
+def partition_time(name):
+    """
+    Returns the UTC hour a date partitioned blob belongs to, or None if the name has no complete y=/m=/d=/h= path.
+    """
+    fields = partition_fields(name)
+    if len(fields) < len(_PARTITION_FIELDS):
+        return None
+    return datetime(*fields, tzinfo=timezone.utc)
+
+def _before(fields, since):
+    # A partition is older than since if all of it is; compare only the fields the prefix has
+    since_fields = (since.year, since.month, since.day, since.hour)[:len(fields)]
+    return fields < since_fields
+
+def list_blobs_since(container, since=None, prefix=''):
+    """
+    Yields the blobs of container under prefix, skipping every y=/m=/d=/h= partition older than since. Without since,
+    this is a plain flat listing. With it, the container is walked one directory level at a time so that whole years,
+    months and days before since are never listed, which keeps incremental pulls proportional to the new partitions.
+    """
+    if since is None:
+        yield from container.list_blobs(name_starts_with=prefix or None)
+        return
+    for item in container.walk_blobs(name_starts_with=prefix or None, delimiter='/'):
+        if isinstance(item, BlobPrefix):
+            fields = partition_fields(item.name)
+            if fields and _before(fields, since):
+                continue
+            yield from list_blobs_since(container, since, item.name)
+        else:
+            yield item
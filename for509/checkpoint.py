@@ -0,0 +1,133 @@
+"""
+Crash-safe resume checkpoints shared by the AWS, Azure and GWS collectors.
+
+Checkpoints live in a SQLite database in WAL mode. A checkpoint records, for one collector and scope (for example an
+account and region, a blob, or a GWS application), the cursor to resume from, the number of events collected so far
+and the output files those events are in. The cursor and the outputs are written in a single transaction, so after a
+crash the database always describes a consistent state: every page before the cursor is in a recorded output file
+and nothing after it is.
+"""
+
+import json, os, sqlite3, threading, time
+from collections import namedtuple
+
+Checkpoint = namedtuple('Checkpoint', ['cursor', 'events', 'done', 'outputs'])
+OutputFile = namedtuple('OutputFile', ['path', 'offset', 'events'])
+
+# Name of the checkpoint database in the output directory of every collector, unless another path is given
+DEFAULT_CHECKPOINT_DB = 'checkpoints.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS checkpoints (
+    collector TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    cursor TEXT,
+    events INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    PRIMARY KEY (collector, scope)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    collector TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    PRIMARY KEY (collector, scope, path)
+);
+'''
+
+def default_checkpoint_db(output_directory):
+    """
+    Path of the checkpoint database of an output directory.
+    """
+    return os.path.join(output_directory, DEFAULT_CHECKPOINT_DB)
+
+class CheckpointStore(object):
+    """
+    SQLite backed checkpoint store. Each process should open its own store; a store can be shared between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.executescript(SCHEMA)
+
+    def load(self, collector, scope):
+        """
+        Returns the Checkpoint for collector/scope, or None if nothing has been committed yet.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT cursor, events, done FROM checkpoints WHERE collector = ? AND scope = ?',
+                                     (collector, scope)).fetchone()
+            if row is None:
+                return None
+            outputs = [OutputFile(*output) for output in self._conn.execute(
+                'SELECT path, offset, events FROM outputs WHERE collector = ? AND scope = ? ORDER BY rowid',
+                (collector, scope))]
+        cursor = json.loads(row[0]) if row[0] is not None else None
+        return Checkpoint(cursor, row[1], bool(row[2]), outputs)
+
+    def load_all(self, collector):
+        """
+        Returns {scope: Checkpoint} for every scope of a collector (without their outputs).
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT scope, cursor, events, done FROM checkpoints WHERE collector = ?',
+                                      (collector,)).fetchall()
+        return {scope: Checkpoint(json.loads(cursor) if cursor is not None else None, events, bool(done), [])
+                for scope, cursor, events, done in rows}
+
+    def commit(self, collector, scope, cursor, events, outputs=(), done=False):
+        """
+        Atomically records the cursor, event count and any new or grown output files (path, offset, events) for collector/scope.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO checkpoints (collector, scope, cursor, events, done, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                    (collector, scope, json.dumps(cursor) if cursor is not None else None, events, int(done), time.time()))
+                for output in outputs:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO outputs (collector, scope, path, offset, events) VALUES (?, ?, ?, ?, ?)',
+                        (collector, scope) + tuple(output))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def clear(self, collector, scope=None):
+        """
+        Forgets the checkpoints of one scope, or of every scope of the collector.
+        """
+        where, params = ('collector = ?', (collector,)) if scope is None else ('collector = ? AND scope = ?', (collector, scope))
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('DELETE FROM checkpoints WHERE ' + where, params)
+            self._conn.execute('DELETE FROM outputs WHERE ' + where, params)
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def truncate_to_checkpoint(checkpoint, path):
+    """
+    Cuts an append-only output file back to the offset recorded in the checkpoint, dropping anything written after
+    the last commit (e.g. a partial record from a crash). Files the checkpoint does not know about are left alone.
+    Returns the offset the file now ends at, or None if the file is not recorded in the checkpoint.
+    """
+    offsets = [output.offset for output in (checkpoint.outputs if checkpoint else []) if output.path == path]
+    if not offsets:
+        return None
+    offset = offsets[-1]
+    if os.path.exists(path) and os.path.getsize(path) > offset:
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+            f.flush()
+            os.fsync(f.fileno())
+    return offset
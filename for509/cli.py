@@ -0,0 +1,26 @@
+"""
+Command line options shared by the collection scripts: where the records go besides the output directory (--sink,
+--no-local-copy), how the run manifest is made (--blake3, --manifest-key-file) and where the metrics go
+(--metrics-file, --metrics-summary, --metrics-port).
+"""
+
+def add_output_arguments(parser, sink=True):
+    """
+    Adds the sink, run manifest and metrics options to an argparse parser (the sink options only if sink is set).
+    Call check_output_arguments once the arguments are parsed.
+    """
+    if sink:
+        parser.add_argument('--sink', default=None, help='Also stream the records to stdout, elasticsearch+http://host:9200/index, kafka-rest+http://host:8082/topic or kafka://brokers/topic.')
+        parser.add_argument('--no-local-copy', action='store_true', help='With --sink, only send the records to the sink instead of also writing them to the output directory.')
+    parser.add_argument('--blake3', action='store_true', help='Also record BLAKE3 digests of the files in the run manifest (requires the blake3 package).')
+    parser.add_argument('--manifest-key-file', default=None, help='File holding the key the run manifest is signed with (default: $FOR509_MANIFEST_KEY or ~/.config/for509/manifest.key).')
+    parser.add_argument('--metrics-file', default=None, help='Prometheus text file to keep updated with API latency, throttling and I/O metrics.')
+    parser.add_argument('--metrics-summary', default=None, help='JSON file to write a summary of the metrics of the run to when it ends.')
+    parser.add_argument('--metrics-port', default=None, type=int, help='Serve the metrics on http://127.0.0.1:<port>/metrics while the collection runs.')
+
+def check_output_arguments(parser, args):
+    """
+    Exits with a usage error if --no-local-copy is given without a sink, which would leave the records nowhere.
+    """
+    if getattr(args, 'no_local_copy', False) and not getattr(args, 'sink', None):
+        parser.error('--no-local-copy requires --sink')
@@ -0,0 +1,158 @@
+"""
+Checkpointed output of a CloudTrail LookupEvents walk, shared by the process and asyncio download engines.
+"""
+
+import glob, os
+from datetime import datetime, timedelta
+
+from for509 import integrity, metrics
+from for509.checkpoint import CheckpointStore, OutputFile
+from for509.dedup import SeenSet
+from for509.sinks import SinkOnlyWriter, open_sink
+from for509.writer import RollingRecordsWriter
+
+# LookupEvents only returns the last 90 days of management events
+LOOKUP_WINDOW = timedelta(days=90)
+
+# Checkpoints of LookupEvents downloads are stored under this collector name, scoped by account and region
+CHECKPOINT_COLLECTOR = 'cloudtrail-lookup'
+
+# Output files are rolled after this many events or compressed bytes, whichever comes first
+DEFAULT_OUTPUT_CONFIG = {'max_events': 100000, 'max_bytes': 64 * 1024 * 1024, 'ndjson': False, 'reserialize': False, 'dedup': True,
+                         'sink': None, 'local_copy': True}
+
+# Event IDs already written are kept under <log directory>/SEEN_DIRECTORY/<account>_<region>
+SEEN_DIRECTORY = '.seen'
+
+def event_ids(events):
+    return [event['EventId'] for event in events]
+
+def encode_page(events, encode):
+    """
+    Returns the JSON records of a page of LookupEvents events, timing the encoding as serialization.
+    """
+    with metrics.timer('for509_serialize_seconds', collector='cloudtrail'):
+        return [encode(event) for event in events]
+
+class RegionOutput(object):
+    """
+    Output files and resume state of one account/region download.
+
+    On creation the checkpoint is loaded and any .part file left by a crash is either completed (if its checkpoint was
+    committed) or discarded. write() records the cursor as of the page being written, and every time the rolling writer
+    finishes a file that cursor is committed to the checkpoint store together with the file. Written events and
+    bytes are added to the optional progress counter.
+
+    With dedup set in output_config, events whose ID was written before (by an earlier run into the same directory,
+    or an overlapping slice) are dropped. The IDs of a file are added to the seen set when its checkpoint is committed.
+
+    With a sink URL in output_config (see for509.sinks) records are also streamed to the sink, which is flushed before
+    every checkpoint commit. Without local_copy they only go to the sink, and the checkpoint is committed every
+    max_events events.
+
+    Files are hashed as they are written and recorded in the run's manifest (see for509.integrity), if there is one.
+    """
+
+    def __init__(self, checkpoint_db, account_id, region_name, log_directory, output_config=None, progress=None):
+        self.account_id = account_id
+        self.region_name = region_name
+        self.scope = f'{account_id}:{region_name}'
+        self.store = CheckpointStore(checkpoint_db)
+        self.progress = progress
+
+        checkpoint = self.store.load(CHECKPOINT_COLLECTOR, self.scope)
+        self.done = checkpoint is not None and checkpoint.done
+        self.is_resumed = checkpoint is not None
+        self.cursor = checkpoint.cursor if self.is_resumed else {}
+        self.events = checkpoint.events if self.is_resumed else 0
+        if progress is not None:
+            progress.set_events(self.events)
+        self.seen = None
+        self.sink = None
+        if self.done:
+            return
+
+        recorded_outputs = set(output.path for output in checkpoint.outputs) if self.is_resumed else set()
+        for part_filename in glob.glob(os.path.join(log_directory, f'{account_id}_CloudTrail_{region_name}_*.gz.part')):
+            if part_filename[:-len('.part')] in recorded_outputs:
+                os.replace(part_filename, part_filename[:-len('.part')])
+            else:
+                os.remove(part_filename)
+
+        output_config = output_config or DEFAULT_OUTPUT_CONFIG
+        if output_config.get('dedup'):
+            self.seen = SeenSet(os.path.join(log_directory, SEEN_DIRECTORY, f'{account_id}_{region_name}'))
+            # The IDs describe the files of earlier runs: if those are gone, so are the events
+            if output_config.get('local_copy', True) and not self.is_resumed and not glob.glob(os.path.join(log_directory, f'{account_id}_CloudTrail_{region_name}_*')):
+                self.seen.reset()
+        if output_config.get('sink'):
+            self.sink = open_sink(output_config['sink'], 'cloudtrail')
+        if not output_config.get('local_copy', True):
+            self.writer = SinkOnlyWriter(output_config['max_events'], on_close=self._commit_file)
+            return
+        timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
+        extension = 'ndjson.gz' if output_config['ndjson'] else 'json.gz'
+        self.writer = RollingRecordsWriter(
+            lambda file_index: os.path.join(log_directory, f'{account_id}_CloudTrail_{region_name}_{timestamp}_{file_index}.{extension}'),
+            first_index=self.events,
+            max_events=output_config['max_events'],
+            max_bytes=output_config['max_bytes'],
+            ndjson=output_config['ndjson'],
+            on_close=self._commit_file,
+            hash_algorithms=integrity.algorithms()
+        )
+
+    def _commit_file(self, filename, file_events, size):
+        # filename is None when there is no local copy
+        if self.sink is not None:
+            self.sink.flush()
+        outputs = [OutputFile(filename, size, file_events)] if filename is not None else []
+        self.store.commit(CHECKPOINT_COLLECTOR, self.scope, self.cursor, self.events, outputs)
+        if self.seen is not None:
+            self.seen.commit()
+        if filename is not None:
+            metrics.inc('for509_bytes_out_total', size, collector='cloudtrail')
+            integrity.record(filename, size, self.writer.digests, collector='cloudtrail', account=self.account_id,
+                             region=self.region_name, events=file_events)
+
+    def write(self, records, cursor, events, ids=None):
+        """
+        Writes encoded records. cursor and events describe the download state once these records are written. ids are
+        the event IDs of the records, for deduplication.
+        """
+        if self.seen is not None and ids is not None:
+            kept = [(record, event_id) for record, event_id in zip(records, ids) if self.seen.add(event_id)]
+            if len(kept) < len(records):
+                metrics.inc('for509_duplicates_total', len(records) - len(kept), collector='cloudtrail')
+                records = [record for record, _ in kept]
+                ids = [event_id for _, event_id in kept]
+        if self.sink is not None:
+            self.sink.send(records, ids)
+        self.cursor = cursor
+        self.events = events
+        size = sum(len(record) for record in records)
+        if self.progress is not None:
+            self.progress.add(len(records), size)
+        metrics.inc('for509_events_total', len(records), collector='cloudtrail')
+        metrics.inc('for509_bytes_in_total', size, collector='cloudtrail')
+        # Compression, and closing and committing a file when it is full
+        with metrics.timer('for509_write_seconds', collector='cloudtrail'):
+            return self.writer.write(records)
+
+    def finish(self, cursor):
+        """
+        Closes the last file and marks the region complete.
+        """
+        self.cursor = cursor
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.flush()
+        self.store.commit(CHECKPOINT_COLLECTOR, self.scope, cursor, self.events, done=True)
+        self.close()
+
+    def close(self):
+        self.store.close()
+        if self.seen is not None:
+            self.seen.close()
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,212 @@
+"""
+asyncio engine for CloudTrail LookupEvents downloads. Every account/region walk runs as a coroutine in a single
+process on aiobotocore clients, instead of one Python process (with its own boto3 import, session and clients) per
+region. Requires the optional aiobotocore package.
+"""
+
+import asyncio, threading
+from concurrent.futures import CancelledError
+from datetime import datetime, timezone
+
+from aiobotocore.config import AioConfig
+from aiobotocore.credentials import AioRefreshableCredentials
+from aiobotocore.session import get_session
+from botocore.exceptions import HTTPClientError
+
+from for509.aws import assume_role
+from for509.cloudtrail import RegionOutput, LOOKUP_WINDOW, encode_page, event_ids
+from for509.progress import ProgressCounter
+from for509.ratelimit import AsyncTokenBucket, async_call_with_backoff
+
+# Pages waiting to be written per region. The walk pauses once its writer falls this far behind
+PAGE_QUEUE_SIZE = 8
+# Connection pool of each region's client. A client is tied to one regional endpoint and one account's credentials,
+# so it serves a single walk, which has one LookupEvents call in flight at a time
+CONNECTIONS_PER_REGION = 2
+
+class RegionTask(object):
+    """
+    Handle on a region download running in the engine, with the parts of the multiprocessing.Process interface
+    the download monitor uses (exitcode, join, terminate).
+    """
+
+    def __init__(self, future, limiter, progress):
+        self.future = future
+        self.limiter = limiter
+        self.progress = progress
+
+    @property
+    def exitcode(self):
+        if not self.future.done():
+            return None
+        if self.future.cancelled() or self.future.exception() is not None:
+            return 1
+        return 0
+
+    def join(self):
+        try:
+            self.future.result()
+        except (CancelledError, Exception):
+            pass
+
+    def terminate(self):
+        self.future.cancel()
+
+class AsyncEngine(object):
+    """
+    Runs region downloads as coroutines on an event loop in a background thread. submit() can be called from any
+    thread and returns a RegionTask. At most max_concurrency regions are walked at the same time; further submissions
+    wait for a free slot, so callers can submit every region up front. encode turns a LookupEvents event into the JSON record to write. Completion is reported
+    through queue and progress through each task's ProgressCounter, exactly like the process engine does.
+    """
+
+    def __init__(self, log_directory, queue, checkpoint_db, encode, output_config=None, max_concurrency=64):
+        self.log_directory = log_directory
+        self.encode = encode
+        self.queue = queue
+        self.checkpoint_db = checkpoint_db
+        self.output_config = output_config
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._sessions = {}  # One aiobotocore session per account, shared by its regions
+        self._account_ids = {}  # Account ID of each session, looked up once rather than by every region
+        self._semaphore = None
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._init(), self.loop).result()
+        return self
+
+    async def _init(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def stop(self):
+        # Downloads still running are cancelled and allowed to unwind, so their outputs are closed before the loop stops
+        asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, session_params, region_name, rate=2.0):
+        """
+        Starts downloading region_name for the account described by session_params (the same dictionary the process
+        engine passes to regionDownload).
+        """
+        limiter = AsyncTokenBucket(rate=rate)
+        progress = ProgressCounter()
+        future = asyncio.run_coroutine_threadsafe(self.region_download(session_params, region_name, limiter, progress), self.loop)
+        return RegionTask(future, limiter, progress)
+
+    @staticmethod
+    def _session_key(session_params):
+        return session_params.get('role_arn') or session_params['aws_access_key_id']
+
+    def _session(self, session_params):
+        key = self._session_key(session_params)
+        if key not in self._sessions:
+            session = get_session()
+            if session_params.get('role_arn'):
+                role_arn, external_id = session_params['role_arn'], session_params.get('external_id')
+
+                async def refresh():
+                    # AssumeRole is a single call every hour or so, so the blocking boto3 version is good enough
+                    return await asyncio.to_thread(assume_role, session_params, role_arn, external_id)
+
+                session._credentials = AioRefreshableCredentials.create_from_metadata(
+                    metadata=session_params.get('role_credentials') or assume_role(session_params, role_arn, external_id),
+                    refresh_using=refresh, method='sts-assume-role')
+            else:
+                session.set_credentials(session_params['aws_access_key_id'], session_params['aws_secret_access_key'],
+                                        session_params['aws_session_token'])
+            self._sessions[key] = session
+        return self._sessions[key]
+
+    async def region_download(self, session_params, region_name, limiter, progress):
+        """
+        Sequential NextToken walk of one region. Pages are handed to a writer task through a bounded queue so that
+        compression and file I/O (run on a worker thread) overlap with the next LookupEvents call.
+        """
+        async with self._semaphore:
+            session = self._session(session_params)
+            # Retries are handled by async_call_with_backoff so that throttling slows down the limiter
+            config = AioConfig(retries={'total_max_attempts': 1}, max_pool_connections=CONNECTIONS_PER_REGION)
+            async with session.create_client('cloudtrail', region_name=region_name, config=config) as client:
+                account_id = session_params.get('account_id') or self._account_ids.get(self._session_key(session_params))
+                if not account_id:
+                    async with session.create_client('sts', region_name=region_name) as sts:
+                        account_id = (await sts.get_caller_identity())['Account']
+                    self._account_ids[self._session_key(session_params)] = account_id
+
+                output = await asyncio.to_thread(RegionOutput, self.checkpoint_db, account_id, region_name, self.log_directory, self.output_config, progress)
+                if output.done:
+                    output.close()
+                    self.queue.put([account_id, region_name, 'done', True])
+                    return
+                if output.cursor.get('Slices') is not None:
+                    output.close()
+                    raise ValueError(f'{account_id}:{region_name} has a sliced checkpoint, resume it with the process engine')
+
+                pages = asyncio.Queue(PAGE_QUEUE_SIZE)
+                writer = asyncio.create_task(self._write_pages(output, pages))
+                try:
+                    next_token = output.cursor.get('NextToken')
+                    window_start = datetime.now(timezone.utc) - LOOKUP_WINDOW
+                    while True:
+                        lookup_args = {'LookupAttributes': [], 'MaxResults': 50}
+                        if next_token:
+                            lookup_args['NextToken'] = next_token
+                        page = await async_call_with_backoff(limiter, client.lookup_events, retry_on=(HTTPClientError,), metric='cloudtrail:LookupEvents', **lookup_args)
+                        next_token = page.get('NextToken')
+                        if page['Events']:
+                            await self._put(pages, (encode_page(page['Events'], self.encode), event_ids(page['Events']), next_token), writer)
+                            progress.set_remaining(max(0, (page['Events'][-1]['EventTime'] - window_start).total_seconds()))
+                        if not next_token:
+                            break
+                    await self._put(pages, None, writer)
+                    await writer
+                except BaseException:
+                    # The writer only stops once its current write is over: closing the output under it would close
+                    # the checkpoint store and the open file while that write is still using them
+                    writer.cancel()
+                    await asyncio.gather(writer, return_exceptions=True)
+                    output.close()
+                    raise
+                self.queue.put([account_id, region_name, 'done', output.is_resumed])
+
+    async def _put(self, pages, item, writer):
+        # A writer that failed stops reading the queue, so its error is raised here instead of waiting on a full queue
+        put = asyncio.ensure_future(pages.put(item))
+        await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            writer.result()
+
+    async def _write_pages(self, output, pages):
+        """
+        Writes queued pages in order and commits the region as done after the last one.
+        """
+        total_logs = output.events
+        while True:
+            item = await pages.get()
+            if item is None:
+                break
+            records, ids, next_token = item
+            total_logs += len(records)
+            await self._in_thread(output.write, records, {'NextToken': next_token}, total_logs, ids)
+        await self._in_thread(output.finish, {'NextToken': None})
+
+    @staticmethod
+    async def _in_thread(func, *args):
+        # Cancelling a task does not stop the thread it is waiting on, so a cancelled call waits for the thread first
+        call = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            await asyncio.gather(call, return_exceptions=True)
+            raise
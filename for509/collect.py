@@ -0,0 +1,94 @@
+"""
+Single entry point for multi-cloud collection: runs every job of a JSON configuration file at the same time, under
+one global concurrency and bandwidth budget.
+
+    python -m for509.collect --config jobs.json
+
+Example jobs.json (options of each job are those of its collector, see for509/plugins):
+
+    {
+        "output_directory": "/cases/incident-42",
+        "max_concurrency": 32,
+        "max_bandwidth_mb": 50,
+        "jobs": [
+            {"collector": "cloudtrail", "name": "aws-org", "organization": true},
+            {"collector": "cloudtrail-s3", "name": "aws-trail", "bucket": "org-trail-logs", "start": "2023-01-01"},
+            {"collector": "azure-blob", "name": "azure", "accounts_file": "storage_accounts.txt"},
+            {"collector": "gws", "name": "workspace", "creds_path": "creds.json", "delegated_creds": "admin@example.com",
+             "sink": "elasticsearch+http://localhost:9200/workspace"}
+        ]
+    }
+
+Each job writes to <output directory>/<job name>; all jobs share one checkpoint database, so an interrupted run is
+resumed by running the same command again. Every collector takes a "sink" option (see for509.sinks) to stream its
+records downstream as well, and "local_copy": false to only send them there. The digests of every file the jobs write
+are recorded in a signed manifest in the output directory (see for509.integrity).
+"""
+
+import argparse, json, logging, os, sys, time
+
+from for509 import integrity, metrics
+from for509.cli import add_output_arguments
+from for509.collector import COLLECTORS, Engine
+from for509.progress import format_bytes
+from for509.sinks import STDOUT_URLS
+
+def read_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    if not config.get('jobs'):
+        raise ValueError(f'{path} has no jobs')
+    return config
+
+def main(args):
+    if args.list_collectors:
+        for name, path in sorted(COLLECTORS.items()):
+            print(f'{name}: {path}')
+        return
+
+    config = read_config(args.config)
+    output_directory = args.output_directory or config.get('output_directory')
+    if not output_directory:
+        sys.exit('No output directory: use --output-directory or set output_directory in the configuration')
+    os.makedirs(output_directory, exist_ok=True)
+    max_concurrency = args.max_concurrency or config.get('max_concurrency', 32)
+    max_bandwidth_mb = args.max_bandwidth_mb or config.get('max_bandwidth_mb')
+
+    # The collectors log as they go; that goes to a file so it does not draw over the progress display
+    logging.basicConfig(filename=os.path.join(output_directory, 'collect.log'), format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO)
+
+    engine = Engine(output_directory, args.checkpoint_db or config.get('checkpoint_db'), max_concurrency,
+                    max_bandwidth_mb * 1024 * 1024 if max_bandwidth_mb else None)
+    for index, job in enumerate(config['jobs']):
+        options = dict(job)
+        collector_name = options.pop('collector')
+        engine.add_job(options.pop('name', f'{collector_name}-{index}'), collector_name, options)
+
+    # Standard output carries the records if a job sends them there
+    out = sys.stderr if any(job.get('sink') in STDOUT_URLS for job in config['jobs']) else sys.stdout
+
+    start_time = time.time()
+    exporter = metrics.MetricsExporter(args.metrics_file, args.metrics_summary, args.metrics_port).start()
+    manifest = integrity.RunManifest(output_directory, 'collect', args.blake3, args.manifest_key_file)
+    try:
+        results = engine.run('Collecting logs', stream=out)
+    finally:
+        exporter.close()
+        print(f'Manifest: {manifest.close()}', file=out)
+    for name, (events, size, failures) in results.items():
+        print(f'{name}: {events} events, {format_bytes(size)}, {failures} failed', file=out)
+    print(f'Total: {sum(result[0] for result in results.values())} events, '
+          f'{format_bytes(sum(result[1] for result in results.values()))} in {int(time.time() - start_time)} seconds.', file=out)
+    if any(result[2] for result in results.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run collection jobs across AWS, Azure and Google Workspace in one process.')
+    parser.add_argument('--config', '-c', default='jobs.json', help='JSON file listing the jobs to run.')
+    parser.add_argument('--output-directory', default=None, help='Directory the jobs write to, one subdirectory per job (overrides the configuration).')
+    parser.add_argument('--checkpoint-db', default=None, help='SQLite checkpoint database shared by all jobs (default: checkpoints.sqlite in the output directory).')
+    parser.add_argument('--max-concurrency', default=None, type=int, help='Tasks running at the same time across all jobs (default 32).')
+    parser.add_argument('--max-bandwidth-mb', default=None, type=float, help='Combined download rate of all jobs, in MB/s (default: unlimited).')
+    add_output_arguments(parser, sink=False)
+    parser.add_argument('--list-collectors', action='store_true', help='List the built in collectors and exit.')
+    main(parser.parse_args())
@@ -0,0 +1,198 @@
+"""
+Collector plugin interface and the engine that runs collection jobs across clouds.
+
+A collector turns one job (an AWS account, a set of storage accounts, a Google Workspace tenant...) into tasks: an
+account/region, a blob, a GWS application. The engine runs the tasks of every job on one pool of worker threads,
+taking turns between jobs, under a global concurrency and bandwidth budget, and shows their progress.
+"""
+
+import importlib, logging, os, threading, time
+
+from for509.checkpoint import default_checkpoint_db
+from for509.progress import ProgressCounter, RateMeter, format_bytes, open_display
+from for509.ratelimit import BandwidthLimiter
+from for509.scheduler import FairQueue
+
+# Built in collectors, imported only when a job uses them so that each cloud's SDK is only needed for its own jobs
+COLLECTORS = {
+    'cloudtrail': 'for509.plugins.cloudtrail:CloudTrailCollector',
+    'cloudtrail-s3': 'for509.plugins.cloudtrail_s3:CloudTrailS3Collector',
+    'azure-blob': 'for509.plugins.azure_blob:AzureBlobCollector',
+    'gws': 'for509.plugins.gws:GWSCollector',
+}
+
+def load_collector(name):
+    """
+    Returns the collector class registered as name, or named by a 'package.module:Class' path for external plugins.
+    """
+    path = COLLECTORS.get(name, name)
+    if ':' not in path:
+        raise ValueError(f'Unknown collector {name!r}, expected one of {", ".join(sorted(COLLECTORS))} or module:Class')
+    module_name, class_name = path.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+class CollectionContext(object):
+    """
+    What the engine gives a collector: where to write, the checkpoint database shared by all jobs, and account(),
+    through which tasks report the events and bytes they collected.
+    """
+
+    def __init__(self, output_directory, checkpoint_db, bandwidth=None):
+        self.output_directory = output_directory
+        self.checkpoint_db = checkpoint_db
+        self.bandwidth = bandwidth
+        self.progress = ProgressCounter()
+        self._lock = threading.Lock()
+
+    def account(self, events, size):
+        """
+        Adds to the job's counters, then waits if the run is over its bandwidth budget.
+        """
+        with self._lock:
+            self.progress.add(events, size)
+        if self.bandwidth is not None and size:
+            self.bandwidth.consume(size)
+
+class TaskProgress(object):
+    """
+    ProgressCounter look-alike handed to existing download functions, forwarding what they write to the job's context.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    def add(self, events, size):
+        self.context.account(events, size)
+
+    def set_events(self, events):
+        pass
+
+    def set_remaining(self, remaining):
+        pass
+
+class Collector(object):
+    """
+    Base class of collector plugins. options is the job's configuration (a dict), merged over DEFAULT_OPTIONS.
+
+    tasks() may be a generator: it runs on a thread of its own and is only drawn from as fast as tasks are completed,
+    so listing and collecting overlap. run_task() is called concurrently from the engine's workers and should report
+    what it collects through context.account(). finish() runs once after the last task.
+    """
+
+    name = None
+    DEFAULT_OPTIONS = {}
+
+    def __init__(self, options, context):
+        self.options = dict(self.DEFAULT_OPTIONS, **options)
+        self.context = context
+
+    def tasks(self):
+        raise NotImplementedError
+
+    def run_task(self, task):
+        raise NotImplementedError
+
+    def describe(self, task):
+        return str(task)
+
+    def finish(self):
+        pass
+
+class Engine(object):
+    """
+    Runs the tasks of several collectors on max_concurrency worker threads, taking turns between jobs. If
+    bytes_per_second is set, the bytes all jobs report are held to that rate.
+    """
+
+    def __init__(self, output_directory, checkpoint_db=None, max_concurrency=32, bytes_per_second=None, queue_size=1000):
+        self.output_directory = output_directory
+        self.checkpoint_db = checkpoint_db or default_checkpoint_db(output_directory)
+        self.max_concurrency = max_concurrency
+        self.bandwidth = BandwidthLimiter(bytes_per_second) if bytes_per_second else None
+        self.queue = FairQueue(queue_size)
+        self.jobs = {}  # Collector of each job name
+        self.failures = {}  # Failed task count of each job name
+        self._lock = threading.Lock()
+
+    def add_job(self, name, collector_name, options):
+        """
+        Creates the collector for a job. Its files go to <output directory>/<job name>.
+        """
+        output_directory = os.path.join(self.output_directory, name)
+        os.makedirs(output_directory, exist_ok=True)
+        context = CollectionContext(output_directory, self.checkpoint_db, self.bandwidth)
+        self.jobs[name] = load_collector(collector_name)(options, context)
+        self.failures[name] = 0
+        return self.jobs[name]
+
+    def _failed(self, name):
+        with self._lock:
+            self.failures[name] += 1
+
+    def _feed(self, name, collector):
+        try:
+            for task in collector.tasks():
+                if not self.queue.put(name, task):
+                    return
+        except Exception:
+            logging.exception(f'{name}: listing tasks failed')
+            self._failed(name)
+        finally:
+            self.queue.close(name)
+
+    def _work(self):
+        while True:
+            work = self.queue.get()
+            if work is None:
+                return
+            name, task = work
+            collector = self.jobs[name]
+            try:
+                collector.run_task(task)
+            except Exception as e:
+                logging.error(f'{name}: {collector.describe(task)} failed: {e}')
+                self._failed(name)
+
+    def run(self, title='Collecting logs', sample_interval=1.0, stream=None):
+        """
+        Runs every job to completion (or until q is pressed) and returns {job name: (events, bytes, failed tasks)}.
+        Progress is shown on stream (see open_display).
+        """
+        threads = []
+        for name, collector in self.jobs.items():
+            self.queue.open(name)
+            threads.append(threading.Thread(target=self._feed, args=(name, collector), daemon=True))
+        workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.max_concurrency)]
+        for thread in threads + workers:
+            thread.start()
+
+        display = open_display(title, stream)
+        meter = RateMeter()
+        start_time = time.time()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for name, collector in self.jobs.items():
+                    progress = collector.context.progress
+                    events_rate, bytes_rate, _ = meter.sample(name, progress)
+                    display.set_row(name, f'{name}: {progress.events} events, {format_bytes(progress.bytes)}, '
+                                          f'{events_rate:.0f} events/s, {format_bytes(bytes_rate)}/s, {self.failures[name]} failed')
+                display.set_status(f'Elapsed: {int(time.time() - start_time)}s')
+                display.refresh()
+                if display.quit_requested():
+                    display.set_status('Exiting...')
+                    display.refresh()
+                    self.queue.cancel()
+                    break
+                for worker in workers:
+                    worker.join(timeout=sample_interval / len(workers))
+            # Tasks already started are allowed to finish so their checkpoints stay consistent
+            for worker in workers:
+                worker.join()
+        finally:
+            display.close()
+
+        results = {}
+        for name, collector in self.jobs.items():
+            collector.finish()
+            results[name] = (collector.context.progress.events, collector.context.progress.bytes, self.failures[name])
+        return results
@@ -0,0 +1,445 @@
+"""
+Columnar copy of collected logs for fast triage queries.
+
+convert streams the output of the collectors (CloudTrail {"Records":[...]} and NDJSON files, Azure diagnostic log
+blobs, GWS {app}_logs.json files) into Parquet files partitioned by source, account, region and day, e.g.
+source=cloudtrail/account=123456789012/region=us-east-1/day=2024-01-15/part-....parquet. Every record keeps its
+original JSON in the raw column, next to normalized fields common to all sources. For GWS the region is the
+application, for Azure the location of the resource.
+
+An SQLite index next to the Parquet files records the time range of each file and the principals, access keys and IP
+addresses in it, so a query only opens the files that can match and filters them with predicate pushdown on the
+Parquet row group statistics. Requires the optional pyarrow package.
+"""
+
+import gzip, logging, os, re, sqlite3, uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from for509 import fastjson
+from for509.writer import _zstandard
+
+# Normalized columns of every row, in file order
+COLUMNS = ['event_time', 'event_name', 'event_source', 'principal', 'access_key_id', 'source_ip', 'user_agent', 'event_id', 'raw']
+# Directory levels of the Parquet files
+PARTITION_COLUMNS = ['source', 'account', 'region', 'day']
+# Columns whose values are recorded in the index for each file
+INDEXED_COLUMNS = ['principal', 'access_key_id', 'source_ip']
+
+INDEX_FILE = 'index.sqlite'
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    source TEXT NOT NULL,
+    account TEXT NOT NULL,
+    region TEXT NOT NULL,
+    day TEXT NOT NULL,
+    min_time REAL NOT NULL,
+    max_time REAL NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_keys (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    file_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_keys_value ON file_keys (kind, value);
+CREATE TABLE IF NOT EXISTS inputs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    converted REAL NOT NULL
+);
+'''
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute, pyarrow.dataset, pyarrow.parquet
+    except ImportError:
+        raise ImportError('Columnar conversion requires the pyarrow package (pip install pyarrow)')
+    return pyarrow
+
+def arrow_schema(partitions=False):
+    """
+    Arrow schema of the Parquet files, plus the partition columns if partitions is set.
+    """
+    pa = _pyarrow()
+    fields = [('event_time', pa.timestamp('us', tz='UTC'))] + [(name, pa.string()) for name in COLUMNS[1:]]
+    if partitions:
+        fields += [(name, pa.string()) for name in PARTITION_COLUMNS]
+    return pa.schema(fields)
+
+_FRACTION = re.compile(r'\.(\d+)')
+
+def parse_time(value):
+    """
+    Parses the ISO 8601 timestamps of all three sources (Z suffix, Azure's 7 digit fractions, plain dates) as UTC.
+    """
+    value = value.replace('Z', '+00:00')
+    match = _FRACTION.search(value)
+    if match and len(match.group(1)) != 6:
+        value = value[:match.start(1)] + match.group(1)[:6].ljust(6, '0') + value[match.end(1):]
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def _strip_port(address):
+    # Azure storage logs give the caller as 203.0.113.10:50432 (IPv6 addresses have more than one colon)
+    if address and address.count(':') == 1:
+        return address.split(':')[0]
+    return address
+
+def normalize_cloudtrail(record, account, region):
+    identity = record.get('userIdentity') or {}
+    return {
+        'account': record.get('recipientAccountId') or identity.get('accountId') or account,
+        'region': record.get('awsRegion') or region,
+        'event_time': parse_time(record['eventTime']),
+        'event_name': record.get('eventName'),
+        'event_source': record.get('eventSource'),
+        'principal': identity.get('arn') or identity.get('principalId') or identity.get('userName') or identity.get('invokedBy'),
+        'access_key_id': identity.get('accessKeyId'),
+        'source_ip': record.get('sourceIPAddress'),
+        'user_agent': record.get('userAgent'),
+        'event_id': record.get('eventID'),
+    }
+
+_SUBSCRIPTION = re.compile(r'/SUBSCRIPTIONS/([^/]+)', re.IGNORECASE)
+_UPN_CLAIM = 'http://schemas.xmlsoap.org/ws/2005/05/identity/claims/upn'
+
+def normalize_azure(record, account, region):
+    properties = record.get('properties') if isinstance(record.get('properties'), dict) else {}
+    identity = record.get('identity')
+    if isinstance(identity, dict):
+        # Activity logs carry the token claims, storage logs the requester
+        principal = (identity.get('claims') or {}).get(_UPN_CLAIM) or ((identity.get('requester') or {}).get('upn'))
+    else:
+        principal = identity
+    principal = (principal or properties.get('userPrincipalName') or properties.get('servicePrincipalName')
+                 or ((properties.get('initiatedBy') or {}).get('user') or {}).get('userPrincipalName'))
+    subscription = _SUBSCRIPTION.search(record.get('resourceId') or '')
+    return {
+        'account': subscription.group(1).lower() if subscription else record.get('tenantId') or account,
+        'region': record.get('location') or region or 'global',
+        'event_time': parse_time(record.get('time') or record['timeGenerated']),
+        'event_name': record.get('operationName'),
+        'event_source': record.get('category'),
+        'principal': principal,
+        'access_key_id': None,
+        'source_ip': _strip_port(record.get('callerIpAddress') or properties.get('ipAddress')),
+        'user_agent': properties.get('userAgent'),
+        'event_id': record.get('correlationId'),
+    }
+
+def normalize_gws(record, account, region):
+    identifier = record.get('id') or {}
+    actor = record.get('actor') or {}
+    return {
+        'account': identifier.get('customerId') or account,
+        'region': identifier.get('applicationName') or region,
+        'event_time': parse_time(identifier['time']),
+        'event_name': ','.join(event['name'] for event in record.get('events') or [] if event.get('name')) or None,
+        'event_source': identifier.get('applicationName'),
+        'principal': actor.get('email') or actor.get('profileId'),
+        'access_key_id': None,
+        'source_ip': record.get('ipAddress'),
+        'user_agent': None,
+        'event_id': identifier.get('uniqueQualifier'),
+    }
+
+NORMALIZERS = {'cloudtrail': normalize_cloudtrail, 'azure': normalize_azure, 'gws': normalize_gws}
+
+# <account>_CloudTrail_<region>_... files of regionDownload and of trail buckets, and <app>_logs.json of gws-get-logs.py
+_CLOUDTRAIL_FILE = re.compile(r'^(\d{12})_CloudTrail_([a-z0-9-]+)_.*\.(nd)?json(\.gz)?$')
+_GWS_FILE = re.compile(r'^([a-z_]+)_logs\.json(\.gz|\.zst)?$')
+
+def find_inputs(directory):
+    """
+    Yields (path, source, account, region, compression) for every collector output file under directory.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            cloudtrail = _CLOUDTRAIL_FILE.match(name)
+            gws = _GWS_FILE.match(name)
+            if cloudtrail:
+                yield path, 'cloudtrail', cloudtrail.group(1), cloudtrail.group(2), 'gzip' if cloudtrail.group(4) else None
+            elif gws:
+                yield path, 'gws', '', gws.group(1), {'.gz': 'gzip', '.zst': 'zstd'}.get(gws.group(2))
+            elif name.endswith('.json') and ('resourceId=' in path or name == 'PT1H.json'):
+                # Records of some categories have no resourceId, the blob path always has it
+                subscription = _SUBSCRIPTION.search(path)
+                yield path, 'azure', subscription.group(1).lower() if subscription else '', '', None
+
+@contextmanager
+def _open_binary(path, compression, offset=0):
+    # Yields the raw file and the stream of its content. Compressed files are appended to a gzip member or zstd
+    # frame at a time, so offset is always a member boundary
+    with open(path, 'rb') as raw:
+        raw.seek(offset)
+        if compression == 'gzip':
+            yield raw, gzip.GzipFile(fileobj=raw)
+        elif compression == 'zstd':
+            yield raw, _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            yield raw, raw
+
+def read_records(path, source, compression, offset=0, position=None):
+    """
+    Yields (JSON text, parsed record) for each record of a collector output file, from offset onwards. If position
+    is a dict, position['offset'] is kept at the offset the file has been read up to: the end of the last record of a
+    plain file (a last line without its newline that does not parse is still being written, and left for later), or
+    the end of the file once a compressed one has been read to its end.
+    """
+    if position is not None:
+        position['offset'] = offset
+    with _open_binary(path, compression, offset) as (raw, stream):
+        if source == 'cloudtrail' and '.ndjson' not in path:
+            records = fastjson.loads(stream.read())['Records']
+            if position is not None:
+                position['offset'] = raw.tell()
+            for record in records:
+                yield fastjson.dumps(record), record
+            return
+        for line in stream:
+            size = len(line)
+            complete = line.endswith(b'\n')
+            line = line.strip()
+            if line:
+                try:
+                    record = fastjson.loads(line)
+                except ValueError:
+                    if compression is None and not complete:
+                        break
+                    raise
+            if compression is None and position is not None:
+                position['offset'] += size
+            if not line:
+                continue
+            if isinstance(record.get('records'), list):
+                # Older Azure diagnostic logs wrap the records of a blob in a single {"records":[...]} object
+                for inner in record['records']:
+                    yield fastjson.dumps(inner), inner
+            else:
+                yield line.decode('utf-8'), record
+        if compression is not None and position is not None:
+            position['offset'] = raw.tell()
+
+def _partition_value(value):
+    return re.sub(r'[/=\\]', '_', value) if value else 'unknown'
+
+class ColumnarIndex(object):
+    """
+    SQLite index of the Parquet files of a columnar directory, and of the input files converted into them.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(INDEX_SCHEMA)
+
+    def converted_size(self, path):
+        """
+        Size the input file had when it was last converted, or 0.
+        """
+        row = self._conn.execute('SELECT size FROM inputs WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else 0
+
+    def add(self, files, inputs):
+        """
+        Records new Parquet files and the input sizes they cover in one transaction. files are (path, partition,
+        min_time, max_time, rows, {kind: values}) tuples, inputs (path, size) pairs.
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            for path, partition, min_time, max_time, rows, keys in files:
+                file_id = self._conn.execute(
+                    'INSERT INTO files (path, source, account, region, day, min_time, max_time, rows) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path,) + tuple(partition) + (min_time, max_time, rows)).lastrowid
+                self._conn.executemany('INSERT INTO file_keys (kind, value, file_id) VALUES (?, ?, ?)',
+                                       [(kind, value, file_id) for kind, values in keys.items() for value in values])
+            self._conn.executemany('INSERT OR REPLACE INTO inputs (path, size, converted) VALUES (?, ?, ?)',
+                                   [(path, size, datetime.now().timestamp()) for path, size in inputs])
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def find_files(self, start=None, end=None, partitions=None, keys=None):
+        """
+        Returns the paths of the files that can hold rows between start and end (datetimes), in the partitions given
+        ({column: value}) and with every {kind: pattern} of keys, where a pattern may use * as a wildcard.
+        """
+        conditions, parameters = [], []
+        if start is not None:
+            conditions.append('max_time >= ?')
+            parameters.append(start.timestamp())
+        if end is not None:
+            conditions.append('min_time <= ?')
+            parameters.append(end.timestamp())
+        for column, value in (partitions or {}).items():
+            conditions.append(f'{column} = ?')
+            parameters.append(value)
+        for kind, pattern in (keys or {}).items():
+            operator = 'LIKE' if '*' in pattern else '='
+            conditions.append(f'id IN (SELECT file_id FROM file_keys WHERE kind = ? AND value {operator} ?)')
+            parameters += [kind, pattern.replace('*', '%') if '*' in pattern else pattern]
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return [row[0] for row in self._conn.execute(f'SELECT path FROM files{where} ORDER BY min_time', parameters)]
+
+    def close(self):
+        self._conn.close()
+
+class ColumnarConverter(object):
+    """
+    Converts collector output files into the Parquet files and index of output_directory. Records are buffered per
+    partition and written out, sorted by time, once max_buffered_rows are held; only then are the input files
+    recorded as converted, together with the new files. Inputs converted before are skipped, and files that grew
+    since (GWS logs updated in place, Azure blobs of the current hour) are converted from where they left off.
+    """
+
+    def __init__(self, output_directory, max_buffered_rows=100000, compression='zstd'):
+        self.pa = _pyarrow()
+        self.output_directory = output_directory
+        self.max_buffered_rows = max_buffered_rows
+        self.compression = compression
+        os.makedirs(output_directory, exist_ok=True)
+        self.index = ColumnarIndex(os.path.join(output_directory, INDEX_FILE))
+        self.schema = arrow_schema()
+        self.run_id = datetime.now().strftime('%Y%m%dT%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.buffers = {}  # Rows of each (source, account, region, day) partition
+        self.buffered_rows = 0
+        self.pending_inputs = []  # (path, offset read up to) of inputs whose rows are all written once the buffers are flushed
+        self.stats = Counter()
+
+    def convert(self, input_directory):
+        for path, source, account, region, compression in find_inputs(input_directory):
+            path = os.path.abspath(path)
+            size = os.path.getsize(path)
+            offset = self.index.converted_size(path)
+            if offset == size:
+                self.stats['unchanged'] += 1
+                continue
+            if offset > size or (offset and source == 'cloudtrail' and '.ndjson' not in path):
+                logging.warning(f'{path} was rewritten since it was converted, convert it into a new directory')
+                self.stats['rewritten'] += 1
+                continue
+            end = self._convert_file(path, source, account, region, compression, offset)
+            if end is None:
+                continue
+            self.pending_inputs.append((path, end))
+            self.stats['files'] += 1
+            if self.buffered_rows >= self.max_buffered_rows:
+                self.flush()
+        return self.stats
+
+    def _convert_file(self, path, source, account, region, compression, offset):
+        """
+        Buffers the rows of an input file from offset onwards and returns the offset it was read up to, or None if
+        it could not be read, in which case none of its rows are kept and it is left to be converted again.
+        """
+        normalize = NORMALIZERS[source]
+        buffered = dict((partition, len(rows)) for partition, rows in self.buffers.items())
+        position = {}
+        try:
+            for raw, record in read_records(path, source, compression, offset, position):
+                try:
+                    row = normalize(record, account, region)
+                except (KeyError, ValueError, TypeError, AttributeError):
+                    self.stats['unparsed'] += 1
+                    continue
+                row['raw'] = raw
+                partition = (source, _partition_value(row.pop('account')), _partition_value(row.pop('region')), row['event_time'].date().isoformat())
+                self.buffers.setdefault(partition, []).append(row)
+                self.buffered_rows += 1
+                self.stats['rows'] += 1
+        except (OSError, EOFError, ValueError) as e:
+            # A truncated or corrupt file (or one caught mid-write): its rows are taken out of the buffers again, as
+            # the file is not recorded as converted and the next conversion reads it from the same offset
+            logging.warning(f'{path}: {e}')
+            self.stats['errors'] += 1
+            for partition in list(self.buffers):
+                rows = self.buffers[partition]
+                dropped = len(rows) - buffered.get(partition, 0)
+                del rows[len(rows) - dropped:]
+                if not rows:
+                    del self.buffers[partition]
+                self.buffered_rows -= dropped
+                self.stats['rows'] -= dropped
+            return None
+        return position['offset']
+
+    def flush(self):
+        """
+        Writes out every buffered partition and records the new files and the inputs they cover.
+        """
+        pq = self.pa.parquet
+        files = []
+        for partition, rows in self.buffers.items():
+            rows.sort(key=lambda row: row['event_time'])
+            table = self.pa.table({name: [row[name] for row in rows] for name in COLUMNS}, schema=self.schema)
+            relative_path = os.path.join(*(f'{column}={value}' for column, value in zip(PARTITION_COLUMNS, partition)),
+                                         f'part-{self.run_id}-{self.sequence:05d}.parquet')
+            self.sequence += 1
+            path = os.path.join(self.output_directory, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(table, path + '.part', compression=self.compression, row_group_size=50000)
+            os.replace(path + '.part', path)
+            keys = {column: set(row[column] for row in rows if row[column]) for column in INDEXED_COLUMNS}
+            files.append((relative_path, partition, rows[0]['event_time'].timestamp(), rows[-1]['event_time'].timestamp(), len(rows), keys))
+        self.index.add(files, self.pending_inputs)
+        self.stats['parquet_files'] += len(files)
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.pending_inputs = []
+
+    def close(self):
+        self.flush()
+        self.index.close()
+
+def query(directory, start=None, end=None, source=None, account=None, region=None, principal=None, access_key_id=None,
+          source_ip=None, event_name=None, columns=None, limit=None):
+    """
+    Returns the matching rows of a columnar directory as a pyarrow Table, oldest first. principal, access_key_id,
+    source_ip and event_name match exactly, or as a pattern if they contain *.
+    """
+    pa = _pyarrow()
+    ds, pc = pa.dataset, pa.compute
+    index = ColumnarIndex(os.path.join(directory, INDEX_FILE))
+    try:
+        partitions = {column: value for column, value in (('source', source), ('account', account), ('region', region)) if value}
+        keys = {kind: value for kind, value in (('principal', principal), ('access_key_id', access_key_id), ('source_ip', source_ip)) if value}
+        paths = index.find_files(start, end, partitions, keys)
+    finally:
+        index.close()
+    schema = arrow_schema(partitions=True)
+    if columns:
+        columns = list(dict.fromkeys(list(columns) + ['event_time']))
+    if not paths:
+        return schema.empty_table().select(columns) if columns else schema.empty_table()
+
+    dataset = ds.dataset([os.path.join(directory, path) for path in paths], schema=schema, format='parquet',
+                         partitioning=ds.partitioning(flavor='hive'), partition_base_dir=directory)
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('event_time') >= pa.scalar(start, pa.timestamp('us', tz='UTC')))
+    if end is not None:
+        conditions.append(ds.field('event_time') <= pa.scalar(end, pa.timestamp('us', tz='UTC')))
+    for column, value in (('principal', principal), ('access_key_id', access_key_id), ('source_ip', source_ip), ('event_name', event_name)):
+        if not value:
+            continue
+        if '*' in value:
+            conditions.append(pc.match_like(ds.field(column), value.replace('%', '\\%').replace('_', '\\_').replace('*', '%')))
+        else:
+            conditions.append(ds.field(column) == value)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    table = dataset.to_table(columns=columns, filter=expression).sort_by('event_time')
+    return table.slice(0, limit) if limit else table
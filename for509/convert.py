@@ -0,0 +1,34 @@
+"""
+Converts collected logs into partitioned Parquet files for fast queries with for509.query (requires pyarrow).
+
+    python -m for509.convert --output /cases/incident-42/parquet /cases/incident-42/aws /cases/incident-42/azure
+
+Every CloudTrail, Azure blob and GWS output file found under the input directories is converted. Running it again
+only converts new files and the part of files that grew since, so it can follow a collection that is still running.
+"""
+
+import argparse, logging, sys, time
+
+from for509.columnar import ColumnarConverter
+
+def main(args):
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO)
+    start_time = time.time()
+    converter = ColumnarConverter(args.output, max_buffered_rows=args.max_buffered_rows)
+    try:
+        for directory in args.inputs:
+            converter.convert(directory)
+    finally:
+        converter.close()
+    stats = converter.stats
+    print(f'{stats["rows"]} events from {stats["files"]} files converted into {stats["parquet_files"]} Parquet files in '
+          f'{int(time.time() - start_time)} seconds ({stats["unchanged"]} files unchanged, {stats["unparsed"]} events without a time).')
+    if stats['errors'] or stats['rewritten']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert CloudTrail, Azure and Google Workspace logs into partitioned Parquet files.')
+    parser.add_argument('inputs', nargs='+', help='Directories the collectors wrote to.')
+    parser.add_argument('--output', '-o', required=True, help='Directory of the Parquet files and their index.')
+    parser.add_argument('--max-buffered-rows', default=100000, type=int, help='Events held in memory before they are written out (default 100000).')
+    main(parser.parse_args())
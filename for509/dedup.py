@@ -0,0 +1,253 @@
+"""
+Persistent set of the record keys a collector has already written, used to drop the duplicates that re-runs and
+overlapping windows produce (CloudTrail eventID, GWS id.time and id.uniqueQualifier).
+
+Keys are stored as 16 byte BLAKE2b digests. A chain of Bloom filters in memory mapped files answers most lookups
+(keys never seen) without touching anything else; keys a filter reports as present are verified exactly against sorted
+runs of digests on disk, found by binary search. Keys added since the last commit are held in memory and spilled to
+sorted pending runs, so memory use stays bounded however many keys a run adds.
+
+commit() makes the keys added so far permanent and must only be called once the records they belong to are safely
+written (after the collector's checkpoint commit). A crash before commit forgets those keys, so the records are
+written again rather than lost.
+"""
+
+import bisect, hashlib, heapq, json, math, mmap, os, threading
+
+DIGEST_SIZE = 16
+
+# Keys the first Bloom filter is sized for; every further filter of the chain is twice as large as the one before
+DEFAULT_CAPACITY = 1000 * 1000
+# False positive rate of each filter (a false positive costs an exact lookup in the runs, never a lost record)
+DEFAULT_ERROR_RATE = 0.001
+# Keys held in memory before they are spilled to a pending run
+DEFAULT_BUFFER_SIZE = 200 * 1000
+
+META_FILE = 'meta.json'
+# Digests read at a time when streaming a run
+_READ_BATCH = 65536
+
+def digest(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+def _bloom_parameters(capacity, error_rate):
+    # Optimal number of bits and of hash functions for capacity keys at error_rate
+    bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+    return (bits + 7) // 8 * 8, max(1, round(bits / capacity * math.log(2)))
+
+class _Bloom(object):
+    """
+    Bloom filter over a memory mapped file, with positions derived from the two halves of a key digest.
+    """
+
+    def __init__(self, path, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(bits // 8)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), bits // 8)
+
+    def _positions(self, key_digest):
+        first = int.from_bytes(key_digest[:8], 'little')
+        second = int.from_bytes(key_digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key_digest):
+        bitmap = self._map
+        for position in self._positions(key_digest):
+            bitmap[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key_digest):
+        bitmap = self._map
+        for position in self._positions(key_digest):
+            if not bitmap[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+class _Run(object):
+    """
+    Sorted file of digests, searched through a memory map.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = os.path.getsize(path) // DIGEST_SIZE
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self._map[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+
+    def __contains__(self, key_digest):
+        index = bisect.bisect_left(self, key_digest)
+        return index < self.count and self[index] == key_digest
+
+    def __iter__(self):
+        for start in range(0, self.count, _READ_BATCH):
+            chunk = self._map[start * DIGEST_SIZE:min(self.count, start + _READ_BATCH) * DIGEST_SIZE]
+            for offset in range(0, len(chunk), DIGEST_SIZE):
+                yield chunk[offset:offset + DIGEST_SIZE]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+def _write_run(path, digests):
+    # digests must be sorted and free of duplicates
+    with open(path + '.tmp', 'wb', buffering=1024 * 1024) as f:
+        for key_digest in digests:
+            f.write(key_digest)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    return _Run(path)
+
+class SeenSet(object):
+    """
+    Disk backed set of record keys in directory. add() is thread safe; each directory must only be opened by one
+    SeenSet at a time.
+    """
+
+    def __init__(self, directory, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.directory = directory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        meta_path = os.path.join(self.directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self._meta = json.load(f)
+        else:
+            self._meta = {'filters': [], 'runs': [], 'next_file': 0}
+        # Anything meta.json does not list was left by a crash before a commit
+        listed = set([META_FILE] + [entry['file'] for entry in self._meta['filters']] + self._meta['runs'])
+        for name in os.listdir(self.directory):
+            if name not in listed:
+                os.remove(os.path.join(self.directory, name))
+        self._filters = [_Bloom(os.path.join(self.directory, entry['file']), entry['bits'], entry['hashes']) for entry in self._meta['filters']]
+        self._runs = [_Run(os.path.join(self.directory, name)) for name in self._meta['runs']]
+        self._pending = set()
+        self._pending_runs = []
+        self._pending_count = 0
+        if not self._filters:
+            self._add_filter(self.capacity)
+
+    def _next_path(self, prefix):
+        name = f'{prefix}-{self._meta["next_file"]:06d}'
+        self._meta['next_file'] += 1
+        return os.path.join(self.directory, name)
+
+    def _add_filter(self, capacity):
+        bits, hashes = _bloom_parameters(capacity, self.error_rate)
+        path = self._next_path('bloom')
+        self._filters.append(_Bloom(path, bits, hashes))
+        self._meta['filters'].append({'file': os.path.basename(path), 'bits': bits, 'hashes': hashes, 'capacity': capacity, 'count': 0})
+
+    def _maybe_contains(self, key_digest):
+        return any(key_digest in bloom for bloom in self._filters)
+
+    def _contains(self, key_digest):
+        if key_digest in self._pending:
+            return True
+        return any(key_digest in run for run in self._pending_runs) or any(key_digest in run for run in self._runs)
+
+    def add(self, key):
+        """
+        Adds a key. Returns True if it is new, False if it was added before.
+        """
+        key_digest = digest(key)
+        with self._lock:
+            if self._maybe_contains(key_digest) and self._contains(key_digest):
+                return False
+            # Bits set before the commit only cost an exact lookup if the keys are forgotten by a crash
+            current = self._meta['filters'][-1]
+            if current['count'] >= current['capacity']:
+                self._add_filter(current['capacity'] * 2)
+                current = self._meta['filters'][-1]
+            self._filters[-1].add(key_digest)
+            current['count'] += 1
+            self._pending.add(key_digest)
+            self._pending_count += 1
+            if len(self._pending) >= self.buffer_size:
+                self._pending_runs.append(_write_run(self._next_path('pending'), sorted(self._pending)))
+                self._pending = set()
+            return True
+
+    def commit(self):
+        """
+        Makes the keys added since the last commit permanent.
+        """
+        with self._lock:
+            if self._pending:
+                self._pending_runs.append(_write_run(self._next_path('pending'), sorted(self._pending)))
+                self._pending = set()
+            if not self._pending_runs:
+                return
+            runs = self._runs + self._pending_runs
+            # Merge the newest runs while the one before is at most twice as large, keeping a logarithmic number of runs
+            while len(runs) > 1 and len(runs[-2]) <= 2 * len(runs[-1]):
+                older, newer = runs[-2], runs.pop()
+                runs[-1] = _write_run(self._next_path('run'), heapq.merge(older, newer))
+                older.close()
+                newer.close()
+            for bloom in self._filters:
+                bloom.flush()
+            self._runs = runs
+            self._pending_runs = []
+            self._pending_count = 0
+            self._meta['runs'] = [os.path.basename(run.path) for run in runs]
+            self._save_meta()
+            listed = set(self._meta['runs'])
+            for name in os.listdir(self.directory):
+                if name.startswith(('run-', 'pending-')) and name not in listed:
+                    os.remove(os.path.join(self.directory, name))
+
+    def _save_meta(self):
+        meta_path = os.path.join(self.directory, META_FILE)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(self._meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs) + self._pending_count
+
+    def _close_files(self):
+        for item in self._filters + self._runs + self._pending_runs:
+            item.close()
+
+    def reset(self):
+        """
+        Forgets every key, for when the output the keys describe has been removed or is about to be overwritten.
+        """
+        with self._lock:
+            self._close_files()
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+            self._open()
+
+    def close(self):
+        """
+        Closes the set, forgetting the keys added since the last commit.
+        """
+        with self._lock:
+            self._close_files()
@@ -0,0 +1,335 @@
+"""
+Evidence integrity: digests of the collected files computed as their bytes are written, and a signed manifest per run,
+so that what was collected can be proven unchanged without a second pass over the data.
+
+The main process of a collection opens a RunManifest in the output directory. Like the metrics snapshot directory,
+its path is handed to worker processes through the FOR509_MANIFEST environment variable, and every writer that
+finishes a file (or an append to one) records the file's digests in it. When the run ends the manifest is signed with
+HMAC-SHA256 under a key from FOR509_MANIFEST_KEY, a key file, or ~/.config/for509/manifest.key (created on first use).
+
+    python -m for509.integrity /cases/incident-42/aws/manifest-cloudtrail-20260101T000000Z-4242.jsonl
+
+checks the signature of a manifest and hashes the files it lists again.
+"""
+
+import argparse, hashlib, hmac, json, logging, os, secrets, socket, sys
+from datetime import datetime, timezone
+
+MANIFEST_ENV = 'FOR509_MANIFEST'
+KEY_ENV = 'FOR509_MANIFEST_KEY'
+DEFAULT_KEY_FILE = os.path.join(os.path.expanduser('~'), '.config', 'for509', 'manifest.key')
+
+DEFAULT_ALGORITHMS = ('sha256',)
+
+SIGNATURE_EXTENSION = '.sig'
+
+# Bytes of out of order chunks a HashingFile holds for hashing before it leaves them to be read back from the file
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+def _blake3():
+    try:
+        import blake3
+    except ImportError:
+        raise ImportError('BLAKE3 digests require the blake3 package (pip install blake3)')
+    return blake3
+
+def new_hash(algorithm):
+    if algorithm == 'blake3':
+        return _blake3().blake3()
+    if algorithm == 'md5':
+        # Only compared with the Content-MD5 the server stored, never relied on for integrity by itself
+        return hashlib.md5(usedforsecurity=False)
+    return hashlib.new(algorithm)
+
+class Hasher(object):
+    """
+    Computes several digests of the same bytes at once.
+    """
+
+    def __init__(self, algorithms):
+        self._hashes = {algorithm: new_hash(algorithm) for algorithm in algorithms}
+        self.size = 0
+
+    def update(self, data):
+        for digest in self._hashes.values():
+            digest.update(data)
+        self.size += len(data)
+
+    def digest(self, algorithm):
+        return self._hashes[algorithm].digest()
+
+    def hexdigests(self):
+        return {algorithm: digest.hexdigest() for algorithm, digest in self._hashes.items()}
+
+class HashingFile(object):
+    """
+    Writable file wrapper that hashes the bytes written through it in file order. Parallel downloads write chunks out
+    of order, seeking in between: chunks past the hashed prefix are held until the gap before them is written. Once
+    more than max_pending bytes are held, hashing stops there and finish() reads the rest back from the file instead.
+    """
+
+    def __init__(self, raw, hasher, max_pending=MAX_PENDING_BYTES):
+        self.raw = raw
+        self.hasher = hasher
+        self.max_pending = max_pending
+        self._position = raw.tell()
+        self._start = self._hashed = self._position
+        self._pending = {}
+        self._pending_bytes = 0
+        self._written = 0
+        self._read_back = False
+
+    @property
+    def name(self):
+        # Stored in gzip headers, which must stay the same with or without hashing
+        return getattr(self.raw, 'name', '')
+
+    def write(self, data):
+        data = bytes(data)
+        written = self.raw.write(data)
+        self._written += len(data)
+        if self._position < self._hashed:
+            raise ValueError('Bytes that were already hashed were written again')
+        if self._read_back:
+            pass
+        elif self._position == self._hashed:
+            self.hasher.update(data)
+            self._hashed += len(data)
+            while self._hashed in self._pending:
+                chunk = self._pending.pop(self._hashed)
+                self._pending_bytes -= len(chunk)
+                self.hasher.update(chunk)
+                self._hashed += len(chunk)
+        else:
+            self._pending[self._position] = data
+            self._pending_bytes += len(data)
+            if self._pending_bytes > self.max_pending:
+                self._pending = {}
+                self._pending_bytes = 0
+                self._read_back = True
+        self._position += len(data)
+        return written
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._position = self.raw.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def finish(self, block_size=1024 * 1024):
+        """
+        Hashes the bytes left to be read back from the file, which must be flushed (or closed) by then, and returns
+        complete().
+        """
+        if self._read_back:
+            with open(self.raw.name, 'rb') as f:
+                f.seek(self._hashed)
+                for block in iter(lambda: f.read(block_size), b''):
+                    self.hasher.update(block)
+                    self._hashed += len(block)
+            self._read_back = False
+        return self.complete()
+
+    def complete(self):
+        """
+        True once every byte written has been hashed, and only once.
+        """
+        return not self._read_back and not self._pending and self._hashed - self._start == self._written
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+_algorithms_cache = {}
+
+def algorithms():
+    """
+    Digest algorithms of the run's manifest, or () when no manifest is open (nothing is hashed then).
+    """
+    path = os.environ.get(MANIFEST_ENV)
+    if not path:
+        return ()
+    if path not in _algorithms_cache:
+        with open(path, 'rb') as f:
+            _algorithms_cache[path] = tuple(json.loads(f.readline())['algorithms'])
+    return _algorithms_cache[path]
+
+def hasher(extra=()):
+    """
+    Returns a Hasher for the manifest's algorithms plus extra ones, or None if that leaves nothing to compute.
+    """
+    names = tuple(algorithms()) + tuple(name for name in extra if name not in algorithms())
+    return Hasher(names) if names else None
+
+def record(path, size, digests, offset=0, **details):
+    """
+    Adds the digests of the size bytes of path starting at offset (0 for a whole file, the old size for an append) to
+    the run's manifest. Safe to call from any thread or worker process; does nothing without a manifest.
+    """
+    manifest = os.environ.get(MANIFEST_ENV)
+    if not manifest:
+        return
+    entry = {'path': os.path.relpath(path, os.path.dirname(manifest)), 'offset': offset, 'size': size}
+    entry.update((algorithm, value) for algorithm, value in digests.items() if algorithm in algorithms())
+    entry.update(details)
+    entry['recorded'] = _now()
+    # A single write to a file opened for appending is never interleaved with the writes of other processes
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def load_key(key_file=None):
+    """
+    Returns the signing key: FOR509_MANIFEST_KEY, else the contents of key_file, else of DEFAULT_KEY_FILE, which is
+    created with a random key if it does not exist.
+    """
+    if os.environ.get(KEY_ENV):
+        return os.environ[KEY_ENV].encode('utf-8')
+    path = key_file or DEFAULT_KEY_FILE
+    if not key_file and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32) + '\n')
+        logging.info(f'Created the manifest signing key {path}')
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+def key_id(key):
+    return hashlib.sha256(key).hexdigest()[:16]
+
+def sign(path, key):
+    """
+    Writes the signature of a manifest to <manifest>.sig.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    signature = {'manifest': os.path.basename(path), 'sha256': hashlib.sha256(data).hexdigest(),
+                 'hmac-sha256': hmac.new(key, data, hashlib.sha256).hexdigest(), 'key_id': key_id(key)}
+    with open(path + SIGNATURE_EXTENSION + '.tmp', 'w') as f:
+        json.dump(signature, f, indent=2)
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + SIGNATURE_EXTENSION + '.tmp', path + SIGNATURE_EXTENSION)
+
+class RunManifest(object):
+    """
+    Manifest of the files one collection run writes under directory, as JSON lines: a header naming the collector and
+    the digest algorithms (SHA-256, and BLAKE3 if blake3 is set), one entry per file or append, and a footer written
+    by close(), which then signs it.
+    """
+
+    def __init__(self, directory, collector, blake3=False, key_file=None):
+        algorithms = DEFAULT_ALGORITHMS + (('blake3',) if blake3 else ())
+        for algorithm in algorithms:
+            new_hash(algorithm)  # Fails now, rather than in every writer, without the blake3 package
+        self.key = load_key(key_file)
+        started = datetime.now(timezone.utc)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'manifest-{collector}-{started.strftime("%Y%m%dT%H%M%SZ")}-{os.getpid()}.jsonl')
+        header = {'manifest': 1, 'collector': collector, 'algorithms': list(algorithms), 'host': socket.gethostname(),
+                  'started': started.isoformat(timespec='seconds')}
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+        self._previous = os.environ.get(MANIFEST_ENV)
+        os.environ[MANIFEST_ENV] = self.path
+
+    def close(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'finished': _now()}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        sign(self.path, self.key)
+        if self._previous is None:
+            os.environ.pop(MANIFEST_ENV, None)
+        else:
+            os.environ[MANIFEST_ENV] = self._previous
+        return self.path
+
+def _hash_range(path, offset, size, algorithms, block_size=1024 * 1024):
+    digest = Hasher(algorithms)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+def verify(path, key, check_files=True):
+    """
+    Returns the problems found with a manifest (an empty list if there are none): a missing or wrong signature (not
+    checked if key is None), and, with check_files, listed files that are missing or whose bytes no longer match
+    their digests.
+    """
+    problems = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        with open(path + SIGNATURE_EXTENSION) as f:
+            signature = json.load(f)
+    except FileNotFoundError:
+        problems.append('no signature (the run did not finish)')
+    else:
+        if key is None:
+            problems.append(f'no signing key to check the signature with (signed with key {signature.get("key_id")})')
+        elif not hmac.compare_digest(signature['hmac-sha256'], hmac.new(key, data, hashlib.sha256).hexdigest()):
+            problems.append(f'bad signature (signed with key {signature.get("key_id")}, checked with key {key_id(key)})')
+    lines = data.decode('utf-8').splitlines()
+    header = json.loads(lines[0])
+    if not check_files:
+        return problems
+    directory = os.path.dirname(os.path.abspath(path))
+    for line in lines[1:]:
+        entry = json.loads(line)
+        if 'path' not in entry:
+            continue
+        file_path = os.path.join(directory, entry['path'])
+        names = [algorithm for algorithm in header['algorithms'] if algorithm in entry]
+        if not os.path.exists(file_path):
+            problems.append(f'{entry["path"]}: missing')
+            continue
+        digest = _hash_range(file_path, entry['offset'], entry['size'], names)
+        if digest.size != entry['size']:
+            problems.append(f'{entry["path"]}: {digest.size} bytes at offset {entry["offset"]} instead of {entry["size"]}')
+        elif any(digest.hexdigests()[name] != entry[name] for name in names):
+            problems.append(f'{entry["path"]}: bytes {entry["offset"]}-{entry["offset"] + entry["size"]} do not match their digests')
+    return problems
+
+def main(args):
+    key = load_key(args.key_file) if args.key_file or os.environ.get(KEY_ENV) or os.path.exists(DEFAULT_KEY_FILE) else None
+    failed = False
+    for path in args.manifests:
+        problems = verify(path, key, not args.signature_only)
+        for problem in problems:
+            print(f'{path}: {problem}')
+        if not problems:
+            print(f'{path}: OK')
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the signature of collection manifests and the files they list.')
+    parser.add_argument('manifests', nargs='+', help='Manifest files (manifest-*.jsonl) to check.')
+    parser.add_argument('--key-file', default=None, help=f'File holding the signing key (default: ${KEY_ENV} or {DEFAULT_KEY_FILE}).')
+    parser.add_argument('--signature-only', action='store_true', help='Only check the signature, without hashing the files again.')
+    main(parser.parse_args())
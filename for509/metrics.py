@@ -0,0 +1,292 @@
+"""
+Low overhead metrics for the collectors: per-call latency histograms, retry and throttle counters, bytes in and out,
+and time spent serializing and writing, so a slow collection can be told apart as API-bound, throttled, CPU-bound or
+disk-bound.
+
+Every process records into its own REGISTRY (a dict update under a lock per call). Worker processes started by the
+download scripts save snapshots of their registry to the directory named by the FOR509_METRICS_DIR environment
+variable; the main process merges them with its own for export, as a Prometheus text file or endpoint and as a JSON
+run summary.
+"""
+
+import bisect, glob, json, os, tempfile, threading, time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the latency histogram buckets, from a fast local write to a throttled API call
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Directory worker processes save their snapshots to, inherited through the environment
+METRICS_DIR_ENV = 'FOR509_METRICS_DIR'
+
+# Seconds between two snapshots of a worker process
+SNAPSHOT_INTERVAL = 5.0
+
+class Registry(object):
+    """
+    Counters and histograms keyed by metric name and a tuple of sorted (label, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # [bucket counts..., +Inf count, sum] of each key
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Observes how long the body of the with statement took, in seconds, even if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Returns the registry as JSON serializable lists.
+        """
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(histogram)] for (name, labels), histogram in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                total = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+                for index, value in enumerate(histogram):
+                    total[index] += value
+
+REGISTRY = Registry()
+
+# Recording functions of the process wide registry
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.time
+
+def save_snapshot(registry=REGISTRY):
+    """
+    Saves the registry of this process to the FOR509_METRICS_DIR directory, if it is set.
+    """
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if not directory:
+        return
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+class SnapshotThread(object):
+    """
+    Saves the registry of a worker process every interval seconds until stopped, and once more when stopped.
+    """
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            save_snapshot()
+
+    def start(self):
+        if os.environ.get(METRICS_DIR_ENV):
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        save_snapshot()
+
+# A forked worker starts with a copy of its parent's metrics, which the parent already counts
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+def collect(registry=REGISTRY):
+    """
+    Returns a new registry merging registry with the snapshots saved by worker processes.
+    """
+    merged = Registry()
+    merged.merge(registry.snapshot())
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            if os.path.basename(path) == f'{os.getpid()}.json':
+                continue
+            try:
+                with open(path) as f:
+                    merged.merge(json.load(f))
+            except (OSError, ValueError):
+                pass  # Removed or replaced while reading: picked up next time
+    return merged
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def to_prometheus(registry):
+    """
+    Returns the registry in the Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(set(name for name, _ in registry.counters)):
+        lines.append(f'# TYPE {name} counter')
+        for (metric, labels), value in sorted(registry.counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    for name in sorted(set(name for name, _ in registry.histograms)):
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), histogram in sorted(registry.histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-1]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+def quantile(histogram, q):
+    """
+    Estimates a quantile of a histogram by linear interpolation within its bucket, like Prometheus' histogram_quantile.
+    """
+    count = sum(histogram[:-1])
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for index, bucket_count in enumerate(histogram[:-1]):
+        if cumulative + bucket_count >= rank and bucket_count:
+            if index == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[index - 1] if index else 0.0
+            return lower + (BUCKETS[index] - lower) * (rank - cumulative) / bucket_count
+        cumulative += bucket_count
+    return BUCKETS[-1]
+
+def summary(registry):
+    """
+    Returns a JSON serializable run summary: counter values, and count, total, mean and p50/p95/p99 of each histogram.
+    """
+    def key(name, labels):
+        return name + _format_labels(labels)
+
+    result = {'counters': {}, 'histograms': {}}
+    for (name, labels), value in sorted(registry.counters.items()):
+        result['counters'][key(name, labels)] = value
+    for (name, labels), histogram in sorted(registry.histograms.items()):
+        count = sum(histogram[:-1])
+        result['histograms'][key(name, labels)] = {
+            'count': count, 'sum': histogram[-1], 'mean': histogram[-1] / count if count else None,
+            'p50': quantile(histogram, 0.5), 'p95': quantile(histogram, 0.95), 'p99': quantile(histogram, 0.99),
+        }
+    return result
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+class MetricsExporter(object):
+    """
+    Exports the merged metrics of a run: rewrites prometheus_file every interval seconds (for node_exporter's textfile
+    collector), serves them on http://<host>:<port>/metrics, and writes summary_file as JSON when closed. Any of the
+    three can be None. Unless FOR509_METRICS_DIR is already set, it is pointed at snapshot_directory (a temporary
+    directory by default) for the worker processes started afterwards.
+    """
+
+    def __init__(self, prometheus_file=None, summary_file=None, port=None, host='127.0.0.1', interval=15.0, snapshot_directory=None):
+        self.prometheus_file = prometheus_file
+        self.summary_file = summary_file
+        self.port = port
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        if not os.environ.get(METRICS_DIR_ENV) and (prometheus_file or summary_file or port):
+            if snapshot_directory is None:
+                snapshot_directory = tempfile.mkdtemp(prefix='for509-metrics-')
+            os.makedirs(snapshot_directory, exist_ok=True)
+            for path in glob.glob(os.path.join(snapshot_directory, '*.json')):
+                os.remove(path)  # Left by an earlier run
+            os.environ[METRICS_DIR_ENV] = snapshot_directory
+        self.host = host
+
+    def start(self):
+        if self.prometheus_file:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self.port:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = to_prometheus(collect()).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            self._server = ThreadingHTTPServer((exporter.host, exporter.port), Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            _write_atomic(self.prometheus_file, to_prometheus(collect()))
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        registry = collect()
+        if self.prometheus_file:
+            _write_atomic(self.prometheus_file, to_prometheus(registry))
+        if self.summary_file:
+            _write_atomic(self.summary_file, json.dumps(summary(registry), indent=2) + '\n')
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,21 @@
+"""
+Built in collector plugins, wrapping the download scripts of this repo so they can run under the collection engine.
+"""
+
+import importlib.util, os, sys
+
+# Root of the repository, where the scripts live
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+
+def load_script(relative_path, module_name):
+    """
+    Imports one of the repo's scripts (whose file names are not valid module names) as module_name. The scripts
+    only act when run as __main__, so importing them just defines their functions.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,72 @@
+"""
+Azure Storage blob collector: every new blob of the listed containers is a task, downloaded with the
+AzureBlobFileDownloader of download_blobs_multithreaded.py into the job's output directory.
+"""
+
+import os
+
+from for509.checkpoint import CheckpointStore
+from for509.collector import Collector
+from for509.plugins import load_script
+from for509.ratelimit import AdaptiveConcurrency
+from for509.sinks import open_sink
+
+class AzureBlobCollector(Collector):
+    """
+    Options mirror the command line of download_blobs_multithreaded.py: connection_strings (a list), accounts_file,
+    containers (default: its DEFAULT_CONTAINERS), full, lookback_hours, concurrency, max_concurrency, sink and
+    local_copy. Downloads are still held to the adaptive concurrency limit, within the engine's own worker count.
+    """
+
+    name = 'azure-blob'
+    DEFAULT_OPTIONS = {
+        'connection_strings': [], 'accounts_file': None, 'containers': None, 'full': False, 'lookback_hours': 3,
+        'concurrency': 10, 'max_concurrency': 64, 'sink': None, 'local_copy': True,
+    }
+
+    def __init__(self, options, context):
+        super().__init__(options, context)
+        self.script = load_script(os.path.join('Azure', 'download_blobs_multithreaded.py'), 'for509_azure_blob_download')
+        self.connection_strings = list(self.options['connection_strings'])
+        if self.options['accounts_file']:
+            self.connection_strings.extend(self.script.read_connection_strings(self.options['accounts_file']))
+        if not self.connection_strings:
+            raise ValueError('No storage account given: set connection_strings or accounts_file')
+        self.containers = self.options['containers'] or self.script.DEFAULT_CONTAINERS
+        self.store = CheckpointStore(context.checkpoint_db)
+        self.limiter = AdaptiveConcurrency(initial=self.options['concurrency'], maximum=self.options['max_concurrency'])
+        self.sink = open_sink(self.options['sink'], 'azure') if self.options['sink'] else None
+        self.downloaders = []
+
+    def tasks(self):
+        for connection_string in self.connection_strings:
+            for container in self.containers:
+                downloader = self.script.AzureBlobFileDownloader(connection_string, container, self.context.output_directory, self.store,
+                                                                 self.limiter, not self.options['full'], self.options['lookback_hours'],
+                                                                 self.sink, self.options['local_copy'])
+                downloader.verbose = False
+                if not downloader.my_container.exists():
+                    continue
+                self.downloaders.append(downloader)
+                for blob in downloader.list_new_blobs():
+                    yield downloader, blob
+
+    def run_task(self, task):
+        downloader, blob = task
+        size = downloader.save_blob_locally(blob)
+        if size is None:
+            # The downloader already printed why; raising lets the engine count the failed task
+            raise IOError('download failed')
+        if size:
+            self.context.account(1, size)
+
+    def describe(self, task):
+        downloader, blob = task
+        return f'{downloader.account_name}/{downloader.container}/{blob.name}'
+
+    def finish(self):
+        for downloader in self.downloaders:
+            downloader.finish()
+        if self.sink is not None:
+            self.sink.close()
+        self.store.close()
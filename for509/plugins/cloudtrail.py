@@ -0,0 +1,142 @@
+"""
+CloudTrail LookupEvents collector: every enabled region of every account is a task, downloaded with
+Cloudtrail_downloadv2.regionDownload into the job's output directory.
+"""
+
+import argparse, os, threading
+
+import boto3
+
+from for509.aws import DiscoveryCache, RoleCredentialCache, base_session, role_session, cached_regions, probe_regions
+from for509.checkpoint import CheckpointStore
+from for509.cloudtrail import CHECKPOINT_COLLECTOR
+from for509.collector import Collector, TaskProgress
+from for509.plugins import load_script
+from for509.ratelimit import TokenBucket
+
+class _CompletionQueue(object):
+    """
+    Takes the place of the multiprocessing.Queue regionDownload reports to, remembering whether the region finished.
+    """
+
+    def __init__(self):
+        self.done = False
+
+    def put(self, message):
+        if message[2] == 'done':
+            self.done = True
+
+    def close(self):
+        pass
+
+class CloudTrailCollector(Collector):
+    """
+    Options mirror the command line of Cloudtrail_downloadv2.py (with underscores), plus 'regions' to limit the
+    collection to some regions.
+    """
+
+    name = 'cloudtrail'
+    DEFAULT_OPTIONS = {
+        'profile': 'default', 'access_key_id': None, 'secret_key': None, 'session_token': None,
+        'accounts': None, 'organization': False, 'role_name': 'OrganizationAccountAccessRole', 'external_id': None,
+        'regions': None, 'lookup_rate': 2.0, 'slice_hours': 0, 'slice_workers': 4, 'split_events': 10000,
+        'max_file_events': 100000, 'max_file_mb': 64, 'output_format': 'records', 'reserialize': False, 'dedup': True,
+        'sink': None, 'local_copy': True,
+        'cache_file': os.path.join(os.path.expanduser('~'), '.cache', 'for509', 'aws_discovery.json'), 'cache_ttl': 24,
+        'no_probe': False,
+    }
+
+    def __init__(self, options, context):
+        super().__init__(options, context)
+        self.script = load_script(os.path.join('AWS', 'Cloudtrail_downloadv2.py'), 'for509_cloudtrail_download')
+        options = self.options
+
+        self.session_params = {
+            'aws_access_key_id': options['access_key_id'],
+            'aws_secret_access_key': options['secret_key'],
+            'aws_session_token': options['session_token']
+        }
+        if not options['access_key_id'] and not options['secret_key']:
+            credentials = boto3.Session(profile_name=options['profile']).get_credentials().get_frozen_credentials()
+            self.session_params.update(aws_access_key_id=credentials.access_key, aws_secret_access_key=credentials.secret_key,
+                                       aws_session_token=credentials.token)
+
+        self.slice_config = None
+        if options['slice_hours']:
+            self.slice_config = {'slice_hours': options['slice_hours'], 'workers': options['slice_workers'], 'split_events': options['split_events']}
+        self.output_config = {
+            'max_events': options['max_file_events'],
+            'max_bytes': options['max_file_mb'] * 1024 * 1024,
+            'ndjson': options['output_format'] == 'ndjson',
+            'reserialize': options['reserialize'],
+            'dedup': options['dedup'],
+            'sink': options['sink'],
+            'local_copy': options['local_copy']
+        }
+        self.discovery_cache = DiscoveryCache(options['cache_file'], options['cache_ttl'] * 3600)
+        self.credential_cache = RoleCredentialCache(self.session_params, options['external_id'])
+        self.account_regions = {}  # Regions enabled in each account
+        self.completed_regions = set()  # (account, region) pairs that are complete
+        self.limiters = {}  # LookupEvents limiter of each (account, region), made for its probe and kept for its download
+        self._lock = threading.Lock()
+
+    def tasks(self):
+        targets = self.script.collection_targets(argparse.Namespace(**self.options), self.session_params, self.discovery_cache)
+        store = CheckpointStore(self.context.checkpoint_db)
+        try:
+            for account_id, role_arn in targets:
+                if role_arn:
+                    session = role_session(self.session_params, role_arn, self.options['external_id'], self.credential_cache.get(role_arn), 'us-east-1')
+                else:
+                    session = base_session(self.session_params, 'us-east-1')
+                regions = cached_regions(self.discovery_cache, session, account_id)
+                if self.options['regions']:
+                    regions = [region for region in regions if region in self.options['regions']]
+                self.account_regions[account_id] = regions
+
+                # Regions already done are skipped, and regions without a single event are probed for and skipped too
+                candidates = []
+                for region_name in regions:
+                    checkpoint = store.load(CHECKPOINT_COLLECTOR, f'{account_id}:{region_name}')
+                    if checkpoint is not None and checkpoint.done:
+                        self.completed_regions.add((account_id, region_name))
+                    elif checkpoint is not None or self.options['no_probe']:
+                        yield account_id, role_arn, region_name
+                    else:
+                        candidates.append(region_name)
+                for region_name in candidates:
+                    self.limiters[(account_id, region_name)] = TokenBucket(rate=self.options['lookup_rate'])
+                empty_regions = probe_regions(self.discovery_cache, [(account_id, region_name, session) for region_name in candidates], self.limiters)
+                self.discovery_cache.save()
+                for region_name in candidates:
+                    if (account_id, region_name) in empty_regions:
+                        self.completed_regions.add((account_id, region_name))
+                    else:
+                        yield account_id, role_arn, region_name
+        finally:
+            store.close()
+
+    def run_task(self, task):
+        account_id, role_arn, region_name = task
+        worker_params = dict(self.session_params, account_id=account_id)
+        if role_arn:
+            worker_params.update(role_arn=role_arn, external_id=self.options['external_id'], role_credentials=self.credential_cache.get(role_arn))
+        completion = _CompletionQueue()
+        with self._lock:
+            limiter = self.limiters.pop((account_id, region_name), None) or TokenBucket(rate=self.options['lookup_rate'])
+        self.script.regionDownload(worker_params, region_name, self.context.output_directory, completion, limiter,
+                                   self.context.checkpoint_db, self.slice_config, self.output_config, TaskProgress(self.context))
+        if completion.done:
+            with self._lock:
+                self.completed_regions.add((account_id, region_name))
+
+    def describe(self, task):
+        return f'{task[0]}:{task[2]}'
+
+    def finish(self):
+        # Only remove the checkpoints if all regions of all accounts are done
+        if len(self.completed_regions) == sum(len(regions) for regions in self.account_regions.values()):
+            store = CheckpointStore(self.context.checkpoint_db)
+            for account_id, regions in self.account_regions.items():
+                self.script.clear_region_checkpoints(store, account_id, regions)
+            store.close()
@@ -0,0 +1,82 @@
+"""
+CloudTrail trail bucket collector: every log file of the trail in the time window is a task, downloaded with the
+TrailBucketDownloader of Cloudtrail_s3_download.py into the job's output directory.
+"""
+
+import os
+
+import boto3
+
+from for509.aws import base_session, role_session
+from for509.checkpoint import CheckpointStore
+from for509.collector import Collector
+from for509.plugins import load_script
+from for509.ratelimit import AdaptiveConcurrency
+from for509.sinks import open_sink
+
+class CloudTrailS3Collector(Collector):
+    """
+    Options mirror the command line of Cloudtrail_s3_download.py (with underscores): bucket, prefix, start and end
+    (ISO 8601 dates or times), accounts and regions (lists), full, lookback_hours, concurrency, max_concurrency,
+    credentials, role_arn, external_id, region, sink and local_copy.
+    """
+
+    name = 'cloudtrail-s3'
+    DEFAULT_OPTIONS = {
+        'bucket': None, 'prefix': '', 'start': None, 'end': None, 'accounts': None, 'regions': None, 'full': False,
+        'lookback_hours': 3, 'concurrency': 16, 'max_concurrency': 64,
+        'profile': 'default', 'access_key_id': None, 'secret_key': None, 'session_token': None,
+        'role_arn': None, 'external_id': None, 'region': None, 'sink': None, 'local_copy': True,
+    }
+
+    def __init__(self, options, context):
+        super().__init__(options, context)
+        self.script = load_script(os.path.join('AWS', 'Cloudtrail_s3_download.py'), 'for509_cloudtrail_s3_download')
+        options = self.options
+        if not options['bucket']:
+            raise ValueError('No trail bucket given: set bucket')
+
+        session_params = {
+            'aws_access_key_id': options['access_key_id'],
+            'aws_secret_access_key': options['secret_key'],
+            'aws_session_token': options['session_token']
+        }
+        if not options['access_key_id'] and not options['secret_key']:
+            credentials = boto3.Session(profile_name=options['profile']).get_credentials().get_frozen_credentials()
+            session_params.update(aws_access_key_id=credentials.access_key, aws_secret_access_key=credentials.secret_key,
+                                  aws_session_token=credentials.token)
+        if options['role_arn']:
+            session = role_session(session_params, options['role_arn'], options['external_id'], region_name=options['region'])
+        else:
+            session = base_session(session_params, options['region'])
+
+        self.store = CheckpointStore(context.checkpoint_db)
+        self.limiter = AdaptiveConcurrency(initial=options['concurrency'], maximum=options['max_concurrency'])
+        self.sink = open_sink(options['sink'], 'cloudtrail') if options['sink'] else None
+        self.downloader = self.script.TrailBucketDownloader(
+            session, options['bucket'], context.output_directory, self.store, self.limiter, options['prefix'],
+            self.script.parse_time(options['start']) if options['start'] else None,
+            self.script.parse_time(options['end']) if options['end'] else None,
+            options['accounts'], options['regions'], not options['full'], options['lookback_hours'], self.sink,
+            options['local_copy'], options['max_concurrency'])
+        self.downloader.verbose = False
+
+    def tasks(self):
+        return self.downloader.list_new_objects()
+
+    def run_task(self, task):
+        size = self.downloader.save_object(task)
+        if size is None:
+            # The downloader already printed why; raising lets the engine count the failed task
+            raise IOError('download failed')
+        if size:
+            self.context.account(1, size)
+
+    def describe(self, task):
+        return f's3://{self.options["bucket"]}/{task.key}'
+
+    def finish(self):
+        self.downloader.finish()
+        if self.sink is not None:
+            self.sink.close()
+        self.store.close()
@@ -0,0 +1,58 @@
+"""
+Google Workspace collector: every application is a task, collected with the Google class of gws-get-logs.py into the
+job's output directory.
+"""
+
+import os
+
+from dateutil import parser as dateparser, tz
+
+from for509.collector import Collector
+from for509.plugins import load_script
+
+class GWSCollector(Collector):
+    """
+    Options mirror the command line and config.json of gws-get-logs.py: creds_path, delegated_creds, apps (a list,
+    or 'all'), from_date, update, overwrite, shards, compression, dedup, sink and local_copy. Unlike the script,
+    update is on by default.
+    """
+
+    name = 'gws'
+    DEFAULT_OPTIONS = {
+        'creds_path': None, 'delegated_creds': None, 'apps': None, 'from_date': None, 'update': True, 'overwrite': False,
+        'shards': None, 'compression': None, 'dedup': True,
+        'sink': None, 'local_copy': True,
+    }
+
+    def __init__(self, options, context):
+        super().__init__(options, context)
+        self.script = load_script(os.path.join('GWS', 'gws-log-collection', 'gws-get-logs.py'), 'for509_gws_get_logs')
+        Google = self.script.Google
+        apps = self.options['apps'] or Google.DEFAULT_APPLICATIONS
+        if apps == 'all':
+            apps = Google.get_application_list()
+        self.from_date = None
+        if self.options['from_date']:
+            self.from_date = dateparser.parse(self.options['from_date']).replace(tzinfo=tz.gettz('UTC'))
+        self.google = Google(creds_path=self.options['creds_path'], delegated_creds=self.options['delegated_creds'],
+                             output_path=context.output_directory, apps=apps, update=self.options['update'],
+                             overwrite=self.options['overwrite'], checkpoint_db=context.checkpoint_db,
+                             shards=self.options['shards'], compression=self.options['compression'], dedup=self.options['dedup'],
+                             sink=self.options['sink'], local_copy=self.options['local_copy'])
+
+    def tasks(self):
+        return list(self.google.app_list)
+
+    def run_task(self, app):
+        output_file = self.google.output_file(app)
+        size = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+        _, saved, _ = self.google.get_app_logs(app, self.from_date)
+        if os.path.exists(output_file) and saved:
+            # Overwritten files start from zero
+            size = 0 if self.options['overwrite'] else size
+            self.context.account(saved, max(0, os.path.getsize(output_file) - size))
+        elif saved:
+            self.context.account(saved, 0)  # Only sent to the sink
+
+    def finish(self):
+        self.google.close()
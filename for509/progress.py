@@ -0,0 +1,195 @@
+"""
+Download progress shared between collection workers and the process showing it.
+
+Workers only bump counters in shared memory, so they never wait on the display. The main process samples the
+counters on a timer, turns them into rates and an ETA, and shows them in a curses screen or, when the output is not
+a terminal, as periodic log lines.
+"""
+
+import curses, multiprocessing, sys, time
+from collections import deque
+
+# Indexes into the shared values of a ProgressCounter
+_EVENTS, _BYTES, _REMAINING = range(3)
+
+class ProgressCounter(object):
+    """
+    Events and bytes downloaded by one worker, plus how much of its work is left (in whatever unit the worker can
+    measure, e.g. seconds of the lookup window still to walk). Each counter must have a single writer; values are
+    plain 8-byte slots in shared memory that the reader may sample at any time without a lock.
+    """
+
+    def __init__(self):
+        self._values = multiprocessing.RawArray('d', [0, 0, -1])
+
+    def add(self, events, size):
+        self._values[_EVENTS] += events
+        self._values[_BYTES] += size
+
+    def set_events(self, events):
+        self._values[_EVENTS] = events
+
+    def set_remaining(self, remaining):
+        self._values[_REMAINING] = remaining
+
+    @property
+    def events(self):
+        return int(self._values[_EVENTS])
+
+    @property
+    def bytes(self):
+        return int(self._values[_BYTES])
+
+    @property
+    def remaining(self):
+        """
+        Work left, or None if the worker has not reported any yet.
+        """
+        remaining = self._values[_REMAINING]
+        return remaining if remaining >= 0 else None
+
+class RateMeter(object):
+    """
+    Turns periodic samples of ProgressCounters into events/s, bytes/s and an ETA, averaged over the last window seconds.
+    """
+
+    def __init__(self, window=30.0):
+        self.window = window
+        self._samples = {}
+
+    def sample(self, key, counter, now=None):
+        """
+        Records the current values of counter and returns (events_per_second, bytes_per_second, eta_seconds).
+        The ETA is None until the remaining work has been seen going down.
+        """
+        now = time.monotonic() if now is None else now
+        samples = self._samples.setdefault(key, deque())
+        samples.append((now, counter.events, counter.bytes, counter.remaining))
+        while len(samples) > 2 and now - samples[0][0] > self.window:
+            samples.popleft()
+
+        first, last = samples[0], samples[-1]
+        elapsed = last[0] - first[0]
+        if elapsed <= 0:
+            return 0.0, 0.0, None
+        events_rate = (last[1] - first[1]) / elapsed
+        bytes_rate = (last[2] - first[2]) / elapsed
+        eta = None
+        known = [sample for sample in samples if sample[3] is not None]
+        if len(known) >= 2 and known[-1][3] < known[0][3]:
+            eta = known[-1][3] / ((known[0][3] - known[-1][3]) / (known[-1][0] - known[0][0]))
+        return events_rate, bytes_rate, eta
+
+    def forget(self, key):
+        self._samples.pop(key, None)
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
+class CursesDisplay(object):
+    """
+    Full screen display of one line per row key, in the order the rows were first set. Lines that do not fit on the
+    screen are not shown. Press q to quit.
+    """
+
+    def __init__(self, title):
+        self.stdscr = curses.initscr()
+        self.stdscr.border(0)
+        self.stdscr.addstr(0, 0, title, curses.A_BOLD)
+        self.stdscr.addstr(1, 1, 'Press q to quit', curses.A_BOLD)
+        self.stdscr.nodelay(1)
+        curses.cbreak()
+        self._rows = {}
+
+    def set_row(self, key, text, bold=False):
+        row = self._rows.setdefault(key, len(self._rows) + 2)
+        if row < self.stdscr.getmaxyx()[0] - 1:
+            width = self.stdscr.getmaxyx()[1] - 2
+            self.stdscr.addstr(row, 1, ' ' * width)  # Clear previous content
+            self.stdscr.addstr(row, 1, text[:width], curses.A_BOLD if bold else curses.A_NORMAL)
+
+    def set_status(self, text):
+        width = self.stdscr.getmaxyx()[1]
+        if width > 50:
+            self.stdscr.addstr(0, 50, ' ' * (width - 51))
+            self.stdscr.addstr(0, 50, text[:width - 51])
+
+    def refresh(self):
+        self.stdscr.refresh()
+
+    def quit_requested(self):
+        return self.stdscr.getch() == ord('q')
+
+    def close(self):
+        curses.endwin()
+
+class LogDisplay(object):
+    """
+    Stand-in for CursesDisplay when there is no terminal (output redirected to a file, cron, containers): rows are
+    printed as log lines, rows that changed at most every interval seconds and finished (bold) rows straight away.
+    """
+
+    def __init__(self, title, interval=10.0, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._rows = {}
+        self._changed = []
+        self._status = ''
+        self._last_print = time.monotonic()
+        self._print(title)
+
+    def _print(self, text):
+        self.stream.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")} {text}\n')
+        self.stream.flush()
+
+    def set_row(self, key, text, bold=False):
+        if self._rows.get(key) == text:
+            return
+        self._rows[key] = text
+        if bold:
+            self._print(text)
+            if key in self._changed:
+                self._changed.remove(key)
+        elif key not in self._changed:
+            self._changed.append(key)
+
+    def set_status(self, text):
+        self._status = text
+
+    def refresh(self):
+        if time.monotonic() - self._last_print < self.interval:
+            return
+        self._last_print = time.monotonic()
+        for key in self._changed:
+            self._print(self._rows[key])
+        self._changed = []
+        if self._status:
+            self._print(self._status)
+
+    def quit_requested(self):
+        return False
+
+    def close(self):
+        pass
+
+def open_display(title, stream=None):
+    """
+    Returns a CursesDisplay when stream (stdout by default) is a terminal, a LogDisplay otherwise.
+    """
+    stream = stream or sys.stdout
+    # curses draws on standard output, so progress meant for another stream (e.g. next to a stdout sink) is logged
+    if stream is sys.stdout and stream.isatty():
+        return CursesDisplay(title)
+    return LogDisplay(title, stream=stream)
@@ -0,0 +1,303 @@
+"""
+Rate limiting and retry helpers shared by the collectors.
+
+The token bucket keeps its state in shared memory so a single limiter can be handed to several
+multiprocessing workers (e.g. one per region) and still enforce one request budget between them.
+"""
+
+import asyncio, multiprocessing, random, threading, time
+
+from for509 import metrics
+
+# Error codes/statuses returned by the cloud APIs when a caller is being throttled
+THROTTLE_ERROR_CODES = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded',
+                        'SlowDown', 'ServerBusy', 'rateLimitExceeded', 'userRateLimitExceeded'}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Indexes into the shared state array of a TokenBucket
+_RATE, _TOKENS, _UPDATED, _CEILING = range(4)
+
+class TokenBucket(object):
+    """
+    Process-shared token bucket with AIMD (additive increase, multiplicative decrease) rate control.
+
+    The bucket starts at the service ceiling. Every throttle response halves the rate and drains the bucket,
+    every successful call adds a little back, so sustained throughput settles just under the ceiling.
+    """
+
+    def __init__(self, rate=2.0, burst=1.0, min_rate=0.1, increase=0.05, decrease=0.5):
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.Array('d', [rate, burst, time.monotonic(), rate], lock=False)
+        self._throttles = multiprocessing.Value('q', 0, lock=False)
+        self._requests = multiprocessing.Value('q', 0, lock=False)
+
+    def _refill(self, now):
+        state = self._state
+        state[_TOKENS] = min(self.burst, state[_TOKENS] + (now - state[_UPDATED]) * state[_RATE])
+        state[_UPDATED] = now
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._state[_TOKENS] >= 1:
+                    self._state[_TOKENS] -= 1
+                    self._requests.value += 1
+                    return
+                wait_time = (1 - self._state[_TOKENS]) / self._state[_RATE]
+            time.sleep(wait_time)
+
+    def on_success(self):
+        with self._lock:
+            self._state[_RATE] = min(self._state[_CEILING], self._state[_RATE] + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._state[_RATE] = max(self.min_rate, self._state[_RATE] * self.decrease)
+            self._state[_TOKENS] = min(self._state[_TOKENS], 0)
+            self._throttles.value += 1
+
+    @property
+    def rate(self):
+        return self._state[_RATE]
+
+    @property
+    def throttles(self):
+        return self._throttles.value
+
+    @property
+    def requests(self):
+        return self._requests.value
+
+class AsyncTokenBucket(object):
+    """
+    asyncio counterpart of TokenBucket, for coroutines sharing one event loop. Same AIMD behaviour, no shared memory.
+    """
+
+    def __init__(self, rate=2.0, burst=1.0, min_rate=0.1, increase=0.05, decrease=0.5):
+        self.rate = rate
+        self.ceiling = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.throttles = 0
+        self.requests = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Waits until a request may be sent. Waiters are served in order.
+        """
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.ceiling, self.rate + self.increase)
+
+    def on_throttle(self):
+        self._refill(time.monotonic())
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = min(self.tokens, 0)
+        self.throttles += 1
+
+class AdaptiveConcurrency(object):
+    """
+    Bounds how many transfers run at once between threads, and tunes that bound while they run.
+
+    Every throttle response (503 ServerBusy and friends) halves the limit. Otherwise the throughput of each interval is
+    compared with the previous one and the limit keeps moving one step in the direction that last improved it, so it
+    settles around the point where more parallel downloads stop adding bandwidth.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=64, interval=10.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.active = 0
+        self.throttles = 0
+        self._cond = threading.Condition()
+        self._step = 1
+        self._bytes = 0
+        self._window_start = time.monotonic()
+        self._last_throughput = None
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, transferred=0):
+        """
+        Frees a slot. transferred is the number of bytes the transfer moved, used to measure throughput.
+        """
+        with self._cond:
+            self.active -= 1
+            self._bytes += transferred
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed >= self.interval:
+                throughput = self._bytes / elapsed
+                if self._last_throughput is not None and throughput < self._last_throughput * 0.95:
+                    self._step = -self._step
+                self.limit = max(self.minimum, min(self.maximum, self.limit + self._step))
+                self._last_throughput = throughput
+                self._bytes = 0
+                self._window_start = now
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.throttles += 1
+            # Start measuring afresh at the new limit and probe upwards from there
+            self._step = 1
+            self._bytes = 0
+            self._window_start = time.monotonic()
+            self._last_throughput = None
+
+class BandwidthLimiter(object):
+    """
+    Caps the combined throughput of threads at bytes_per_second. Transfers report their bytes after moving them and
+    are held back until the average is under the cap again, so the limit applies however the data was fetched.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._available_at = time.monotonic()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._available_at = max(self._available_at, now) + size / self.bytes_per_second
+            delay = self._available_at - now - 1.0  # Allow a one second burst
+        if delay > 0:
+            time.sleep(delay)
+
+def is_throttling_error(error):
+    """
+    Returns True if the exception is a throttling response from AWS (botocore ClientError),
+    Azure (HttpResponseError) or Google (HttpError).
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in THROTTLE_ERROR_CODES or status == 429
+    if getattr(error, 'error_code', None) in THROTTLE_ERROR_CODES:
+        return True
+    # Google reports quota errors as 403 with the reason in the error details
+    details = getattr(error, 'error_details', None)
+    if isinstance(details, list) and any(isinstance(detail, dict) and detail.get('reason') in THROTTLE_ERROR_CODES for detail in details):
+        return True
+    return _status(error) in THROTTLE_STATUS_CODES
+
+def is_server_error(error):
+    """
+    Returns True if the exception is a 5xx response, which is worth retrying (for use as retry_if).
+    """
+    status = _status(error)
+    return isinstance(status, int) and status >= 500
+
+def _status(error):
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return getattr(error, 'status_code', None) or getattr(response, 'status', None) or getattr(getattr(error, 'resp', None), 'status', None)
+
+def _record_attempt(api, wait_start, call_start, throttled=False, retried=False):
+    metrics.observe('for509_rate_limit_wait_seconds', call_start - wait_start, api=api)
+    metrics.observe('for509_api_call_seconds', time.perf_counter() - call_start, api=api)
+    if throttled:
+        metrics.inc('for509_api_throttles_total', api=api)
+    if throttled or retried:
+        metrics.inc('for509_api_retries_total', api=api)
+
+def call_with_backoff(limiter, func, *args, max_attempts=10, base_delay=1.0, max_delay=60.0, retry_on=(), retry_if=None, metric=None, **kwargs):
+    """
+    Calls func(*args, **kwargs) once the limiter allows it. Throttling errors shrink the limiter rate and are retried
+    with full jitter exponential backoff, as are any exception types listed in retry_on and any exception retry_if
+    (e.g. is_server_error) returns True for. Because the call is retried with the same arguments, a paginated walk
+    resumes from the same NextToken instead of starting over.
+    If metric is set, the time waiting on the limiter, the latency of every attempt, retries and throttles are
+    recorded in for509.metrics with it as the api label.
+    """
+    attempt = 0
+    while True:
+        wait_start = time.perf_counter()
+        limiter.acquire()
+        call_start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            retried = isinstance(e, retry_on) or (retry_if is not None and retry_if(e))
+            if metric:
+                _record_attempt(metric, wait_start, call_start, throttled, retried)
+            if throttled:
+                limiter.on_throttle()
+            elif not retried:
+                raise
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+            continue
+        if metric:
+            _record_attempt(metric, wait_start, call_start)
+        limiter.on_success()
+        return result
+
+async def async_call_with_backoff(limiter, func, *args, max_attempts=10, base_delay=1.0, max_delay=60.0, retry_on=(), retry_if=None, metric=None, **kwargs):
+    """
+    Coroutine version of call_with_backoff for an AsyncTokenBucket and a coroutine function.
+    """
+    attempt = 0
+    while True:
+        wait_start = time.perf_counter()
+        await limiter.acquire()
+        call_start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            retried = isinstance(e, retry_on) or (retry_if is not None and retry_if(e))
+            if metric:
+                _record_attempt(metric, wait_start, call_start, throttled, retried)
+            if throttled:
+                limiter.on_throttle()
+            elif not retried:
+                raise
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+            continue
+        if metric:
+            _record_attempt(metric, wait_start, call_start)
+        limiter.on_success()
+        return result
@@ -0,0 +1,114 @@
+"""
+Fair scheduling of work items over a bounded number of workers.
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+class FairScheduler(object):
+    """
+    Hands out work items grouped by owner (e.g. one group per AWS account) so that every group makes progress:
+    the next item always comes from the group with the fewest items running, ties broken round robin.
+    Running at most max_running items at once keeps the worker count bounded however many groups there are.
+    """
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self._queued = OrderedDict()
+        self._running = {}
+
+    def add(self, group, item):
+        self._queued.setdefault(group, deque()).append(item)
+        self._running.setdefault(group, 0)
+
+    def has_capacity(self):
+        return sum(self._running.values()) < self.max_running
+
+    def pending(self):
+        return sum(len(items) for items in self._queued.values())
+
+    def running(self):
+        return sum(self._running.values())
+
+    def next(self):
+        """
+        Returns (group, item) for the next item to start, or None if nothing is queued or no worker is free.
+        """
+        if not self.has_capacity():
+            return None
+        candidates = [group for group, items in self._queued.items() if items]
+        if not candidates:
+            return None
+        group = min(candidates, key=lambda g: self._running[g])
+        item = self._queued[group].popleft()
+        # Move the group to the back so equally loaded groups take turns
+        self._queued.move_to_end(group)
+        self._running[group] += 1
+        return group, item
+
+    def finished(self, group):
+        self._running[group] -= 1
+
+class FairQueue(object):
+    """
+    Thread-safe producer/consumer counterpart of FairScheduler. Each group (e.g. one collection job) has its own
+    bounded queue that its producer blocks on when full, and consumers take items round robin across groups, so a
+    group with millions of items (blobs) cannot starve one with a handful (regions).
+    """
+
+    def __init__(self, max_per_group=1000):
+        self.max_per_group = max_per_group
+        self._cond = threading.Condition()
+        self._queued = OrderedDict()
+        self._open = set()
+        self._cancelled = False
+
+    def open(self, group):
+        with self._cond:
+            self._queued.setdefault(group, deque())
+            self._open.add(group)
+
+    def put(self, group, item):
+        """
+        Queues an item, waiting while the group already has max_per_group items queued. Returns False if the queue was cancelled.
+        """
+        with self._cond:
+            while len(self._queued[group]) >= self.max_per_group and not self._cancelled:
+                self._cond.wait()
+            if self._cancelled:
+                return False
+            self._queued[group].append(item)
+            self._cond.notify_all()
+            return True
+
+    def close(self, group):
+        """
+        Marks the group as having no more items.
+        """
+        with self._cond:
+            self._open.discard(group)
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        Returns (group, item), waiting for one if needed, or None once every group is closed and drained (or the queue was cancelled).
+        """
+        with self._cond:
+            while True:
+                if self._cancelled:
+                    return None
+                for group, items in self._queued.items():
+                    if items:
+                        item = items.popleft()
+                        # Move the group to the back so groups take turns
+                        self._queued.move_to_end(group)
+                        self._cond.notify_all()
+                        return group, item
+                if not self._open:
+                    return None
+                self._cond.wait()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
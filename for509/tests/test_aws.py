@@ -0,0 +1,41 @@
+import time
+
+from for509.aws import EMPTY_REGION_TTL, DiscoveryCache, probe_regions
+from for509.ratelimit import TokenBucket
+
+class FakeSession(object):
+    def __init__(self, events):
+        self.events = events
+
+    def client(self, service, region_name=None):
+        events = self.events
+
+        class Client(object):
+            def lookup_events(self, **kwargs):
+                return {'Events': events.get(region_name, [])}
+
+        return Client()
+
+def test_empty_regions_are_only_cached_briefly(tmp_path):
+    cache = DiscoveryCache(str(tmp_path / 'cache.json'), 24 * 3600)
+    cache.set('regions:123456789012', ['us-east-1'])
+    cache.set('empty:123456789012:us-east-1', True)
+    assert cache.get('empty:123456789012:us-east-1', EMPTY_REGION_TTL)
+    for entry in cache._entries.values():
+        entry['time'] -= EMPTY_REGION_TTL + 1
+    assert cache.get('empty:123456789012:us-east-1', EMPTY_REGION_TTL) is None
+    assert cache.get('regions:123456789012') == ['us-east-1']
+
+def test_probes_go_through_the_region_limiters(tmp_path):
+    cache = DiscoveryCache(str(tmp_path / 'cache.json'), 24 * 3600)
+    session = FakeSession({'us-east-1': [{'EventId': '1'}]})
+    limiters = {('123456789012', region): TokenBucket(rate=100.0) for region in ('us-east-1', 'eu-west-1')}
+    empty = probe_regions(cache, [('123456789012', region, session) for region in ('us-east-1', 'eu-west-1')], limiters)
+    assert empty == {('123456789012', 'eu-west-1')}
+    assert all(limiter.requests == 1 for limiter in limiters.values())
+
+    # Probed again once the emptiness has expired, even though the cache is still valid for a day
+    for entry in cache._entries.values():
+        entry['time'] = time.time() - EMPTY_REGION_TTL - 1
+    session.events['eu-west-1'] = [{'EventId': '2'}]
+    assert probe_regions(cache, [('123456789012', 'eu-west-1', session)], limiters) == set()
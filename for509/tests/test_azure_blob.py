@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+from urllib.parse import unquote, urlparse
+
+from bench.fakes import BlobFake, ElasticsearchFake
+from for509.azure import partition_time
+from for509.checkpoint import CheckpointStore
+from for509.collector import Engine
+from for509.plugins import load_script
+
+script = load_script(os.path.join('Azure', 'download_blobs_multithreaded.py'), 'for509_azure_blob_download')
+
+class FailingBlobFake(BlobFake):
+    """
+    Refuses to serve the blob named failing, while it is set.
+    """
+
+    failing = None
+
+    def handle(self, method, path, headers, body):
+        if self.failing and unquote(urlparse(path).path).endswith(self.failing):
+            return 403, {'x-ms-error-code': 'AuthorizationFailure', 'Content-Type': 'application/xml'}, \
+                b'<?xml version="1.0" encoding="utf-8"?><Error><Code>AuthorizationFailure</Code></Error>'
+        return super().handle(method, path, headers, body)
+
+def run(fake, output_directory, sink=None):
+    args = argparse.Namespace(connection_string=[fake.connection_string()], accounts_file=None, containers=[fake.container],
+                              output_directory=output_directory, checkpoint_db=None, full=False, lookback_hours=1,
+                              concurrency=4, max_concurrency=4, sink=sink, no_local_copy=sink is not None, blake3=False,
+                              manifest_key_file=None, metrics_file=None, metrics_summary=None, metrics_port=None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        script.main(args)
+
+def downloaded(output_directory, fake):
+    container_path = os.path.join(output_directory, 'devstoreaccount1', fake.container)
+    return {name for name in fake.names if os.path.exists(os.path.join(container_path, name))}
+
+def test_failed_blob_is_listed_again_by_the_next_incremental_run(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    # Eight hourly partitions of one blob each; the oldest fails the first time
+    with FailingBlobFake(events=800, events_per_blob=100, resources=1) as fake:
+        oldest = min(fake.names, key=partition_time)
+        fake.failing = oldest
+        run(fake, str(tmp_path))
+        assert downloaded(str(tmp_path), fake) == set(fake.names) - {oldest}
+        assert not glob.glob(os.path.join(str(tmp_path), '**', '*.part'), recursive=True)
+
+        store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite'))
+        checkpoint = store.load(script.CONTAINER_COLLECTOR, 'devstoreaccount1/' + fake.container)
+        store.close()
+        assert checkpoint.cursor['newest_partition'] == partition_time(oldest).isoformat()
+
+        fake.failing = None
+        run(fake, str(tmp_path))
+        assert downloaded(str(tmp_path), fake) == set(fake.names)
+
+def test_checkpoints_of_earlier_versions_are_moved_to_the_default_name(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    with BlobFake(events=400, events_per_blob=100, resources=1) as fake:
+        run(fake, str(tmp_path))
+        os.replace(str(tmp_path / 'checkpoints.sqlite'), str(tmp_path / '.checkpoints.sqlite'))
+        container_path = os.path.join(str(tmp_path), 'devstoreaccount1', fake.container)
+        inodes = {name: os.stat(os.path.join(container_path, name)).st_ino for name in fake.names}
+
+        run(fake, str(tmp_path))
+        assert not os.path.exists(str(tmp_path / '.checkpoints.sqlite'))
+        # Nothing was downloaded again
+        assert {name: os.stat(os.path.join(container_path, name)).st_ino for name in fake.names} == inodes
+
+def test_engine_counts_failed_blobs(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    with FailingBlobFake(events=800, events_per_blob=100, resources=1) as fake:
+        fake.failing = min(fake.names, key=partition_time)
+        engine = Engine(str(tmp_path), max_concurrency=4)
+        engine.add_job('blobs', 'azure-blob', {'connection_strings': [fake.connection_string()], 'containers': [fake.container],
+                                               'lookback_hours': 1})
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = engine.run()
+        events, size, failures = results['blobs']
+        assert failures == 1
+        assert events == len(fake.names) - 1
+
+class DocumentsFake(ElasticsearchFake):
+    """
+    Keeps the last document received under each ID.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.documents = {}
+
+    def handle(self, method, path, headers, body):
+        lines = body.split(b'\n')
+        for action, document in zip(lines[0::2], lines[1::2]):
+            self.documents[json.loads(action)['index']['_id']] = json.loads(document)
+        return super().handle(method, path, headers, body)
+
+def test_sink_only_resume_sends_only_whole_records(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    with BlobFake(events=200, events_per_blob=100, resources=2) as fake, DocumentsFake() as sink:
+        appended, rewritten = fake.names
+        records = [{'time': '2024-01-15T10:00:00Z', 'index': index} for index in range(3)]
+        fake.blobs[rewritten] = json.dumps({'records': records[:2]}).encode()
+        run(fake, str(tmp_path), f'elasticsearch+{sink.url}/logs')
+        assert len(sink.documents) == 102
+
+        # An NDJSON blob grows by whole lines, the older format is rewritten as one object
+        fake.blobs[appended] += b'{"time": "2024-01-15T10:00:00Z", "index": 100}\n'
+        fake.blobs[rewritten] = json.dumps({'records': records}).encode()
+        received = sink.received
+        run(fake, str(tmp_path), f'elasticsearch+{sink.url}/logs')
+        # The new line alone, and the rewritten blob again
+        assert sink.received - received == 1 + 3
+        assert len(sink.documents) == 104
+        assert sorted(document['index'] for document in sink.documents.values() if 'properties' not in document) == [0, 1, 2, 100]
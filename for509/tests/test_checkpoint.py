@@ -0,0 +1,43 @@
+from for509.checkpoint import CheckpointStore, OutputFile, truncate_to_checkpoint
+
+def test_checkpoint_survives_reopening(tmp_path):
+    path = str(tmp_path / 'checkpoints.sqlite')
+    output = str(tmp_path / 'events.json')
+    store = CheckpointStore(path)
+    assert store.load('cloudtrail', '111111111111:us-east-1') is None
+    store.commit('cloudtrail', '111111111111:us-east-1', {'token': 'a'}, 10, [OutputFile(output, 100, 10)])
+    store.commit('cloudtrail', '111111111111:us-east-1', {'token': 'b'}, 20, [OutputFile(output, 250, 20)])
+    store.close()
+
+    store = CheckpointStore(path)
+    checkpoint = store.load('cloudtrail', '111111111111:us-east-1')
+    store.close()
+    assert checkpoint.cursor == {'token': 'b'}
+    assert checkpoint.events == 20 and not checkpoint.done
+    # A grown output replaces its earlier offset
+    assert checkpoint.outputs == [OutputFile(output, 250, 20)]
+
+def test_clear_forgets_one_scope_or_the_whole_collector(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite'))
+    for scope in ('111111111111:us-east-1', '111111111111:eu-west-1', '222222222222:us-east-1'):
+        store.commit('cloudtrail', scope, {'token': scope}, 1, done=True)
+    store.commit('gws', 'login', {'start': '2024-01-01'}, 1, done=True)
+
+    store.clear('cloudtrail', '111111111111:us-east-1')
+    assert set(store.load_all('cloudtrail')) == {'111111111111:eu-west-1', '222222222222:us-east-1'}
+    store.clear('cloudtrail')
+    assert store.load_all('cloudtrail') == {}
+    assert store.load('gws', 'login').done
+    store.close()
+
+def test_output_is_cut_back_to_the_last_commit(tmp_path):
+    output = tmp_path / 'events.json'
+    output.write_bytes(b'{"a": 1}\n{"b": 2}\n{"c"')
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite'))
+    store.commit('gws', 'login', {'start': '2024-01-01'}, 2, [OutputFile(str(output), 18, 2)])
+    checkpoint = store.load('gws', 'login')
+    store.close()
+
+    assert truncate_to_checkpoint(checkpoint, str(output)) == 18
+    assert output.read_bytes() == b'{"a": 1}\n{"b": 2}\n'
+    assert truncate_to_checkpoint(checkpoint, str(tmp_path / 'other.json')) is None
@@ -0,0 +1,95 @@
+import gzip
+import glob
+import json
+import os
+import queue
+import time
+
+import pytest
+
+pytest.importorskip('aiobotocore')
+
+from bench.fakes import CloudTrailFake
+from for509.checkpoint import CheckpointStore
+from for509.cloudtrail import CHECKPOINT_COLLECTOR, DEFAULT_OUTPUT_CONFIG
+from for509.cloudtrail_async import AsyncEngine
+from for509.plugins import load_script
+
+script = load_script(os.path.join('AWS', 'Cloudtrail_downloadv2.py'), 'for509_cloudtrail_download')
+
+ACCOUNT = '111111111111'
+SESSION_PARAMS = {'aws_access_key_id': 'AKIDTEST', 'aws_secret_access_key': 'test', 'aws_session_token': None, 'account_id': ACCOUNT}
+
+class FailingCloudTrailFake(CloudTrailFake):
+    """
+    Refuses the pages from event index fail_from on, while it is set.
+    """
+
+    fail_from = None
+
+    def handle(self, method, path, headers, body):
+        token = json.loads(body or b'{}').get('NextToken')
+        if self.fail_from is not None and token and int(token) >= self.fail_from:
+            return 400, {'Content-Type': 'application/x-amz-json-1.1'}, b'{"__type":"AccessDeniedException","message":"denied"}'
+        return super().handle(method, path, headers, body)
+
+def download(directory, rate=1000.0):
+    engine = AsyncEngine(str(directory), queue.Queue(), str(directory / 'checkpoints.sqlite'), script.encode_event,
+                         dict(DEFAULT_OUTPUT_CONFIG, max_events=100), max_concurrency=4).start()
+    return engine, engine.submit(SESSION_PARAMS, 'us-east-1', rate)
+
+def event_ids(directory):
+    ids = []
+    for path in glob.glob(os.path.join(str(directory), f'{ACCOUNT}_CloudTrail_us-east-1_*.json.gz')):
+        with gzip.open(path) as f:
+            ids.extend(record['eventID'] for record in json.load(f)['Records'])
+    return ids
+
+def checkpoint(directory):
+    store = CheckpointStore(str(directory / 'checkpoints.sqlite'))
+    try:
+        return store.load(CHECKPOINT_COLLECTOR, f'{ACCOUNT}:us-east-1')
+    finally:
+        store.close()
+
+def test_region_that_fails_midway_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    with FailingCloudTrailFake(events=600, record_size=100) as fake:
+        monkeypatch.setenv('AWS_ENDPOINT_URL_CLOUDTRAIL', fake.url)
+        fake.fail_from = 350
+        engine, task = download(tmp_path)
+        task.join()
+        engine.stop()
+        assert task.exitcode == 1
+        # Only whole files of 100 events are committed; the events after the last one are fetched again
+        assert not checkpoint(tmp_path).done
+        assert sorted(event_ids(tmp_path)) == sorted(set(event_ids(tmp_path)))
+        assert len(event_ids(tmp_path)) == checkpoint(tmp_path).events == 300
+
+        fake.fail_from = None
+        engine, task = download(tmp_path)
+        task.join()
+        engine.stop()
+        assert task.exitcode == 0
+        assert checkpoint(tmp_path).done
+        ids = event_ids(tmp_path)
+        assert len(ids) == len(set(ids)) == 600
+
+def test_stop_cancels_running_downloads_and_leaves_them_resumable(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    with CloudTrailFake(events=600, record_size=100) as fake:
+        monkeypatch.setenv('AWS_ENDPOINT_URL_CLOUDTRAIL', fake.url)
+        # Five pages a second: the download is still running when the engine is stopped
+        engine, task = download(tmp_path, rate=5.0)
+        while task.progress.events < 150 and not task.future.done():
+            time.sleep(0.05)
+        engine.stop()
+        assert task.exitcode == 1
+        assert not checkpoint(tmp_path).done
+
+        engine, task = download(tmp_path)
+        task.join()
+        engine.stop()
+        assert task.exitcode == 0
+        ids = event_ids(tmp_path)
+        assert len(ids) == len(set(ids)) == 600
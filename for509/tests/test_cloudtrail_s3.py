@@ -0,0 +1,59 @@
+import argparse
+import contextlib
+import glob
+import io
+import os
+from urllib.parse import unquote, urlparse
+
+from bench.fakes import TrailBucketFake
+from for509.checkpoint import CheckpointStore
+from for509.plugins import load_script
+
+script = load_script(os.path.join('AWS', 'Cloudtrail_s3_download.py'), 'for509_cloudtrail_s3_download')
+
+class FailingTrailBucketFake(TrailBucketFake):
+    """
+    Refuses to serve the object with key failing, while it is set.
+    """
+
+    failing = None
+
+    def handle(self, method, path, headers, body):
+        if self.failing and unquote(urlparse(path).path).endswith('/' + self.failing):
+            return self._error(403, 'AccessDenied')
+        return super().handle(method, path, headers, body)
+
+def run(fake, output_directory):
+    args = argparse.Namespace(bucket=fake.bucket, prefix='', output_directory=output_directory, start=None, end=None, accounts=None,
+                              regions=None, full=False, lookback_hours=3, concurrency=4, max_concurrency=4,
+                              access_key_id='AKIDTEST', secret_key='test', session_token=None, profile='default', role_arn=None,
+                              external_id=None, region='us-east-1', checkpoint_db=None, sink=None, no_local_copy=False, blake3=False,
+                              manifest_key_file=None, metrics_file=None, metrics_summary=None, metrics_port=None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        script.main(args)
+
+def downloaded(output_directory, fake):
+    return {key for key in fake.keys if os.path.exists(os.path.join(output_directory, fake.bucket, key))}
+
+def test_failed_object_is_listed_again_by_the_next_incremental_run(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    # Two log files in each of two accounts and two regions; the oldest fails the first time
+    with FailingTrailBucketFake(events=800, events_per_file=100, record_size=100) as fake:
+        monkeypatch.setenv('AWS_ENDPOINT_URL_S3', fake.url)
+        oldest = min(fake.keys, key=lambda key: key.rsplit('_', 1)[0][-14:])
+        fake.failing = oldest
+        run(fake, str(tmp_path))
+        assert downloaded(str(tmp_path), fake) == set(fake.keys) - {oldest}
+        assert not glob.glob(os.path.join(str(tmp_path), '**', '*.part'), recursive=True)
+
+        # The region of the failed file keeps no cursor, the others move on
+        account, region = oldest.split('/')[2], oldest.split('/')[4]
+        store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite'))
+        cursors = store.load_all(script.REGION_COLLECTOR)
+        store.close()
+        assert len(cursors) == 3
+        assert not any(scope.endswith(f'/{account}/{region}') for scope in cursors)
+
+        fake.failing = None
+        run(fake, str(tmp_path))
+        assert downloaded(str(tmp_path), fake) == set(fake.keys)
@@ -0,0 +1,133 @@
+import glob
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from for509.cloudtrail import DEFAULT_OUTPUT_CONFIG, RegionOutput
+from for509.plugins import load_script
+from for509.progress import ProgressCounter
+
+script = load_script(os.path.join('AWS', 'Cloudtrail_downloadv2.py'), 'for509_cloudtrail_download')
+
+ACCOUNT = '111111111111'
+NEWEST = datetime(2024, 1, 15, 12, 0, 0, tzinfo=timezone.utc)
+
+def make_events(count, per_second):
+    # Newest first, several events to a second like a busy region
+    return [{'EventId': f'{index:06d}', 'EventTime': NEWEST - timedelta(seconds=index // per_second),
+             'CloudTrailEvent': json.dumps({'eventID': f'{index:06d}'})} for index in range(count)]
+
+class FakeLookup(object):
+    """
+    LookupEvents over a list of events, with the inclusive StartTime/EndTime filters, MaxResults and NextToken. Fails
+    every call after the first fail_after ones, while that is set.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.calls = 0
+        self.fail_after = None
+        self.lock = threading.Lock()
+
+    def __call__(self, StartTime, EndTime, MaxResults=50, NextToken=None):
+        with self.lock:
+            self.calls += 1
+            if self.fail_after is not None and self.calls > self.fail_after:
+                raise IOError('connection reset')
+        matching = [event for event in self.events if StartTime <= event['EventTime'] <= EndTime]
+        first = int(NextToken) if NextToken else 0
+        page = {'Events': matching[first:first + MaxResults]}
+        if first + MaxResults < len(matching):
+            page['NextToken'] = str(first + MaxResults)
+        return page
+
+def walk(lookup, time_slice, split_events):
+    # Walks a slice and whatever it is split into, returning the IDs of the events handed over and the slices walked
+    ids, walked = [], []
+    remaining = [time_slice]
+    while remaining:
+        time_slice = remaining.pop()
+        walked.append(time_slice)
+        remaining.extend(script.walk_time_slice(lookup, time_slice, split_events,
+                                                lambda time_slice, events, next_token: ids.extend(script.event_ids(events))))
+    return ids, walked
+
+def downloaded_ids(directory):
+    ids = []
+    for path in glob.glob(os.path.join(str(directory), f'{ACCOUNT}_CloudTrail_us-east-1_*.json.gz')):
+        with gzip.open(path) as f:
+            ids.extend(record['eventID'] for record in json.load(f)['Records'])
+    return ids
+
+def region_output(directory):
+    # Without dedup, so that an event written twice shows up in the files
+    return RegionOutput(str(directory / 'checkpoints.sqlite'), ACCOUNT, 'us-east-1', str(directory),
+                        dict(DEFAULT_OUTPUT_CONFIG, max_events=100, dedup=False), ProgressCounter())
+
+def test_time_slices_cover_the_window_without_overlapping():
+    start = NEWEST - timedelta(hours=5, minutes=30)
+    slices = script.build_time_slices(start, NEWEST, 2)
+    assert [datetime.fromisoformat(time_slice['EndTime']) for time_slice in slices[:1]] == [NEWEST]
+    assert datetime.fromisoformat(slices[-1]['StartTime']) == start
+    for newer, older in zip(slices, slices[1:]):
+        assert datetime.fromisoformat(older['EndTime']) == datetime.fromisoformat(newer['StartTime']) - timedelta(seconds=1)
+    assert len(slices) == 3
+
+def test_adjacent_slices_share_no_events():
+    events = make_events(600, 3)
+    lookup = FakeLookup(events)
+    ids = []
+    for time_slice in script.build_time_slices(events[-1]['EventTime'], NEWEST, 0.01):
+        ids.extend(walk(lookup, time_slice, 100000)[0])
+    assert sorted(ids) == script.event_ids(events)
+
+def test_dense_slice_is_split_where_it_was_read_up_to():
+    # Three events a second, so the pages of 50 end in the middle of a second
+    events = make_events(1000, 3)
+    lookup = FakeLookup(events)
+    time_slice = {'StartTime': events[-1]['EventTime'].isoformat(), 'EndTime': NEWEST.isoformat()}
+    halves = script.walk_time_slice(lookup, time_slice, 100, lambda *args: None)
+    assert len(halves) == 2
+    newer, older = halves
+    assert newer['SkipEventIds']
+    assert datetime.fromisoformat(older['EndTime']) == datetime.fromisoformat(newer['StartTime']) - timedelta(seconds=1)
+    assert older['StartTime'] == time_slice['StartTime']
+
+    ids, walked = walk(FakeLookup(events), dict(time_slice), 100)
+    assert len(walked) > 3
+    assert sorted(ids) == script.event_ids(events)
+
+def test_sliced_download_writes_every_event_once(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    events = make_events(2000, 3)
+    output = region_output(tmp_path)
+    slices = script.build_time_slices(events[-1]['EventTime'], NEWEST, 0.1)
+    total = script.sliceDownload(FakeLookup(events), slices, 0, {'workers': 4, 'split_events': 200}, output, script.encode_event, ProgressCounter())
+    output.close()
+    assert total == 2000
+    assert sorted(downloaded_ids(tmp_path)) == script.event_ids(events)
+
+def test_interrupted_sliced_download_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setenv('FOR509_MANIFEST_KEY', 'test')
+    events = make_events(2000, 3)
+    lookup = FakeLookup(events)
+    lookup.fail_after = 25
+    slice_config = {'workers': 4, 'split_events': 200}
+    output = region_output(tmp_path)
+    slices = script.build_time_slices(events[-1]['EventTime'], NEWEST, 0.1)
+    with pytest.raises(IOError):
+        script.sliceDownload(lookup, slices, 0, slice_config, output, script.encode_event, ProgressCounter())
+    output.close()
+    assert 0 < len(downloaded_ids(tmp_path)) < 2000
+
+    lookup.fail_after = None
+    output = region_output(tmp_path)
+    assert output.cursor['Slices']
+    total = script.sliceDownload(lookup, output.cursor['Slices'], output.events, slice_config, output, script.encode_event, ProgressCounter())
+    output.close()
+    assert total == 2000
+    assert sorted(downloaded_ids(tmp_path)) == script.event_ids(events)
@@ -0,0 +1,75 @@
+import io
+import threading
+import time
+
+from for509 import collector as collector_module
+from for509.collector import Collector, Engine
+from for509.progress import LogDisplay
+
+# Tasks run by the collectors below, in order, as (job name, task)
+started = []
+started_lock = threading.Lock()
+
+class CountingCollector(Collector):
+    """
+    Job of options['tasks'] tasks of one event each, taking options['seconds'] each, of which the ones in
+    options['failing'] raise.
+    """
+
+    DEFAULT_OPTIONS = {'tasks': 10, 'seconds': 0.0, 'failing': ()}
+
+    def tasks(self):
+        for index in range(self.options['tasks']):
+            yield index
+
+    def run_task(self, task):
+        with started_lock:
+            started.append((self.options['name'], task))
+        time.sleep(self.options['seconds'])
+        if task in self.options['failing']:
+            raise IOError('download failed')
+        self.context.account(1, 100)
+
+class BrokenListingCollector(CountingCollector):
+    def tasks(self):
+        yield 0
+        raise IOError('listing failed')
+
+COLLECTOR = f'{__name__}:CountingCollector'
+
+def run(engine):
+    return engine.run(sample_interval=0.05, stream=io.StringIO())
+
+def test_jobs_take_turns(tmp_path):
+    del started[:]
+    engine = Engine(str(tmp_path), max_concurrency=1)
+    engine.add_job('blobs', COLLECTOR, {'name': 'blobs', 'tasks': 200, 'seconds': 0.002})
+    engine.add_job('regions', COLLECTOR, {'name': 'regions', 'tasks': 5, 'seconds': 0.002})
+    results = run(engine)
+    assert results == {'blobs': (200, 20000, 0), 'regions': (5, 500, 0)}
+    # The job with a handful of tasks is not left waiting behind the one with many
+    assert [name for name, _ in started[:20]].count('regions') == 5
+
+def test_failed_tasks_are_counted(tmp_path):
+    engine = Engine(str(tmp_path), max_concurrency=4)
+    engine.add_job('blobs', COLLECTOR, {'name': 'blobs', 'tasks': 10, 'failing': (3, 7)})
+    engine.add_job('listing', f'{__name__}:BrokenListingCollector', {'name': 'listing'})
+    results = run(engine)
+    assert results['blobs'] == (8, 800, 2)
+    assert results['listing'] == (1, 100, 1)
+
+class QuittingDisplay(LogDisplay):
+    def quit_requested(self):
+        return True
+
+def test_quit_cancels_the_tasks_not_started(tmp_path, monkeypatch):
+    monkeypatch.setattr(collector_module, 'open_display', lambda title, stream=None: QuittingDisplay(title, stream=io.StringIO()))
+    engine = Engine(str(tmp_path), max_concurrency=2)
+    engine.add_job('quitting', COLLECTOR, {'name': 'quitting', 'tasks': 500, 'seconds': 0.01})
+    start = time.monotonic()
+    events, _, failures = run(engine)['quitting']
+    assert time.monotonic() - start < 2
+    # The tasks already running when q was pressed finish and are counted
+    assert events < 500
+    assert events == sum(1 for name, _ in started if name == 'quitting')
+    assert failures == 0
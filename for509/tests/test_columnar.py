@@ -0,0 +1,84 @@
+import gzip
+import importlib.util
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from for509.columnar import ColumnarConverter, find_inputs, parse_time, query
+
+requires_pyarrow = pytest.mark.skipif(importlib.util.find_spec('pyarrow') is None, reason='requires pyarrow')
+
+def activity(index):
+    return json.dumps({'id': {'time': f'2024-01-15T10:{index // 60:02d}:{index % 60:02d}.000Z', 'uniqueQualifier': str(index),
+                              'applicationName': 'login', 'customerId': 'C0000000'},
+                       'actor': {'email': 'user@example.com'}, 'events': [{'name': 'login_success'}]})
+
+def convert(input_directory, output_directory):
+    converter = ColumnarConverter(str(output_directory))
+    stats = converter.convert(str(input_directory))
+    converter.close()
+    return stats
+
+def event_ids(output_directory):
+    return sorted(query(str(output_directory), columns=['event_id']).column('event_id').to_pylist(), key=int)
+
+@requires_pyarrow
+def test_line_being_written_is_converted_once_complete(tmp_path):
+    logs = tmp_path / 'logs' / 'login_logs.json'
+    logs.parent.mkdir()
+    lines = [activity(index) + '\n' for index in range(3)]
+    logs.write_text(lines[0] + lines[1] + lines[2][:20])
+    convert(logs.parent, tmp_path / 'columnar')
+    assert event_ids(tmp_path / 'columnar') == ['0', '1']
+
+    logs.write_text(''.join(lines))
+    convert(logs.parent, tmp_path / 'columnar')
+    assert event_ids(tmp_path / 'columnar') == ['0', '1', '2']
+
+@requires_pyarrow
+def test_unreadable_file_keeps_no_rows_and_is_converted_again(tmp_path):
+    logs = tmp_path / 'logs' / 'login_logs.json.gz'
+    logs.parent.mkdir()
+    content = gzip.compress(''.join(activity(index) + '\n' for index in range(3)).encode())
+    # A gzip member cut short
+    logs.write_bytes(content[:-10])
+    stats = convert(logs.parent, tmp_path / 'columnar')
+    assert stats['errors'] == 1 and stats['rows'] == 0
+
+    logs.write_bytes(content)
+    convert(logs.parent, tmp_path / 'columnar')
+    assert event_ids(tmp_path / 'columnar') == ['0', '1', '2']
+
+def test_parse_time_reads_every_source_as_utc():
+    expected = datetime(2024, 1, 15, 10, 0, 1, 123456, tzinfo=timezone.utc)
+    assert parse_time('2024-01-15T10:00:01.123456Z') == expected
+    # Azure gives seven digits of fraction, GWS three
+    assert parse_time('2024-01-15T10:00:01.1234567Z') == expected
+    assert parse_time('2024-01-15T10:00:01.123Z') == expected.replace(microsecond=123000)
+    assert parse_time('2024-01-15T12:00:01.123456+02:00') == expected
+    assert parse_time('2024-01-15') == datetime(2024, 1, 15, tzinfo=timezone.utc)
+
+def test_find_inputs_recognizes_the_output_of_each_collector(tmp_path):
+    names = [
+        'aws/AWSLogs/111111111111/CloudTrail/us-east-1/2024/01/15/111111111111_CloudTrail_us-east-1_20240115T1000Z_abc.json.gz',
+        'aws/111111111111_CloudTrail_eu-west-1_20240115T100000Z_1.ndjson',
+        'azure/devstoreaccount1/insights-logs-storageread/resourceId=/SUBSCRIPTIONS/ABCD-1234/RESOURCEGROUPS/RG/y=2024/PT1H.json',
+        'gws/login_logs.json.zst',
+        'gws/admin_logs.json',
+        'gws/notes.txt',
+        'aws/manifest-cloudtrail-20240115T100000Z-1.jsonl',
+    ]
+    for name in names:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('')
+    found = {os.path.relpath(path, tmp_path): rest for path, *rest in find_inputs(str(tmp_path))}
+    assert found == {
+        names[0]: ['cloudtrail', '111111111111', 'us-east-1', 'gzip'],
+        names[1]: ['cloudtrail', '111111111111', 'eu-west-1', None],
+        names[2]: ['azure', 'abcd-1234', '', None],
+        names[3]: ['gws', '', 'login', 'zstd'],
+        names[4]: ['gws', '', 'admin', None],
+    }
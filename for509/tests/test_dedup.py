@@ -0,0 +1,37 @@
+from for509.dedup import SeenSet
+
+def test_add_reports_new_keys_only(tmp_path):
+    seen = SeenSet(str(tmp_path / 'seen'), capacity=100, buffer_size=10)
+    assert seen.add('a') and seen.add('b')
+    assert not seen.add('a')
+    # Enough keys to spill pending runs and chain a second filter
+    assert all(seen.add(str(index)) for index in range(500))
+    assert not any(seen.add(str(index)) for index in range(500))
+    assert len(seen) == 502
+    seen.close()
+
+def test_committed_keys_survive_reopening(tmp_path):
+    directory = str(tmp_path / 'seen')
+    seen = SeenSet(directory, buffer_size=10)
+    for index in range(50):
+        seen.add(str(index))
+    seen.commit()
+    seen.add('uncommitted')
+    seen.close()
+
+    seen = SeenSet(directory, buffer_size=10)
+    assert len(seen) == 50
+    assert not any(seen.add(str(index)) for index in range(50))
+    # Keys added after the last commit are forgotten, so their records are written again
+    assert seen.add('uncommitted')
+    seen.close()
+
+def test_reset_forgets_every_key(tmp_path):
+    directory = str(tmp_path / 'seen')
+    seen = SeenSet(directory)
+    seen.add('a')
+    seen.commit()
+    seen.reset()
+    assert len(seen) == 0
+    assert seen.add('a')
+    seen.close()
@@ -0,0 +1,54 @@
+import json
+import os
+from datetime import timedelta
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.discovery import build
+
+from bench.fakes import ReportsFake
+from for509.plugins import load_script
+
+script = load_script(os.path.join('GWS', 'gws-log-collection', 'gws-get-logs.py'), 'for509_gws_get_logs')
+
+class FailingReportsFake(ReportsFake):
+    """
+    Rejects the listings that start after fail_after, while it is set.
+    """
+
+    fail_after = None
+
+    def handle(self, method, path, headers, body):
+        start = parse_qs(urlparse(path).query).get('startTime')
+        if self.fail_after and start and self._parse(start[0]) > self.fail_after:
+            return 400, {'Content-Type': 'application/json'}, b'{"error":{"code":400,"message":"Bad Request"}}'
+        return super().handle(method, path, headers, body)
+
+def collect(fake, output_path, monkeypatch):
+    monkeypatch.setattr(script.Google, 'google_session', lambda self: build(
+        'admin', 'reports_v1', http=httplib2.Http(), static_discovery=True, client_options={'api_endpoint': fake.endpoint}))
+    google = script.Google(creds_path=None, delegated_creds=None, output_path=output_path, apps=['drive'],
+                           update=True, overwrite=False, shards=4)
+    try:
+        google.get_logs()
+    finally:
+        google.close()
+    return google
+
+def test_failed_shard_is_collected_by_the_next_update(tmp_path, monkeypatch):
+    with FailingReportsFake(events=3000) as fake:
+        # Four shards of 45 days over the default 180; the newest one fails
+        fake.fail_after = fake.timeline.newest - timedelta(days=60)
+        google = collect(fake, str(tmp_path), monkeypatch)
+        assert google.failed_apps == ['drive']
+        with open(tmp_path / 'drive_logs.json') as f:
+            first = [json.loads(line)['id']['time'] for line in f]
+        assert first and first == sorted(first)
+        assert first[-1] < fake._rfc3339(fake.timeline.newest - timedelta(days=44))
+
+        fake.fail_after = None
+        google = collect(fake, str(tmp_path), monkeypatch)
+        assert google.failed_apps == []
+        with open(tmp_path / 'drive_logs.json') as f:
+            ids = [json.loads(line)['id']['uniqueQualifier'] for line in f]
+        assert len(ids) == len(set(ids)) == 3000
@@ -0,0 +1,80 @@
+import hashlib
+import json
+
+from for509 import integrity
+
+def write_run(tmp_path):
+    # A run that writes one file and appends to it
+    manifest = integrity.RunManifest(str(tmp_path), 'test')
+    path = tmp_path / 'events.json'
+    for offset, data in ((0, b'{"a": 1}\n'), (9, b'{"b": 2}\n')):
+        with open(path, 'ab') as f:
+            f.write(data)
+        hasher = integrity.hasher()
+        hasher.update(data)
+        integrity.record(str(path), len(data), hasher.hexdigests(), offset=offset)
+    return manifest.close(), path
+
+def test_finished_run_verifies(tmp_path, monkeypatch):
+    monkeypatch.setenv(integrity.KEY_ENV, 'test')
+    manifest, path = write_run(tmp_path)
+    assert integrity.verify(manifest, b'test') == []
+    with open(manifest) as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry.get('offset') for entry in entries if 'path' in entry] == [0, 9]
+    # The manifest is only in effect while the run is open
+    assert integrity.hasher() is None
+
+def test_changed_files_and_manifests_are_reported(tmp_path, monkeypatch):
+    monkeypatch.setenv(integrity.KEY_ENV, 'test')
+    manifest, path = write_run(tmp_path)
+    assert integrity.verify(manifest, b'other') == [f'bad signature (signed with key {integrity.key_id(b"test")}, '
+                                                    f'checked with key {integrity.key_id(b"other")})']
+
+    path.write_bytes(b'{"a": 1}\n{"b": 3}\n')
+    assert integrity.verify(manifest, b'test') == ['events.json: bytes 9-18 do not match their digests']
+    assert integrity.verify(manifest, b'test', check_files=False) == []
+
+    path.unlink()
+    assert integrity.verify(manifest, b'test') == ['events.json: missing', 'events.json: missing']
+
+def test_unfinished_run_has_no_signature(tmp_path, monkeypatch):
+    monkeypatch.setenv(integrity.KEY_ENV, 'test')
+    manifest = integrity.RunManifest(str(tmp_path), 'test')
+    try:
+        assert integrity.verify(manifest.path, b'test') == ['no signature (the run did not finish)']
+    finally:
+        manifest.close()
+
+def write_chunks(path, chunks, max_pending):
+    # Writes (offset, data) chunks in the order given, like a parallel download, and returns the HashingFile
+    with open(path, 'wb') as f:
+        target = integrity.HashingFile(f, integrity.Hasher(('sha256',)), max_pending)
+        for offset, data in chunks:
+            target.seek(offset)
+            target.write(data)
+    return target
+
+def test_out_of_order_chunks_are_hashed_in_file_order(tmp_path):
+    data = bytes(range(256)) * 64
+    chunks = [(offset, data[offset:offset + 1024]) for offset in range(0, len(data), 1024)]
+    target = write_chunks(str(tmp_path / 'blob'), chunks[1:] + chunks[:1], 1024 * 1024)
+    assert target.complete()
+    assert target.finish()
+    assert target.hasher.hexdigests() == {'sha256': hashlib.sha256(data).hexdigest()}
+
+def test_chunks_past_the_pending_cap_are_read_back(tmp_path):
+    data = bytes(range(256)) * 64
+    chunks = [(offset, data[offset:offset + 1024]) for offset in range(0, len(data), 1024)]
+    # The first chunk comes last, so every other one would be held
+    target = write_chunks(str(tmp_path / 'blob'), chunks[1:] + chunks[:1], 4096)
+    assert not target._pending
+    assert not target.complete()
+    assert target.finish()
+    assert target.hasher.size == len(data)
+    assert target.hasher.hexdigests() == {'sha256': hashlib.sha256(data).hexdigest()}
+
+def test_missing_chunks_leave_the_hash_incomplete(tmp_path):
+    data = bytes(range(256)) * 16
+    chunks = [(offset, data[offset:offset + 1024]) for offset in range(0, len(data), 1024)]
+    assert not write_chunks(str(tmp_path / 'blob'), chunks[1:], 1024 * 1024).finish()
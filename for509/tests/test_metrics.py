@@ -0,0 +1,63 @@
+import json
+import os
+
+from for509 import metrics
+from for509.metrics import BUCKETS, Registry, summary, to_prometheus
+
+def test_prometheus_text_format():
+    registry = Registry()
+    registry.inc('for509_api_throttles_total', api='s3:GetObject')
+    registry.inc('for509_api_throttles_total', 2, api='s3:GetObject')
+    registry.inc('for509_sink_records_total', 5, sink='say "hi"')
+    registry.observe('for509_api_call_seconds', 0.003, api='s3:GetObject')
+    registry.observe('for509_api_call_seconds', 0.2, api='s3:GetObject')
+    lines = to_prometheus(registry).splitlines()
+
+    assert lines[:3] == ['# TYPE for509_api_throttles_total counter', 'for509_api_throttles_total{api="s3:GetObject"} 3',
+                         '# TYPE for509_sink_records_total counter']
+    assert lines[3] == 'for509_sink_records_total{sink="say \\"hi\\""} 5'
+    assert lines[4] == '# TYPE for509_api_call_seconds histogram'
+    # Buckets are cumulative and end with +Inf, followed by the sum and count
+    buckets = lines[5:5 + len(BUCKETS) + 1]
+    assert buckets[0] == 'for509_api_call_seconds_bucket{api="s3:GetObject",le="0.0001"} 0'
+    assert 'for509_api_call_seconds_bucket{api="s3:GetObject",le="0.005"} 1' in buckets
+    assert 'for509_api_call_seconds_bucket{api="s3:GetObject",le="0.25"} 2' in buckets
+    assert buckets[-1] == 'for509_api_call_seconds_bucket{api="s3:GetObject",le="+Inf"} 2'
+    assert lines[-2:] == ['for509_api_call_seconds_sum{api="s3:GetObject"} 0.203', 'for509_api_call_seconds_count{api="s3:GetObject"} 2']
+
+def test_summary_quantiles():
+    registry = Registry()
+    for _ in range(90):
+        registry.observe('for509_write_seconds', 0.0008)
+    for _ in range(10):
+        registry.observe('for509_write_seconds', 3.0)
+    registry.inc('for509_bytes_written_total', 4096, collector='gws')
+    result = json.loads(json.dumps(summary(registry)))
+
+    assert result['counters'] == {'for509_bytes_written_total{collector="gws"}': 4096}
+    histogram = result['histograms']['for509_write_seconds']
+    assert histogram['count'] == 100
+    assert abs(histogram['mean'] - (90 * 0.0008 + 10 * 3.0) / 100) < 1e-9
+    # Interpolated within the bucket the quantile falls in
+    assert 0.0005 < histogram['p50'] <= 0.001
+    assert 2.5 < histogram['p95'] <= 5.0
+    assert summary(Registry()) == {'counters': {}, 'histograms': {}}
+
+def test_worker_snapshots_are_merged_into_the_export(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path / 'snapshots'))
+    os.makedirs(str(tmp_path / 'snapshots'))
+    worker = Registry()
+    worker.inc('for509_test_pages_total', 7, region='us-east-1')
+    worker.observe('for509_test_call_seconds', 0.5)
+    with open(str(tmp_path / 'snapshots' / '1.json'), 'w') as f:
+        json.dump(worker.snapshot(), f)
+    metrics.inc('for509_test_pages_total', 3, region='us-east-1')
+
+    exporter = metrics.MetricsExporter(str(tmp_path / 'metrics.prom'), str(tmp_path / 'summary.json')).start()
+    exporter.close()
+    with open(str(tmp_path / 'summary.json')) as f:
+        result = json.load(f)
+    assert result['counters']['for509_test_pages_total{region="us-east-1"}'] == 10
+    assert result['histograms']['for509_test_call_seconds']['count'] == 1
+    with open(str(tmp_path / 'metrics.prom')) as f:
+        assert 'for509_test_pages_total{region="us-east-1"} 10\n' in f.read()
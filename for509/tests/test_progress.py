@@ -0,0 +1,65 @@
+import io
+import multiprocessing
+
+from for509.progress import LogDisplay, ProgressCounter, RateMeter, format_bytes, format_eta
+
+def count(counter, pages):
+    for _ in range(pages):
+        counter.add(50, 1000)
+
+def test_counter_is_shared_with_worker_processes():
+    counter = ProgressCounter()
+    assert counter.remaining is None
+    worker = multiprocessing.Process(target=count, args=(counter, 10))
+    worker.start()
+    worker.join()
+    assert (counter.events, counter.bytes) == (500, 10000)
+    counter.set_events(20)
+    counter.set_remaining(0)
+    assert counter.events == 20
+    assert counter.remaining == 0
+
+def test_rates_and_eta_over_the_window():
+    counter = ProgressCounter()
+    meter = RateMeter(window=30.0)
+    counter.set_remaining(1000)
+    assert meter.sample('us-east-1', counter, now=0.0) == (0.0, 0.0, None)
+    counter.add(100, 2000)
+    counter.set_remaining(900)
+    events_rate, bytes_rate, eta = meter.sample('us-east-1', counter, now=10.0)
+    assert (events_rate, bytes_rate) == (10.0, 200.0)
+    # 100 units of work done in 10 seconds, 900 to go
+    assert eta == 90.0
+
+    # Samples older than the window are dropped, so the rates follow a slowdown
+    counter.add(10, 200)
+    meter.sample('us-east-1', counter, now=40.0)
+    counter.add(10, 200)
+    events_rate, _, _ = meter.sample('us-east-1', counter, now=50.0)
+    assert events_rate == 1.0
+
+def test_eta_is_unknown_until_the_remaining_work_goes_down():
+    counter = ProgressCounter()
+    meter = RateMeter()
+    meter.sample('gws', counter, now=0.0)
+    counter.add(100, 0)
+    assert meter.sample('gws', counter, now=5.0)[2] is None
+    meter.forget('gws')
+    assert meter.sample('gws', counter, now=6.0) == (0.0, 0.0, None)
+
+def test_log_display_prints_changed_rows_every_interval():
+    stream = io.StringIO()
+    display = LogDisplay('Downloading', interval=3600, stream=stream)
+    display.set_row('us-east-1', 'us-east-1: 100 events')
+    display.refresh()
+    display.set_row('eu-west-1', 'eu-west-1: DONE', bold=True)
+    lines = stream.getvalue().splitlines()
+    assert [line.split(' ', 2)[2] for line in lines] == ['Downloading', 'eu-west-1: DONE']
+
+def test_formatting():
+    assert format_bytes(512) == '512B'
+    assert format_bytes(1536) == '1.5KB'
+    assert format_bytes(3 * 1024 ** 4) == '3.0TB'
+    assert format_eta(None) == '--:--'
+    assert format_eta(75) == '1:15'
+    assert format_eta(7260) == '2h01m'
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from for509.ratelimit import AdaptiveConcurrency, TokenBucket, call_with_backoff
+
+class Throttled(Exception):
+    status_code = 429
+
+def test_throttle_halves_the_rate_and_successes_win_it_back():
+    limiter = TokenBucket(rate=2.0, min_rate=0.1, increase=0.5, decrease=0.5)
+    limiter.on_throttle()
+    assert limiter.rate == 1.0
+    limiter.on_throttle()
+    assert limiter.rate == 0.5
+    assert limiter.throttles == 2
+    for _ in range(2):
+        limiter.on_success()
+    assert limiter.rate == 1.5
+    # Never past the rate it started at, nor under the minimum
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.rate == 2.0
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == 0.1
+
+def test_throttle_drains_the_bucket():
+    limiter = TokenBucket(rate=20.0, burst=1.0)
+    limiter.acquire()
+    limiter.on_throttle()
+    start = time.monotonic()
+    limiter.acquire()
+    # A whole token at the halved rate of 10 a second
+    assert time.monotonic() - start >= 0.09
+    assert limiter.requests == 2
+
+def test_throttled_calls_are_retried_at_a_lower_rate():
+    limiter = TokenBucket(rate=50.0)
+    responses = [Throttled(), Throttled(), 'page']
+
+    def call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert call_with_backoff(limiter, call, base_delay=0.001) == 'page'
+    assert limiter.throttles == 2
+    assert limiter.requests == 3
+    assert limiter.rate == 50.0 * 0.5 * 0.5 + 0.05
+
+def test_other_errors_are_not_retried():
+    limiter = TokenBucket(rate=50.0)
+
+    def call():
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        call_with_backoff(limiter, call, base_delay=0.001)
+    assert limiter.requests == 1
+    assert limiter.throttles == 0
+
+def test_acquire_waits_for_a_free_slot():
+    limiter = AdaptiveConcurrency(initial=2, maximum=4, interval=3600)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(5)
+    waiter.join()
+    assert limiter.active == 2
+
+def test_running_transfers_never_exceed_the_limit():
+    limiter = AdaptiveConcurrency(initial=3, maximum=3, interval=3600)
+    lock = threading.Lock()
+    running = [0, 0]  # Now, most at once
+
+    def transfer():
+        limiter.acquire()
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        limiter.release(1024)
+
+    threads = [threading.Thread(target=transfer) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert running == [0, 3]
+    assert limiter.active == 0
+
+def test_throttle_halves_the_limit_and_throughput_moves_it():
+    limiter = AdaptiveConcurrency(initial=8, minimum=1, maximum=16, interval=0)
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    assert limiter.throttles == 1
+    # Probes upwards while the throughput holds, and turns back once it drops
+    for transferred in (1000, 100000):
+        limiter.acquire()
+        time.sleep(0.01)
+        limiter.release(transferred)
+    assert limiter.limit == 6
+    limiter.acquire()
+    time.sleep(0.01)
+    limiter.release(0)
+    assert limiter.limit == 5
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.limit == 1
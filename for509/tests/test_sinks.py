@@ -0,0 +1,54 @@
+import json
+import sys
+
+import pytest
+
+from bench.fakes import ElasticsearchFake
+from for509.sinks import SinkError, open_sink, report_stream
+
+class RejectingElasticsearchFake(ElasticsearchFake):
+    """
+    Rejects the documents whose _id is in rejected for their content, like a mapping conflict.
+    """
+
+    rejected = ()
+
+    def handle(self, method, path, headers, body):
+        status, response_headers, response = super().handle(method, path, headers, body)
+        result = json.loads(response)
+        for item in result['items']:
+            if item['index']['_id'] in self.rejected:
+                item['index'].update(status=400, error={'type': 'mapper_parsing_exception'})
+                result['errors'] = True
+        return status, response_headers, json.dumps(result).encode()
+
+def test_documents_rejected_for_their_content_fail_the_flush():
+    with RejectingElasticsearchFake() as fake:
+        fake.rejected = {'b'}
+        sink = open_sink(f'elasticsearch+{fake.url}/logs', 'test')
+        sink.send(['{"n":1}', '{"n":2}', '{"n":3}'], ['a', 'b', 'c'])
+        with pytest.raises(SinkError, match='mapper_parsing_exception'):
+            sink.flush()
+        with pytest.raises(SinkError):
+            sink.close()
+        assert fake.ids == {'a', 'b', 'c'}
+
+def test_accepted_documents_flush():
+    with RejectingElasticsearchFake() as fake:
+        sink = open_sink(f'elasticsearch+{fake.url}/logs', 'test')
+        sink.send(['{"n":1}', '{"n":2}'], ['a', 'b'])
+        sink.close()
+        assert fake.ids == {'a', 'b'}
+
+def test_stdout_sink_leaves_the_process_output_alone(capsysbinary):
+    stdout = sys.stdout
+    sink = open_sink('stdout', 'test')
+    assert sys.stdout is stdout
+    assert report_stream(sink) is report_stream('-') is sys.stderr
+    assert report_stream(None) is sys.stdout
+    sink.send(['{"n":1}', '{"n":2}'])
+    print('Done', file=report_stream(sink))
+    sink.close()
+    captured = capsysbinary.readouterr()
+    assert captured.out == b'{"n":1}\n{"n":2}\n'
+    assert captured.err == b'Done\n'
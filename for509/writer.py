@@ -0,0 +1,204 @@
+"""
+Output writers shared by the collectors.
+"""
+
+import gzip, io, os, tempfile
+
+from for509.integrity import Hasher, HashingFile
+
+# File name extension of each supported compression
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression requires the zstandard package (pip install zstandard)')
+    return zstandard
+
+class RollingRecordsWriter(object):
+    """
+    Writes CloudTrail style {"Records":[...]} gzip files from a single open compressor stream, rolling over to a new
+    file once max_events records or max_bytes of compressed output have been written. With ndjson=True the records
+    are written one per line without the envelope instead.
+
+    Files are written as <name>.part and only renamed to their final name after being fsynced, so a file with its final
+    name is always complete. write() returns True when it closed a file, which is the point where any resume state
+    covering the records written so far can safely be saved. If on_close is given it is called as
+    on_close(filename, events, size) after the .part file is on disk but before it is renamed, so a checkpoint that
+    lists the file is always committed before the file appears under its final name.
+
+    With hash_algorithms, the digests of each file's bytes are computed as they are written, and are in digests when
+    on_close is called.
+    """
+
+    def __init__(self, make_filename, first_index=0, max_events=100000, max_bytes=64 * 1024 * 1024, compresslevel=6, ndjson=False, on_close=None,
+                 hash_algorithms=()):
+        self.make_filename = make_filename
+        self.hash_algorithms = hash_algorithms
+        self.digests = {}
+        self.on_close = on_close
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        if ndjson:
+            self._header, self._separator, self._footer = b'', '\n', b'\n'
+        else:
+            self._header, self._separator, self._footer = b'{"Records":[', ',', b']}'
+        self.next_index = first_index
+        self.closed_files = []
+        self._raw = None
+        self._stream = None
+        self._filename = None
+        self._file_events = 0
+
+    def _open(self):
+        self._filename = self.make_filename(self.next_index)
+        self._raw = open(self._filename + '.part', 'wb')
+        self._hashing = HashingFile(self._raw, Hasher(self.hash_algorithms)) if self.hash_algorithms else None
+        self._stream = gzip.GzipFile(fileobj=self._hashing or self._raw, mode='wb', compresslevel=self.compresslevel)
+        self._stream.write(self._header)
+        self._file_events = 0
+
+    def write(self, records):
+        """
+        Appends already JSON encoded records (str) to the current file. Records are spliced in as they are,
+        so strings returned by the API can be written without being parsed. Returns True if the file was rolled.
+        """
+        if not records:
+            return False
+        if self._stream is None:
+            self._open()
+        separator = self._separator if self._file_events else ''
+        self._stream.write((separator + self._separator.join(records)).encode('utf-8'))
+        self._file_events += len(records)
+        self.next_index += len(records)
+
+        if self._file_events >= self.max_events or self._raw.tell() >= self.max_bytes:
+            self.roll()
+            return True
+        return False
+
+    def roll(self):
+        """
+        Finishes the current file (if any), fsyncs it and moves it to its final name.
+        """
+        if self._stream is None:
+            return None
+        self._stream.write(self._footer)
+        self._stream.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        size = self._raw.tell()
+        self._raw.close()
+        self.digests = self._hashing.hasher.hexdigests() if self._hashing is not None else {}
+        if self.on_close is not None:
+            self.on_close(self._filename, self._file_events, size)
+        os.replace(self._filename + '.part', self._filename)
+        self.closed_files.append(self._filename)
+        filename, self._stream, self._raw, self._filename = self._filename, None, None, None
+        return filename
+
+    def close(self):
+        self.roll()
+
+class NdjsonWriter(object):
+    """
+    Appends (or writes) lines to an NDJSON file, plain or gzip/zstd compressed, in large buffered writes. Each writer
+    adds one gzip member or zstd frame to a compressed file, so appending to a file from an earlier run keeps it valid,
+    and truncating it back to the size returned by an earlier close() drops exactly what was appended since.
+
+    With a hasher, the bytes this writer adds to the file are hashed as they are written.
+    """
+
+    def __init__(self, path, append=True, compression=None, compresslevel=6, buffer_size=1024 * 1024, hasher=None):
+        self.path = path
+        self.hasher = hasher
+        self._raw = open(path, 'ab' if append else 'wb', buffering=buffer_size)
+        target = HashingFile(self._raw, hasher) if hasher is not None else self._raw
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=target, mode='wb', compresslevel=compresslevel)
+        elif compression == 'zstd':
+            self._stream = _zstandard().ZstdCompressor(level=compresslevel).stream_writer(target, closefd=False)
+        else:
+            self._stream = target
+        self._compressed = compression is not None
+
+    def write_lines(self, lines):
+        """
+        Writes a batch of lines, each already ending with a newline.
+        """
+        if lines:
+            self._stream.write(''.join(lines).encode('utf-8'))
+
+    def close(self):
+        """
+        Finishes the compressed stream, fsyncs the file and returns its size.
+        """
+        if self._compressed:
+            self._stream.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        size = self._raw.tell()
+        self._raw.close()
+        return size
+
+def open_lines(path, compression=None):
+    """
+    Opens a file written by NdjsonWriter for reading text lines.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == 'zstd':
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+class ReversingSpool(object):
+    """
+    Puts a stream of lines that arrives newest first (as most log APIs page) back in time order with bounded memory.
+    Lines are buffered until there are run_size of them, then written out reversed, as a run in a temporary file.
+    Because the stream is already ordered, the runs never overlap and replaying them from the last one written to the
+    first yields every line oldest first.
+    """
+
+    def __init__(self, directory, run_size=20000):
+        self.directory = directory
+        self.run_size = run_size
+        self.count = 0
+        self._buffer = []
+        self._runs = []
+
+    def add(self, lines):
+        """
+        Adds lines (each ending with a newline) that are all older than the lines added before.
+        """
+        self._buffer.extend(lines)
+        self.count += len(lines)
+        if len(self._buffer) >= self.run_size:
+            fd, run_path = tempfile.mkstemp(prefix='.run-', suffix='.ndjson', dir=self.directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as run:
+                run.writelines(reversed(self._buffer))
+            self._runs.append(run_path)
+            self._buffer = []
+
+    def replay(self, batch_size=5000):
+        """
+        Yields the lines oldest first, in batches of up to batch_size.
+        """
+        lines = self._buffer[::-1]
+        for start in range(0, len(lines), batch_size):
+            yield lines[start:start + batch_size]
+        for run_path in reversed(self._runs):
+            with open(run_path, 'r', encoding='utf-8') as run:
+                while True:
+                    batch = run.readlines(batch_size * 1024)
+                    if not batch:
+                        break
+                    yield batch
+
+    def close(self):
+        for run_path in self._runs:
+            os.remove(run_path)
+        self._runs = []
+        self._buffer = []